@@ -0,0 +1,69 @@
+import random
+
+from typing import Dict, List, Tuple
+
+from prompt_building_utils import TAG_START, TAG_END
+
+# A sample of fine-grained Few-NERD types
+FINE_GRAINED_TYPES = ["art-music", "building-hospital", "event-election", "location-GPE", "organization-company",
+                      "other-award", "person-artist/author", "product-software"]
+
+WORDS = ["the", "of", "in", "and", "a", "to", "was", "he", "for", "on", "is", "as", "with", "by", "his", "at",
+         "from", "new", "york", "university", "national", "john", "city", "team", "first", "album", "river",
+         "county", "league", "party", "church", ",", ".", "(", ")", "``", "''"]
+
+
+def synthetic_sentence(rng: random.Random, n_tokens: int, entity_rate: float = 0.1) -> Tuple[List[str], List[str]]:
+    """
+    Generate a Few-NERD-shaped sentence: lowercase tokens with entities of 1-3 tokens.
+
+    :param rng: random number generator
+    :param n_tokens: sentence length
+    :param entity_rate: probability of an entity starting at a given token
+    :return: tokens and fine-grained labels
+    """
+    tokens, labels = [], []
+    while len(tokens) < n_tokens:
+        if rng.random() < entity_rate:
+            entity_type = rng.choice(FINE_GRAINED_TYPES)
+            for _ in range(min(rng.randint(1, 3), n_tokens - len(tokens))):
+                tokens.append(rng.choice(WORDS[16:31]))
+                labels.append(entity_type)
+            # Keep adjacent entities apart
+            if len(tokens) < n_tokens:
+                tokens.append(rng.choice(WORDS[:16]))
+                labels.append("O")
+        else:
+            tokens.append(rng.choice(WORDS))
+            labels.append("O")
+    return tokens, labels
+
+
+def synthetic_output(n_entities: int, words_between: int = 5) -> str:
+    """
+    Generate a well-formed model output with the given number of tagged entities.
+
+    :param n_entities: number of entities
+    :param words_between: number of untagged words between entities
+    :return: output string
+    """
+    filler = " ".join(["word"] * words_between)
+    return " ".join(f"{filler} {TAG_START}new york{TAG_END}" for _ in range(n_entities)) + " ."
+
+
+def synthetic_episode(rng: random.Random, n_way: int = 5, k_shot: int = 5, sentence_length: int = 25) -> Dict:
+    """
+    Generate an episode in the Few-NERD episode data format.
+
+    :param rng: random number generator
+    :param n_way: number of entity types
+    :param k_shot: number of examples per type (the support set has about n_way * k_shot sentences)
+    :param sentence_length: mean sentence length
+    :return: episode dictionary with "support", "query" and "types"
+    """
+    episode = {"types": rng.sample(FINE_GRAINED_TYPES, min(n_way, len(FINE_GRAINED_TYPES)))}
+    for split in ["support", "query"]:
+        sentences = [synthetic_sentence(rng, rng.randint(sentence_length // 2, sentence_length * 3 // 2))
+                     for _ in range(n_way * k_shot)]
+        episode[split] = {"word": [s[0] for s in sentences], "label": [s[1] for s in sentences]}
+    return episode
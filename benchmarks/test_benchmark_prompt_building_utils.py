@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+from prompt_building_utils import (make_output_example, output_well_formed, extract_predicted_entities,
+                                   labels_from_output, build_llama2_prompt_plain)
+from read_few_nerd import FewNerdEpisode
+
+from .synthetic_corpora import synthetic_sentence, synthetic_output, synthetic_episode
+
+pytest.importorskip("pytest_benchmark")
+
+SIZES = [10, 100, 1000]
+
+
+@pytest.mark.parametrize("n_tokens", SIZES)
+def test_benchmark_make_output_example(benchmark, n_tokens):
+    tokens, labels = synthetic_sentence(random.Random(0), n_tokens)
+    benchmark(make_output_example, tokens, labels, "location")
+
+
+@pytest.mark.parametrize("n_entities", SIZES)
+def test_benchmark_output_well_formed(benchmark, n_entities):
+    assert benchmark(output_well_formed, synthetic_output(n_entities)) is True
+
+
+@pytest.mark.parametrize("n_entities", SIZES)
+def test_benchmark_extract_predicted_entities(benchmark, n_entities):
+    assert len(benchmark(extract_predicted_entities, synthetic_output(n_entities))) == n_entities
+
+
+@pytest.mark.parametrize("n_tokens", SIZES)
+def test_benchmark_labels_from_output(benchmark, n_tokens):
+    tokens, labels = synthetic_sentence(random.Random(0), n_tokens)
+    output = make_output_example(tokens, labels, "location")
+    assert len(benchmark(labels_from_output, output, tokens, "location")) == n_tokens
+
+
+@pytest.mark.parametrize("n_examples", SIZES)
+def test_benchmark_build_llama2_prompt_plain(benchmark, n_examples):
+    rng = random.Random(0)
+    examples = []
+    for _ in range(n_examples):
+        tokens, labels = synthetic_sentence(rng, 25)
+        examples.append((" ".join(tokens), make_output_example(tokens, labels, "location")))
+    benchmark(build_llama2_prompt_plain, examples, "I am an excellent linguist.",
+              "The task is to label location entities in the given sentence.", "a query sentence .")
+
+
+@pytest.mark.parametrize("k_shot", [1, 5, 20])
+def test_benchmark_few_nerd_episode(benchmark, k_shot):
+    episode_dict = synthetic_episode(random.Random(0), n_way=10, k_shot=k_shot)
+    benchmark(FewNerdEpisode, episode_dict, None, False)
@@ -0,0 +1,82 @@
+import time
+import random
+
+from typing import Callable, Sequence
+
+from prompt_building_utils import (make_output_example, output_well_formed, extract_predicted_entities,
+                                   labels_from_output, build_llama2_prompt_plain)
+from read_few_nerd import FewNerdEpisode
+
+from .synthetic_corpora import synthetic_sentence, synthetic_output, synthetic_episode
+
+# Growing the input 8 times should take about 8 times longer for linear code and 64 times longer for quadratic code;
+# the threshold leaves room for timing noise
+SCALE = 8
+MAX_RATIO = 24
+
+
+def best_time(func: Callable[[], object], repeats: int = 5) -> float:
+    # Best of several runs is the most stable estimate of the cost of a call
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def assert_subquadratic(make_call: Callable[[int], Callable[[], object]], sizes: Sequence[int]) -> None:
+    """
+    Check that the time of a call grows roughly linearly with the input size.
+
+    :param make_call: function creating a zero-argument call for a given input size
+    :param sizes: a small and a large input size
+    """
+    small, large = sizes
+    time_small = best_time(make_call(small))
+    time_large = best_time(make_call(large))
+    ratio = time_large / time_small
+    assert ratio < MAX_RATIO, f"{large / small:.0f}x larger input took {ratio:.1f}x longer"
+
+
+def test_scaling_make_output_example():
+    def make_call(n_tokens):
+        tokens, labels = synthetic_sentence(random.Random(0), n_tokens)
+        return lambda: make_output_example(tokens, labels, "location")
+    assert_subquadratic(make_call, (2000, 2000 * SCALE))
+
+
+def test_scaling_output_well_formed():
+    def make_call(n_entities):
+        output = synthetic_output(n_entities)
+        return lambda: output_well_formed(output)
+    assert_subquadratic(make_call, (2000, 2000 * SCALE))
+
+
+def test_scaling_extract_predicted_entities():
+    def make_call(n_entities):
+        output = synthetic_output(n_entities)
+        return lambda: extract_predicted_entities(output)
+    assert_subquadratic(make_call, (2000, 2000 * SCALE))
+
+
+def test_scaling_labels_from_output():
+    def make_call(n_tokens):
+        tokens, labels = synthetic_sentence(random.Random(0), n_tokens, entity_rate=0.01)
+        output = make_output_example(tokens, labels, "location")
+        return lambda: labels_from_output(output, tokens, "location")
+    assert_subquadratic(make_call, (20000, 20000 * SCALE))
+
+
+def test_scaling_build_llama2_prompt_plain():
+    def make_call(n_examples):
+        examples = [("a b c", "a b c")] * n_examples
+        return lambda: build_llama2_prompt_plain(examples, "system", "instruction", "query")
+    assert_subquadratic(make_call, (2000, 2000 * SCALE))
+
+
+def test_scaling_few_nerd_episode():
+    def make_call(k_shot):
+        episode_dict = synthetic_episode(random.Random(0), n_way=10, k_shot=k_shot)
+        return lambda: FewNerdEpisode(episode_dict, None, False)
+    assert_subquadratic(make_call, (5, 5 * SCALE))
@@ -0,0 +1,158 @@
+from concurrent.futures import Executor, as_completed
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+from tqdm import tqdm
+
+from clarifai_prompter import ClarifaiPrompter
+from telemetry import Telemetry
+from prompt_building_utils import (build_reprompt, build_self_verification_prompt_plain, extract_predicted_entities,
+                                   output_problem, verification_system_message)
+
+# Reasons for sending a prompt to the next tier
+ESCALATION_REASONS = ("malformed", "alignment", "verification")
+
+
+class CascadeTier(NamedTuple):
+    prompter: ClarifaiPrompter
+    model_id: str
+    # Prompts escalated to this tier are repeated with the rejected output and the problem (see build_reprompt)
+    reprompt: bool = False
+
+
+def parse_model_spec(spec: str, user_id: str, app_id: str) -> Tuple[str, str, str]:
+    """
+    Parse a model given either as MODEL_ID or as USER_ID/APP_ID/MODEL_ID.
+
+    :param spec: model specification
+    :param user_id: user ID to use if the specification does not include one
+    :param app_id: app ID to use if the specification does not include one
+    :return: (user_id, app_id, model_id)
+    """
+    parts = spec.split("/")
+    if len(parts) == 1:
+        return user_id, app_id, spec
+    if len(parts) == 3:
+        return parts[0], parts[1], parts[2]
+    raise ValueError(f"Model should be given as MODEL_ID or USER_ID/APP_ID/MODEL_ID, not {spec}")
+
+
+class ModelCascade:
+    """
+    Send prompts through a sequence of model tiers, e.g. a small fast model followed by a larger one.
+    All prompts go to the first tier; outputs that are malformed, cannot be aligned with the input tokens
+    (see output_problem) or, with verify, contain an entity the tier's model rejects when asked to verify it,
+    are sent to the next tier, all escalated prompts of an episode at once.
+    Outputs of the last tier are used as they are.
+    """
+
+    def __init__(self, tiers: List[CascadeTier], verify: bool = False, telemetry: Optional[Telemetry] = None):
+        if not tiers:
+            raise ValueError("A cascade needs at least one tier")
+        self.tiers = tiers
+        self.verify = verify
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        # Number of prompts sent to each tier, and of outputs with each problem
+        # (escalated, except for the last tier, where verification is not run)
+        self.prompt_counts = [0] * len(tiers)
+        self.problem_counts = [{reason: 0 for reason in ESCALATION_REASONS} for _ in tiers]
+
+    def _rejected_by_verification(self, tier: CascadeTier, executor: Executor,
+                                  candidates: Dict[int, Tuple[str, str, Tuple[int, str, int]]]) -> Set[int]:
+        """
+        Ask the tier's model to verify each entity of the given outputs.
+
+        :param tier: tier whose outputs are verified
+        :param executor: executor running the requests
+        :param candidates: dictionary mapping prompt positions to (output, input sentence, index)
+        :return: positions of outputs with at least one entity the model does not confirm
+        """
+        futures = {}
+        for position, (output, input_example, index) in candidates.items():
+            entity_class = index[1]
+            for entity in extract_predicted_entities(output):
+                prompt = build_self_verification_prompt_plain(verification_system_message(entity_class),
+                                                              input_example, entity, entity_class)
+                futures[tier.prompter.submit(executor, tier.model_id, prompt, index)] = position
+        rejected = set()
+        for future in as_completed(futures):
+            answer, _ = future.result()
+            if not answer.strip().lower().startswith("yes"):
+                rejected.add(futures[future])
+        return rejected
+
+    def predict(self, executor: Executor, raw_texts_ner: List[Tuple[str, Tuple[int, str, int]]],
+                query_tokens: Sequence[Sequence[str]], show_progress: bool = True
+                ) -> List[Tuple[str, Tuple[int, str, int]]]:
+        """
+        Get outputs for all prompts of an episode, escalating unusable outputs to later tiers.
+
+        :param executor: executor running the requests
+        :param raw_texts_ner: (prompt, (episode_id, entity_class, query_id)) pairs, see build_episode_prompts
+        :param query_tokens: tokens of each query sentence of the episode
+        :param show_progress: show progress bars
+        :return: (first line of the output, index) pairs, in the order of raw_texts_ner
+        """
+        outputs = [""] * len(raw_texts_ner)
+        prompts = [raw_text for raw_text, _ in raw_texts_ner]
+        pending = list(range(len(raw_texts_ner)))
+
+        for tier_id, tier in enumerate(self.tiers):
+            is_last_tier = tier_id == len(self.tiers) - 1
+            self.prompt_counts[tier_id] += len(pending)
+            futures = {tier.prompter.submit(executor, tier.model_id, prompts[position], raw_texts_ner[position][1]):
+                       position for position in pending}
+            for future in tqdm(as_completed(futures), total=len(futures),
+                               desc=f"Getting predictions (tier {tier_id})", disable=not show_progress):
+                output_text, _ = future.result()
+                # Only use the first line of each output, as the model is prone to over-generation
+                outputs[futures[future]] = output_text.split('\n')[0]
+
+            problems = {}
+            candidates = {}
+            for position in pending:
+                _, (_, entity_class, query_id) = raw_texts_ner[position]
+                problem = output_problem(outputs[position], list(query_tokens[query_id]), entity_class)
+                if problem is not None:
+                    problems[position] = problem
+                elif self.verify and not is_last_tier and extract_predicted_entities(outputs[position]):
+                    candidates[position] = (outputs[position], ' '.join(query_tokens[query_id]),
+                                            raw_texts_ner[position][1])
+            if candidates:
+                for position in self._rejected_by_verification(tier, executor, candidates):
+                    problems[position] = "verification"
+
+            for position, problem in problems.items():
+                self.problem_counts[tier_id][problem] += 1
+                if is_last_tier:
+                    continue
+                self.telemetry.inc("fewnerd_cascade_escalations_total", model=tier.model_id, reason=problem)
+                if self.tiers[tier_id + 1].reprompt:
+                    prompt, (_, entity_class, _) = raw_texts_ner[position]
+                    prompts[position] = build_reprompt(prompt, outputs[position], problem, entity_class)
+                else:
+                    prompts[position] = raw_texts_ner[position][0]
+            pending = sorted(problems)
+            if not pending:
+                break
+
+        return [(output, index) for output, (_, index) in zip(outputs, raw_texts_ner)]
+
+    def report(self) -> str:
+        """
+        Build a table with the number of prompts sent to each tier and the number of escalated prompts by reason.
+        For the last tier, the problem columns count outputs that were used despite the problem.
+
+        :return: table as a string
+        """
+        names = [f"{tier.model_id} (reprompt)" if tier.reprompt else tier.model_id for tier in self.tiers]
+        width = max(len("model"), *(len(name) for name in names))
+        lines = [f"{'tier':>4} {'model':<{width}} {'prompts':>8} "
+                 + " ".join(f"{reason:>12}" for reason in ESCALATION_REASONS) + f" {'escalated':>12}"]
+        for tier_id, name in enumerate(names):
+            n_problems = sum(self.problem_counts[tier_id].values())
+            escalated = n_problems if tier_id < len(self.tiers) - 1 else 0
+            n_prompts = self.prompt_counts[tier_id]
+            share = f"{escalated} ({escalated / n_prompts:.0%})" if n_prompts else "0"
+            lines.append(f"{tier_id:>4} {name:<{width}} {n_prompts:>8} "
+                         + " ".join(f"{self.problem_counts[tier_id][reason]:>12}" for reason in ESCALATION_REASONS)
+                         + f" {share:>12}")
+        return "\n".join(lines)
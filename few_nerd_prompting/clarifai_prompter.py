@@ -1,57 +1,421 @@
+import os
 import time
+import queue
 import logging
+import threading
 
+import grpc
+# Channel settings follow clarifai-grpc (pinned in requirements.txt)
+from clarifai_grpc.channel import clarifai_channel
 from clarifai_grpc.channel.clarifai_channel import ClarifaiChannel
 from clarifai_grpc.grpc.api import resources_pb2, service_pb2, service_pb2_grpc
 from clarifai_grpc.grpc.api.status import status_code_pb2
 
-from typing import Tuple, Any
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future
+from typing import Tuple, Any, Optional, Dict, List
 
 from google.protobuf.struct_pb2 import Struct
 
+from telemetry import Telemetry
+
+
+def _entity_class_from_index(index: Any) -> str:
+    # Prompt indices are (episode_id, entity_class, query_id) tuples in prompt_llm.py
+    if isinstance(index, tuple) and len(index) > 1:
+        return str(index[1])
+    return ""
+
+
+class HedgingPolicy:
+    """
+    Decide when to send a duplicate ("hedge") of a slow request.
+    A hedge is sent once a request has been running longer than the given percentile of recent successful latencies,
+    as long as the number of hedges stays within a fraction (budget) of all calls.
+    """
+
+    def __init__(self, percentile: float = 95.0, budget: float = 0.05, min_samples: int = 20, window: int = 1000):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+
+    def record_latency(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def start_call(self) -> Optional[float]:
+        """
+        Register a new call and get the delay after which it should be hedged.
+
+        :return: delay in seconds, or None if there are not enough latency samples yet
+        """
+        with self._lock:
+            self.calls += 1
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        rank = min(int(len(latencies) * self.percentile / 100), len(latencies) - 1)
+        return latencies[rank]
+
+    def acquire_hedge(self) -> bool:
+        """
+        Reserve a hedge if the budget allows it.
+
+        :return: True if a hedge may be sent
+        """
+        with self._lock:
+            if self.hedges_fired + 1 > self.budget * self.calls:
+                return False
+            self.hedges_fired += 1
+            return True
+
+    def record_win(self) -> None:
+        with self._lock:
+            self.hedges_won += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"calls": self.calls, "hedges_fired": self.hedges_fired, "hedges_won": self.hedges_won}
+
+
+COMPRESSION = {
+    None: grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
+
+class ChannelPool:
+    """
+    Pool of gRPC channels to the Clarifai API, each with its own connection and V2Stub.
+    Requests are spread over the channels in turn ("round_robin") or sent to the channel
+    with the fewest requests in flight ("least_loaded"). A failed channel can be replaced with a new one.
+    """
+
+    def __init__(self, size: int = 1, selection: str = "round_robin", keepalive_time_ms: Optional[int] = None,
+                 keepalive_timeout_ms: int = 20000, compression: Optional[str] = None, base: Optional[str] = None):
+        if selection not in ("round_robin", "least_loaded"):
+            raise ValueError(f"Unknown channel selection: {selection}")
+        self.selection = selection
+        self.keepalive_time_ms = keepalive_time_ms
+        self.keepalive_timeout_ms = keepalive_timeout_ms
+        self.compression = COMPRESSION[compression]
+        self.base = base or os.environ.get("CLARIFAI_GRPC_BASE", "api.clarifai.com")
+
+        # V2Stub reads its response deserializer from clarifai-grpc module state, which is set up by getting
+        # a channel from ClarifaiChannel; that channel is closed right away, as it does not connect until used
+        ClarifaiChannel.get_grpc_channel(self.base).close()
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._in_flight = [0] * size
+        self._channels = [self._create_channel() for _ in range(size)]
+        self._stubs = [service_pb2_grpc.V2Stub(channel) for channel in self._channels]
+
+    def _create_channel(self) -> grpc.Channel:
+        # Same settings as ClarifaiChannel.get_grpc_channel()
+        options = [
+            ("grpc.service_config", clarifai_channel.grpc_json_config),
+            ("grpc.max_receive_message_length", clarifai_channel.MAX_MESSAGE_LENGTH),
+            # Per-channel argument: do not share connections with the other channels of the pool
+            ("grpc.use_local_subchannel_pool", 1),
+        ]
+        if self.keepalive_time_ms:
+            options.extend([
+                ("grpc.keepalive_time_ms", self.keepalive_time_ms),
+                ("grpc.keepalive_timeout_ms", self.keepalive_timeout_ms),
+                ("grpc.keepalive_permit_without_calls", 1),
+                ("grpc.http2.max_pings_without_data", 0),
+            ])
+        return grpc.secure_channel(self.base, grpc.ssl_channel_credentials(), options=options,
+                                   compression=self.compression)
+
+    def acquire(self) -> Tuple[int, service_pb2_grpc.V2Stub]:
+        """
+        Choose a channel for a request; release() must be called when the request is finished.
+
+        :return: channel slot and its stub
+        """
+        with self._lock:
+            if self.selection == "least_loaded":
+                slot = min(range(len(self._stubs)), key=lambda i: self._in_flight[i])
+            else:
+                slot = self._next
+                self._next = (self._next + 1) % len(self._stubs)
+            self._in_flight[slot] += 1
+            return slot, self._stubs[slot]
+
+    def release(self, slot: int) -> None:
+        with self._lock:
+            self._in_flight[slot] -= 1
+
+    def recreate(self, slot: int, stub: service_pb2_grpc.V2Stub) -> None:
+        """
+        Replace the channel in a slot with a new one, unless another request already did.
+
+        :param slot: channel slot
+        :param stub: the stub the failed request used
+        """
+        with self._lock:
+            if self._stubs[slot] is not stub:
+                return
+            old_channel = self._channels[slot]
+            self._channels[slot] = self._create_channel()
+            self._stubs[slot] = service_pb2_grpc.V2Stub(self._channels[slot])
+        logging.warning(f"Recreated gRPC channel {slot}")
+        old_channel.close()
+
+    def in_flight(self) -> List[int]:
+        with self._lock:
+            return list(self._in_flight)
+
+
+class LRUCache:
+    """
+    Thread-safe cache of model outputs that keeps at most max_size entries, dropping the least recently used ones.
+    """
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Tuple) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def __setitem__(self, key: Tuple, value: str) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
 
 class ClarifaiPrompter:
     # based on https://github.com/isaac-chung/tweetBot98/blob/main/llm.py
-    def __init__(self, user_id, app_id, pat, max_generated_tokens):
+    def __init__(self, user_id, app_id, pat, max_generated_tokens, telemetry: Optional[Telemetry] = None,
+                 hedging: Optional[HedgingPolicy] = None, cache: Optional[LRUCache] = None,
+                 channels: Optional[ChannelPool] = None):
+        self.user_id = user_id
+        self.app_id = app_id
         self.user_data_object = resources_pb2.UserAppIDSet(user_id=user_id, app_id=app_id)
         self.metadata = (('authorization', 'Key ' + pat),)
 
-        channel = ClarifaiChannel.get_grpc_channel()
-        self.stub = service_pb2_grpc.V2Stub(channel)
+        self.channels = channels if channels is not None else ChannelPool()
 
         self.params = Struct()
         self.params.update({
             "max_tokens": max_generated_tokens
         })
 
-    def _predict(self, model_id, raw_texts_ner):
-        return self.stub.PostModelOutputs(
-            service_pb2.PostModelOutputsRequest(
-                user_app_id=self.user_data_object,
-                model_id=model_id,
-                inputs=[resources_pb2.Input(
-                    data=resources_pb2.Data(
-                        text=resources_pb2.Text(raw=t)
-                    )
-                ) for t in raw_texts_ner],
-                model=resources_pb2.Model(
-                    model_version=resources_pb2.ModelVersion(
-                        output_info=resources_pb2.OutputInfo(
-                            params=self.params
-                        )
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.hedging = hedging
+        # Outputs of completed requests by (user_id, app_id, model_id, prompt), possibly shared between prompters
+        self.cache = cache
+        # Futures of requests being processed (see _request_key), so that identical requests are only sent once
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    def _request(self, model_id, raw_texts_ner):
+        return service_pb2.PostModelOutputsRequest(
+            user_app_id=self.user_data_object,
+            model_id=model_id,
+            inputs=[resources_pb2.Input(
+                data=resources_pb2.Data(
+                    text=resources_pb2.Text(raw=t)
+                )
+            ) for t in raw_texts_ner],
+            model=resources_pb2.Model(
+                model_version=resources_pb2.ModelVersion(
+                    output_info=resources_pb2.OutputInfo(
+                        params=self.params
                     )
                 )
-            ),
-            metadata=self.metadata
+            )
         )
 
+    @staticmethod
+    def _retry_unavailable(send):
+        # A call failing because its connection is unavailable is retried once (on a new channel, see _call_once)
+        for attempt in range(2):
+            try:
+                return send()
+            except grpc.RpcError as e:
+                if attempt or e.code() != grpc.StatusCode.UNAVAILABLE:
+                    raise
+
+    def _call(self, request):
+        return self._retry_unavailable(lambda: self._call_once(request))
+
+    def _call_once(self, request):
+        slot, stub = self.channels.acquire()
+        try:
+            return stub.PostModelOutputs(request, metadata=self.metadata)
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.UNAVAILABLE:
+                self.channels.recreate(slot, stub)
+                self.telemetry.inc("fewnerd_channel_recreations_total")
+            raise
+        finally:
+            self.channels.release(slot)
+
+    def _call_future(self, request):
+        slot, stub = self.channels.acquire()
+        call = stub.PostModelOutputs.future(request, metadata=self.metadata)
+
+        def on_done(finished_call):
+            self.channels.release(slot)
+            if not finished_call.cancelled() and isinstance(finished_call.exception(), grpc.RpcError) \
+                    and finished_call.code() == grpc.StatusCode.UNAVAILABLE:
+                self.channels.recreate(slot, stub)
+                self.telemetry.inc("fewnerd_channel_recreations_total")
+
+        call.add_done_callback(on_done)
+        return call
+
+    def _predict(self, model_id, raw_texts_ner):
+        if self.hedging is not None:
+            return self._retry_unavailable(lambda: self._predict_hedged(model_id, raw_texts_ner))
+        return self._call(self._request(model_id, raw_texts_ner))
+
+    def _predict_hedged(self, model_id, raw_texts_ner):
+        """
+        Send a request; if it has not returned within the hedging delay, send a duplicate
+        and use whichever response comes first, cancelling the other call.
+        """
+        request = self._request(model_id, raw_texts_ner)
+        hedge_delay = self.hedging.start_call()
+        primary = self._call_future(request)
+        if hedge_delay is None:
+            return primary.result()
+
+        finished = queue.Queue()
+        primary.add_done_callback(lambda call: finished.put((False, call)))
+        try:
+            _, first_call = finished.get(timeout=hedge_delay)
+            return first_call.result()
+        except queue.Empty:
+            pass
+
+        if not self.hedging.acquire_hedge():
+            return primary.result()
+        self.telemetry.inc("fewnerd_hedges_fired_total", model=model_id)
+        hedge = self._call_future(request)
+        hedge.add_done_callback(lambda call: finished.put((True, call)))
+
+        is_hedge, first_call = finished.get()
+        other_call = primary if is_hedge else hedge
+        # If the first call to finish failed, fall back to the other one; that is not a won race
+        if first_call.exception() is not None:
+            return other_call.result()
+        other_call.cancel()
+        if is_hedge:
+            self.hedging.record_win()
+            self.telemetry.inc("fewnerd_hedges_won_total", model=model_id)
+        return first_call.result()
+
     def predict(self, model_id, raw_text_ner, index, retries=3) -> Tuple[str, Tuple[Any, ...]]:
-        for i in range(retries):
-            post_model_outputs_response = self._predict(model_id, [raw_text_ner])
-            if post_model_outputs_response.status.code == status_code_pb2.SUCCESS:
-                return post_model_outputs_response.outputs[0].data.text.raw, index
-            if i == retries - 1:
-                logging.error(post_model_outputs_response.status)
-                raise Exception("Post model outputs failed, status: " + post_model_outputs_response.status.description)
-            logging.info(f"Prompt trial {i} failed. Sleeping for one minute.")
-            time.sleep(10)
+        entity_class = _entity_class_from_index(index)
+        self.telemetry.add_gauge("fewnerd_requests_in_flight", 1, model=model_id)
+        try:
+            for i in range(retries):
+                start_time = time.perf_counter()
+                try:
+                    post_model_outputs_response = self._predict(model_id, [raw_text_ner])
+                except grpc.RpcError as e:
+                    self.telemetry.inc("fewnerd_request_failures_total", model=model_id, status=e.code().name)
+                    raise
+                latency = time.perf_counter() - start_time
+                status_code = post_model_outputs_response.status.code
+                if status_code == status_code_pb2.SUCCESS:
+                    output_text = post_model_outputs_response.outputs[0].data.text.raw
+                    self.telemetry.observe("fewnerd_request_latency_seconds", latency,
+                                           model=model_id, entity_class=entity_class)
+                    if self.hedging is not None:
+                        self.hedging.record_latency(latency)
+                    self.telemetry.inc("fewnerd_requests_total", model=model_id)
+                    self.telemetry.inc("fewnerd_prompt_chars_total", len(raw_text_ner), model=model_id)
+                    self.telemetry.inc("fewnerd_completion_chars_total", len(output_text), model=model_id)
+                    return output_text, index
+                status_name = status_code_pb2.StatusCode.Name(status_code)
+                if i == retries - 1:
+                    logging.error(post_model_outputs_response.status)
+                    self.telemetry.inc("fewnerd_request_failures_total", model=model_id, status=status_name)
+                    raise Exception("Post model outputs failed, status: " +
+                                    post_model_outputs_response.status.description)
+                self.telemetry.inc("fewnerd_request_retries_total", model=model_id, status=status_name)
+                logging.info(f"Prompt trial {i} failed. Sleeping for one minute.")
+                time.sleep(10)
+        finally:
+            self.telemetry.add_gauge("fewnerd_requests_in_flight", -1, model=model_id)
+
+    def submit(self, executor: Executor, model_id, raw_text_ner, index) -> Future:
+        """
+        Schedule a prediction on an executor, keeping track of how many requests are waiting for a worker.
+        If an identical request (same model and prompt) is already being processed, no new request is sent:
+        the output of the running one is returned with this request's index.
+
+        :param executor: executor to run the request on
+        :param model_id: model ID
+        :param raw_text_ner: prompt text
+        :param index: index returned together with the output (e.g. (episode_id, entity_class, query_id))
+        :return: future resolving to the same value as predict()
+        """
+        key = self._request_key(model_id, raw_text_ner)
+        with self._in_flight_lock:
+            cached_output = self.cache.get(key) if self.cache is not None else None
+            shared_future = self._in_flight.get(key) if cached_output is None else None
+            is_new_request = cached_output is None and shared_future is None
+            if is_new_request:
+                self.telemetry.add_gauge("fewnerd_requests_queued", 1, model=model_id)
+                shared_future = self._in_flight[key] = executor.submit(self._run, model_id, raw_text_ner, index)
+
+        if cached_output is not None:
+            self.telemetry.inc("fewnerd_cache_hits_total", model=model_id)
+            future = Future()
+            future.set_result((cached_output, index))
+            return future
+        if not is_new_request:
+            self.telemetry.inc("fewnerd_coalesced_requests_total", model=model_id)
+
+        # Every caller gets its own future, resolving to the shared output and its own index
+        future = Future()
+
+        def fan_out(finished_future):
+            if finished_future.cancelled():
+                future.cancel()
+            elif finished_future.exception() is not None:
+                future.set_exception(finished_future.exception())
+            else:
+                future.set_result((finished_future.result(), index))
+
+        shared_future.add_done_callback(fan_out)
+        return future
+
+    def _request_key(self, model_id, raw_text_ner) -> Tuple[str, str, str, str]:
+        # The same model ID can refer to different models in different apps
+        return self.user_id, self.app_id, model_id, raw_text_ner
+
+    def _run(self, model_id, raw_text_ner, index) -> str:
+        key = self._request_key(model_id, raw_text_ner)
+        self.telemetry.add_gauge("fewnerd_requests_queued", -1, model=model_id)
+        try:
+            output_text, _ = self.predict(model_id, raw_text_ner, index)
+            if self.cache is not None:
+                self.cache[key] = output_text
+            return output_text
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
@@ -0,0 +1,101 @@
+import zlib
+
+import numpy as np
+from scipy import sparse
+
+from typing import List, Sequence, Tuple
+
+
+class HashedNgramVectorizer:
+    """
+    Turn whitespace-tokenized sentences into L2-normalised sparse vectors of hashed word n-gram counts,
+    optionally weighted by inverse document frequency (TF-IDF).
+    N-grams are hashed with CRC32, so vectors are the same across processes and runs.
+    """
+
+    def __init__(self, ngram_range: Tuple[int, int] = (1, 2), n_features: int = 2 ** 18, use_idf: bool = True):
+        self.ngram_range = ngram_range
+        self.n_features = n_features
+        self.use_idf = use_idf
+        self.idf = None
+
+    def _feature_ids(self, text: str) -> List[int]:
+        tokens = text.lower().split()
+        feature_ids = []
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            for i in range(len(tokens) - n + 1):
+                ngram = " ".join(tokens[i:i + n])
+                feature_ids.append(zlib.crc32(ngram.encode("utf8")) % self.n_features)
+        return feature_ids
+
+    def _counts(self, texts: Sequence[str]) -> sparse.csr_matrix:
+        indptr, indices = [0], []
+        for text in texts:
+            indices.extend(self._feature_ids(text))
+            indptr.append(len(indices))
+        data = np.ones(len(indices), dtype=np.float32)
+        counts = sparse.csr_matrix((data, np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+                                   shape=(len(texts), self.n_features))
+        # Sum duplicate n-grams within a sentence
+        counts.sum_duplicates()
+        return counts
+
+    def fit(self, texts: Sequence[str]) -> "HashedNgramVectorizer":
+        """
+        Compute smoothed IDF weights from a collection of sentences.
+
+        :param texts: sentences (tokens separated by spaces)
+        :return: the fitted vectorizer
+        """
+        if self.use_idf:
+            counts = self._counts(texts)
+            document_frequency = np.bincount(counts.indices, minlength=self.n_features)
+            self.idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(np.float32)
+        return self
+
+    def transform(self, texts: Sequence[str]) -> sparse.csr_matrix:
+        """
+        Vectorize sentences.
+
+        :param texts: sentences (tokens separated by spaces)
+        :return: sparse matrix with one L2-normalised row per sentence
+        """
+        vectors = self._counts(texts)
+        if self.use_idf and self.idf is not None:
+            vectors = vectors.multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms).dot(vectors).tocsr()
+
+
+class DemonstrationRetriever:
+    """
+    Select the k most similar pool sentences (e.g. the support set of an episode) for each query sentence,
+    using cosine similarity of hashed n-gram vectors.
+    All queries are scored against the pool with a single sparse matrix product.
+    """
+
+    def __init__(self, k: int, vectorizer: HashedNgramVectorizer = None):
+        self.k = k
+        self.vectorizer = vectorizer if vectorizer is not None else HashedNgramVectorizer()
+
+    def select(self, pool_texts: Sequence[str], query_texts: Sequence[str]) -> List[List[int]]:
+        """
+        Find the most similar pool sentences for each query.
+        Indices are ordered from the least to the most similar sentence, so that the most similar demonstration
+        ends up closest to the query in the prompt; ties are broken by pool order.
+
+        :param pool_texts: candidate demonstration sentences (tokens separated by spaces)
+        :param query_texts: query sentences (tokens separated by spaces)
+        :return: list of pool indices for each query
+        """
+        if not pool_texts or not query_texts:
+            return [[] for _ in query_texts]
+        self.vectorizer.fit(pool_texts)
+        pool_vectors = self.vectorizer.transform(pool_texts)
+        query_vectors = self.vectorizer.transform(query_texts)
+        scores = (query_vectors @ pool_vectors.T).toarray()
+
+        # A stable sort by decreasing score keeps pool order among ties
+        ranking = np.argsort(-scores, axis=1, kind="stable")[:, :min(self.k, len(pool_texts))]
+        return [[int(i) for i in row[::-1]] for row in ranking]
@@ -0,0 +1,189 @@
+import heapq
+
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from prompt_building_utils import build_episode_prompts, make_output_example
+
+
+class LengthDistribution:
+    """
+    Streaming summary of prompt lengths in tokens: count, sum, min, max and a fixed-width histogram
+    used to approximate percentiles in constant memory.
+    """
+
+    def __init__(self, bucket_width: int = 32, n_buckets: int = 512):
+        self.bucket_width = bucket_width
+        self.buckets = [0] * (n_buckets + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, length: int) -> None:
+        self.count += 1
+        self.total += length
+        self.min = length if self.min is None else min(self.min, length)
+        self.max = length if self.max is None else max(self.max, length)
+        self.buckets[min(length // self.bucket_width, len(self.buckets) - 1)] += 1
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q: float) -> int:
+        """
+        Approximate percentile (upper bound of the histogram bucket containing it).
+
+        :param q: percentile between 0 and 100
+        :return: prompt length in tokens
+        """
+        if not self.count:
+            return 0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                # The last bucket has no upper bound
+                if i == len(self.buckets) - 1:
+                    return self.max
+                return min((i + 1) * self.bucket_width - 1, self.max)
+        return self.max
+
+
+class LatencyProfile:
+    """
+    Linear model of the latency of a single request:
+    base_seconds + seconds_per_input_token * input_tokens + seconds_per_output_token * output_tokens
+    """
+
+    def __init__(self, base_seconds: float, seconds_per_input_token: float, seconds_per_output_token: float):
+        self.base_seconds = base_seconds
+        self.seconds_per_input_token = seconds_per_input_token
+        self.seconds_per_output_token = seconds_per_output_token
+
+    def latency(self, input_tokens: int, output_tokens: int) -> float:
+        return (self.base_seconds + self.seconds_per_input_token * input_tokens
+                + self.seconds_per_output_token * output_tokens)
+
+
+def makespan(latencies: Iterable[float], concurrency: int) -> float:
+    """
+    Wall time of running requests with the given latencies on a pool of workers, in submission order.
+
+    :param latencies: request latencies in seconds
+    :param concurrency: number of workers
+    :return: time until the last request finishes
+    """
+    workers = [0.0] * concurrency
+    finish_time = 0.0
+    for latency in latencies:
+        start_time = heapq.heappop(workers)
+        finish_time = max(finish_time, start_time + latency)
+        heapq.heappush(workers, start_time + latency)
+    return finish_time
+
+
+def plan_run(episodes: Iterable[Tuple[int, object]], entity_classes: List[str], system_msg: str,
+             instr_messages: Dict[str, str], count_tokens: Callable[[str], int], max_tokens: int,
+             concurrency: int, latency_profile: LatencyProfile, retriever: Optional[object] = None,
+             packer: Optional[object] = None, absent_class_policy: str = "prompt") -> Dict:
+    """
+    Build every prompt of a run without calling the model and estimate its cost.
+    Episodes are processed one at a time, so memory use does not depend on the number of episodes.
+    Expected output tokens are estimated from the length of the correct output (capped at max_tokens),
+    the upper bound assumes every call generates max_tokens.
+
+    :param episodes: iterable of (episode_id, FewNerdEpisode) pairs
+    :param entity_classes: entity classes to prompt for
+    :param system_msg: system message
+    :param instr_messages: dictionary mapping entity classes to instruction messages
+    :param count_tokens: function counting tokens in a text
+    :param max_tokens: max number of tokens to generate per call
+    :param concurrency: number of concurrent requests
+    :param latency_profile: latency model used to estimate wall time
+    :param retriever: optional demonstration retriever, see build_episode_prompts
+    :param packer: optional PromptPacker, see build_episode_prompts
+    :param absent_class_policy: with "skip" or "fill", classes absent from an episode's types are not prompted for
+    :return: dictionary with the run estimates
+    """
+    lengths = {entity_class: LengthDistribution() for entity_class in entity_classes}
+    n_episodes, n_calls = 0, 0
+    input_tokens, expected_output_tokens = 0, 0
+    expected_wall_time, max_wall_time = 0.0, 0.0
+
+    for episode_id, episode in episodes:
+        n_episodes += 1
+        episode_classes = entity_classes
+        if absent_class_policy in ("skip", "fill"):
+            episode_classes = episode.present_classes(entity_classes)
+        prompts = build_episode_prompts(episode, episode_id, episode_classes, system_msg, instr_messages,
+                                        retriever, packer)
+        expected_latencies, max_latencies = [], []
+        # Correct outputs for each query, per class, to estimate the length of a well-behaved completion
+        # (build_episode_prompts only builds support output examples, so each is built once)
+        query_labels = episode.query_labels
+        output_lengths = {entity_class: [min(count_tokens(make_output_example(tokens, labels, entity_class)),
+                                             max_tokens)
+                                         for tokens, labels in zip(episode.query_tokens, query_labels)]
+                          for entity_class in episode_classes}
+
+        for prompt, (_, entity_class, query_id) in prompts:
+            prompt_tokens = count_tokens(prompt)
+            output_tokens = output_lengths[entity_class][query_id]
+            lengths[entity_class].add(prompt_tokens)
+            n_calls += 1
+            input_tokens += prompt_tokens
+            expected_output_tokens += output_tokens
+            expected_latencies.append(latency_profile.latency(prompt_tokens, output_tokens))
+            max_latencies.append(latency_profile.latency(prompt_tokens, max_tokens))
+
+        # prompt_llm.py waits for all requests of an episode before starting the next one
+        expected_wall_time += makespan(expected_latencies, concurrency)
+        max_wall_time += makespan(max_latencies, concurrency)
+
+    return {
+        "episodes": n_episodes,
+        "calls": n_calls,
+        "input_tokens": input_tokens,
+        "expected_output_tokens": expected_output_tokens,
+        "max_output_tokens": n_calls * max_tokens,
+        "expected_wall_time_seconds": expected_wall_time,
+        "max_wall_time_seconds": max_wall_time,
+        "prompt_tokens_per_class": {
+            entity_class: {
+                "count": distribution.count,
+                "mean": distribution.mean(),
+                "min": distribution.min,
+                "p50": distribution.percentile(50),
+                "p90": distribution.percentile(90),
+                "p99": distribution.percentile(99),
+                "max": distribution.max,
+            }
+            for entity_class, distribution in lengths.items()
+        }
+    }
+
+
+def format_plan(plan: Dict, round_to: Optional[int] = 1) -> str:
+    """
+    Format a run plan as a human-readable report.
+
+    :param plan: dictionary returned by plan_run
+    :param round_to: decimal places for means and times
+    :return: report string
+    """
+    lines = [
+        f"Episodes: {plan['episodes']}",
+        f"Calls: {plan['calls']}",
+        f"Input tokens: {plan['input_tokens']}",
+        f"Output tokens: {plan['expected_output_tokens']} expected, {plan['max_output_tokens']} max",
+        f"Wall time (s): {round(plan['expected_wall_time_seconds'], round_to)} expected, "
+        f"{round(plan['max_wall_time_seconds'], round_to)} max",
+        "",
+        f"{'class':>20} {'count':>8} {'mean':>8} {'min':>6} {'p50':>6} {'p90':>6} {'p99':>6} {'max':>6}",
+    ]
+    for entity_class, stats in plan["prompt_tokens_per_class"].items():
+        lines.append(f"{entity_class:>20} {stats['count']:>8} {round(stats['mean'], round_to):>8} "
+                     f"{str(stats['min']):>6} {stats['p50']:>6} {stats['p90']:>6} {stats['p99']:>6} "
+                     f"{str(stats['max']):>6}")
+    return "\n".join(lines)
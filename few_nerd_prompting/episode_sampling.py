@@ -0,0 +1,139 @@
+import random
+
+import numpy as np
+
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+# Bootstrap resampling is done within strata; strata with fewer sampled episodes than this are pooled together
+MIN_STRATUM_EPISODES = 2
+
+
+def stratum_key(types: Sequence[str], n_query: int) -> Tuple[Tuple[str, ...], int]:
+    """
+    Stratum of an episode: the set of coarse-grained classes among its types and the size of its query set.
+
+    :param types: fine-grained entity types of the episode, e.g. ["art-music", "location-GPE"]
+    :param n_query: number of query sentences
+    :return: stratum key
+    """
+    return tuple(sorted({entity_type.split("-")[0] for entity_type in types})), n_query
+
+
+def read_strata(episode_dicts: Iterable[Dict]) -> Dict[Hashable, List[int]]:
+    """
+    Group the episodes of a Few-NERD episode file by stratum (see stratum_key).
+
+    :param episode_dicts: episodes of the file as parsed JSON, in file order
+    :return: dictionary mapping strata to episode IDs (0-based)
+    """
+    strata = {}
+    for episode_id, episode in enumerate(episode_dicts):
+        strata.setdefault(stratum_key(episode.get("types", []), len(episode["query"]["word"])),
+                          []).append(episode_id)
+    return strata
+
+
+def stratified_order(strata: Dict[Hashable, List[int]], seed: Optional[int] = None) -> List[int]:
+    """
+    Order all episodes randomly so that every prefix of the order is a stratified sample:
+    each stratum is shuffled and its episodes are spread evenly over the order, in proportion to its size.
+
+    :param strata: dictionary mapping strata to episode IDs
+    :param seed: random seed
+    :return: episode IDs in sampling order
+    """
+    rng = random.Random(seed)
+    positions = []
+    for episode_ids in strata.values():
+        episode_ids = list(episode_ids)
+        rng.shuffle(episode_ids)
+        start = rng.random()
+        positions.extend(((i + start) / len(episode_ids), rng.random(), episode_id)
+                         for i, episode_id in enumerate(episode_ids))
+    return [episode_id for _, _, episode_id in sorted(positions)]
+
+
+def f1_from_counts(counts: np.ndarray) -> np.ndarray:
+    """
+    Calculate F1-scores from arrays of entity counts.
+
+    :param counts: array with true positive, false positive and false negative counts in the last dimension
+    :return: array of F1-scores (0 where there are no true or predicted entities)
+    """
+    tp, fp, fn = counts[..., 0], counts[..., 1], counts[..., 2]
+    denominator = 2 * tp + fp + fn
+    return np.where(denominator > 0, 2 * tp / np.maximum(denominator, 1), 0.0)
+
+
+class StratifiedF1Estimate:
+    """
+    Running estimate of per-class, micro and macro F1-scores from a stratified sample of episodes,
+    with stratified bootstrap confidence intervals.
+    """
+
+    def __init__(self, entity_classes: List[str], confidence: float = 0.95, n_resamples: int = 1000,
+                 seed: Optional[int] = None):
+        self.entity_classes = entity_classes
+        self.confidence = confidence
+        self.n_resamples = n_resamples
+        self.seed = seed
+        self._counts = []
+        self._strata = {}
+
+    @property
+    def n_episodes(self) -> int:
+        return len(self._counts)
+
+    def add_episode(self, stratum: Hashable, counts: Sequence[Sequence[int]]) -> None:
+        """
+        Add the entity counts of one episode.
+
+        :param stratum: stratum of the episode, see stratum_key
+        :param counts: [tp, fp, fn] for each entity class, in the order of entity_classes
+        """
+        self._strata.setdefault(stratum, []).append(len(self._counts))
+        self._counts.append(counts)
+
+    def intervals(self) -> Dict[str, Tuple[float, float, float]]:
+        """
+        Estimate F1-scores and their confidence intervals.
+
+        :return: dictionary mapping entity classes, "micro" and "macro" to (estimate, lower bound, upper bound)
+        """
+        counts = np.asarray(self._counts, dtype=np.float64).reshape(self.n_episodes, len(self.entity_classes), 3)
+        rng = np.random.default_rng(self.seed)
+
+        # Each bootstrap sample draws as many episodes from each stratum as were sampled from it
+        groups = [rows for rows in self._strata.values() if len(rows) >= MIN_STRATUM_EPISODES]
+        small_strata = [row for rows in self._strata.values() if len(rows) < MIN_STRATUM_EPISODES for row in rows]
+        if small_strata:
+            groups.append(small_strata)
+        weights = np.zeros((self.n_resamples, self.n_episodes))
+        for rows in groups:
+            weights[:, rows] = rng.multinomial(len(rows), [1 / len(rows)] * len(rows), size=self.n_resamples)
+        resampled = (weights @ counts.reshape(self.n_episodes, -1)).reshape(self.n_resamples, -1, 3)
+
+        total = counts.sum(axis=0)
+        estimates = {entity_class: (f1_from_counts(total[i]), f1_from_counts(resampled[:, i]))
+                     for i, entity_class in enumerate(self.entity_classes)}
+        estimates["micro"] = (f1_from_counts(total.sum(axis=0)), f1_from_counts(resampled.sum(axis=1)))
+        estimates["macro"] = (f1_from_counts(total).mean(), f1_from_counts(resampled).mean(axis=1))
+
+        alpha = (1 - self.confidence) / 2
+        return {name: (float(estimate), float(np.quantile(samples, alpha)), float(np.quantile(samples, 1 - alpha)))
+                for name, (estimate, samples) in estimates.items()}
+
+    def report(self, round_to: int, intervals: Optional[Dict[str, Tuple[float, float, float]]] = None) -> str:
+        """
+        Build a table of F1-scores with confidence intervals.
+
+        :param round_to: max decimal places for scores
+        :param intervals: already computed intervals (computed if not given)
+        :return: table as a string
+        """
+        intervals = intervals if intervals is not None else self.intervals()
+        width = max(len(name) for name in intervals)
+        lines = [f"{'':>{width}} {'f1-score':>9} {f'{self.confidence:.0%} interval':>{2 * round_to + 10}}", ""]
+        for name, (estimate, low, high) in intervals.items():
+            lines.append(f"{name:>{width}} {estimate:>9.{round_to}f}   [{low:.{round_to}f}, {high:.{round_to}f}]")
+        return "\n".join(lines)
@@ -1,12 +1,21 @@
+import os
+import csv
+import time
 import argparse
 import json
 import logging
-from typing import List, Dict, Optional
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, FrozenSet, Optional, Tuple
 
 from seqeval.metrics import accuracy_score, precision_score, recall_score, f1_score
 from seqeval.metrics import classification_report
+from seqeval.metrics.sequence_labeling import get_entities
 
-from read_few_nerd import FewNerdEpisodesSet
+from io_utils import is_compressed, loads, open_text
+from read_few_nerd import FewNerdEpisode, FewNerdEpisodesSet, load_full_labels
+from episode_sampling import StratifiedF1Estimate, stratum_key
+from profiling import StageProfiler
 
 logging.basicConfig(format="{asctime} {levelname}: {message}",
                     style="{", level=logging.INFO)
@@ -60,8 +69,24 @@ def labels_to_iob(labels: List[str]) -> List[str]:
     return result
 
 
+def episode_true_labels(episode: FewNerdEpisode, entity_class: str, coarse_grained: bool = True) -> List[List[str]]:
+    """
+    Get ground truth labels of the query set of an episode, taking into account only one entity type.
+
+    :param episode: FewNerdEpisode object
+    :param entity_class: entity class to keep (all others will be replaced with "O")
+    :param coarse_grained: if true, use coarse-grained classes
+    :return: token labels for each sentence of the query set
+    """
+    if coarse_grained:
+        return [labels_to_iob(single_class(coarse_grained_from_fine_grained(query), entity_class))
+                for query in episode.query_labels]
+    return episode.query_labels
+
+
 def get_true_labels(filename: str, entity_class: str, full_labels_path: Optional[str], pred_ids: List[int] = None,
-                    coarse_grained: bool = True, full_labels: bool = False) -> Dict[int, List[List[str]]]:
+                    coarse_grained: bool = True, full_labels: bool = False,
+                    full_labels_dict: Optional[Dict[str, array]] = None) -> Dict[int, List[List[str]]]:
     """
     Get ground truth labels from a Few-NERD episode data file, taking into account only one entity type.
 
@@ -71,22 +96,17 @@ def get_true_labels(filename: str, entity_class: str, full_labels_path: Optional
     :param pred_ids: IDs of episodes for which predictions are present (in case some predictions are missing)
     :param coarse_grained: if true, use coarse-grained classes
     :param full_labels: use full labels from the supervised task
+    :param full_labels_dict: already loaded labels from the supervised task (loaded from full_labels_path if not given)
     :return: dictionary mapping episode IDs to token labels for each sentence of the query set
     """
-    all_episodes = FewNerdEpisodesSet(filename=filename, full_labels_path=full_labels_path, full_labels=full_labels)
+    all_episodes = FewNerdEpisodesSet(filename=filename, full_labels_path=full_labels_path, full_labels=full_labels,
+                                      full_labels_dict=full_labels_dict)
     all_true_labels = {}
 
     episode_id = 0
     for episode in all_episodes.episodes:
         if episode_id in pred_ids:
-            all_true_labels[episode_id] = []
-            episode.gpt_ner_examples_from_episode(entity_class)
-            if coarse_grained:
-                all_true_labels[episode_id].extend([labels_to_iob(single_class(coarse_grained_from_fine_grained(query),
-                                                                               entity_class))
-                                                    for query in episode.query_labels])
-            else:
-                all_true_labels[episode_id].extend(episode.query_labels)
+            all_true_labels[episode_id] = episode_true_labels(episode, entity_class, coarse_grained)
 
         episode_id += 1
 
@@ -96,23 +116,66 @@ def get_true_labels(filename: str, entity_class: str, full_labels_path: Optional
 def read_predicted_labels_single_class(filename: str, entity_class: str) -> Dict[int, List[List[str]]]:
     """
     Get predicted labels from a file generated with prompt_llm.py, taking into account only one entity type.
+    Episodes where the class was skipped (see prompt_llm.py --absent_class_policy) are left out.
 
     :param filename: path to file containing predictions
     :param entity_class: entity class to keep (all others will be replaced with "O")
     :return: dictionary mapping episode IDs to predicted token labels for each sentence of the query set
     """
     all_predicted_labels = {}
-    with open(filename, 'r', encoding="utf8") as fh:
-        for line in fh.readlines():
-            prediction = json.loads(line.strip())
+    with open_text(filename) as fh:
+        for line in fh:
+            prediction = loads(line)
             episode_id = list(prediction.keys())[0]
+            if entity_class in prediction[episode_id].get("skipped", []):
+                continue
             all_predicted_labels.setdefault(int(episode_id),
                                             [labels_to_iob(p) for p in prediction[episode_id]['label'][entity_class]])
     return all_predicted_labels
 
 
+def class_true_and_pred(entity_class: str, pred_file: str, true_file: str, full_labels: bool,
+                        full_labels_path: Optional[str], full_labels_dict: Optional[Dict[str, array]] = None,
+                        profiler: Optional[StageProfiler] = None) -> Tuple[List[List[str]], List[List[str]]]:
+    """
+    Get true and predicted IOB labels for a single entity class, for all query sentences of the predicted episodes.
+
+    :param entity_class: entity class to keep (all others will be replaced with "O")
+    :param pred_file: path to file containing model predictions (generated by prompt_llm.py)
+    :param true_file: path to Few-NERD episode data file with ground truth labels
+    :param full_labels: use full labels from the supervised task
+    :param full_labels_path: path to files containing labels from the supervised task
+    :param full_labels_dict: already loaded labels from the supervised task
+    :param profiler: optional profiler measuring the "read_predictions" and "read_episodes" stages
+    :return: lists of true and predicted token labels for each sentence
+    """
+    profiler = profiler if profiler is not None else StageProfiler()
+    with profiler.stage("read_predictions"):
+        pred_labels = read_predicted_labels_single_class(pred_file, entity_class)
+    with profiler.stage("read_episodes"):
+        true_labels = get_true_labels(filename=true_file, entity_class=entity_class,
+                                      full_labels_path=full_labels_path,
+                                      pred_ids=[key for key, value in sorted(pred_labels.items())],
+                                      full_labels=full_labels, full_labels_dict=full_labels_dict)
+
+    # Transform predicted and true labels from dicts into lists
+    sorted_true_list = [value for key, value in sorted(true_labels.items())]
+    sorted_pred_list = [value for key, value in sorted(pred_labels.items())]
+    true_flattened = [item for sublist in sorted_true_list for item in sublist]
+    pred_flattened = [item for sublist in sorted_pred_list for item in sublist]
+
+    # Temporary fix: fill the labels that errored out with O's
+    for i in range(len(true_flattened)):
+        if not pred_flattened[i]:
+            pred_flattened[i] = ["O"] * len(true_flattened[i])
+
+    return true_flattened, pred_flattened
+
+
 def build_report(entity_classes: List[str], pred_file: str, true_file: str, round_to: int,
-                 full_labels: bool, full_labels_path: Optional[str]) -> str:
+                 full_labels: bool, full_labels_path: Optional[str],
+                 full_labels_dict: Optional[Dict[str, array]] = None,
+                 profiler: Optional[StageProfiler] = None) -> str:
     """
     Iterate over all required entity classes and build a table of metrics x entity classes
     (showing precision, recall, F1-score, and support for each class).
@@ -123,28 +186,19 @@ def build_report(entity_classes: List[str], pred_file: str, true_file: str, roun
     :param round_to: max decimal places for metrics
     :param full_labels: use full labels from the supervised task
     :param full_labels_path: path to files containing labels from the supervised task
+    :param full_labels_dict: already loaded labels from the supervised task
+    :param profiler: optional profiler measuring reading and metric computation stages
     :return: string showing a table of metrics x entity classes
     """
+    profiler = profiler if profiler is not None else StageProfiler()
     result = ""
 
     for entity_class in entity_classes:
-        pred_labels = read_predicted_labels_single_class(pred_file, entity_class)
-        true_labels = get_true_labels(filename=true_file, entity_class=entity_class, full_labels_path=full_labels_path,
-                                      pred_ids=[key for key, value in sorted(pred_labels.items())],
-                                      full_labels=full_labels)
-
-        # Transform predicted and true labels from dicts into lists
-        sorted_true_list = [value for key, value in sorted(true_labels.items())]
-        sorted_pred_list = [value for key, value in sorted(pred_labels.items())]
-        true_flattened = [item for sublist in sorted_true_list for item in sublist]
-        pred_flattened = [item for sublist in sorted_pred_list for item in sublist]
+        true_flattened, pred_flattened = class_true_and_pred(entity_class, pred_file, true_file, full_labels,
+                                                             full_labels_path, full_labels_dict, profiler)
 
-        # Temporary fix: fill the labels that errored out with O's
-        for i in range(len(true_flattened)):
-            if not pred_flattened[i]:
-                pred_flattened[i] = ["O"] * len(true_flattened[i])
-
-        class_report = report(true_flattened, pred_flattened, round_to)
+        with profiler.stage("metrics"):
+            class_report = report(true_flattened, pred_flattened, round_to)
 
         if not result:
             result += class_report.split("\n")[0]
@@ -156,6 +210,31 @@ def build_report(entity_classes: List[str], pred_file: str, true_file: str, roun
     return result
 
 
+def score_classes(entity_classes: List[str], pred_file: str, true_file: str, full_labels: bool,
+                  full_labels_path: Optional[str],
+                  full_labels_dict: Optional[Dict[str, array]] = None) -> Dict[str, Dict[str, float]]:
+    """
+    Calculate precision, recall, F1-score and support (number of true entities) for each entity class.
+
+    :param entity_classes: all entity classes to calculate scores for
+    :param pred_file: path to file containing model predictions (generated by prompt_llm.py)
+    :param true_file: path to Few-NERD episode data file with ground truth labels
+    :param full_labels: use full labels from the supervised task
+    :param full_labels_path: path to files containing labels from the supervised task
+    :param full_labels_dict: already loaded labels from the supervised task
+    :return: dictionary mapping entity classes to their scores
+    """
+    scores = {}
+    for entity_class in entity_classes:
+        true_flattened, pred_flattened = class_true_and_pred(entity_class, pred_file, true_file, full_labels,
+                                                             full_labels_path, full_labels_dict)
+        scores[entity_class] = {"precision": precision_score(true_flattened, pred_flattened),
+                                "recall": recall_score(true_flattened, pred_flattened),
+                                "f1": f1_score(true_flattened, pred_flattened),
+                                "support": len(get_entities(true_flattened))}
+    return scores
+
+
 def report(y_true: List[List[str]], y_pred: List[List[str]], round_to) -> str:
     """
     Create a classification report using seqeval.
@@ -169,11 +248,413 @@ def report(y_true: List[List[str]], y_pred: List[List[str]], round_to) -> str:
     return classification_report(y_true, y_pred, digits=round_to)
 
 
+def scores_from_counts(tp: int, fp: int, fn: int) -> Dict[str, float]:
+    """
+    Calculate precision, recall and F1-score from entity counts.
+
+    :param tp: number of true positive entities
+    :param fp: number of false positive entities
+    :param fn: number of false negative entities
+    :return: dictionary with precision, recall, F1-score and support (number of true entities)
+    """
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1, "support": tp + fn}
+
+
+def count_entity_matches(y_true: List[List[str]], y_pred: List[List[str]]) -> Tuple[int, int, int]:
+    """
+    Count true positive, false positive and false negative entities, matching entities as seqeval does.
+
+    :param y_true: true labels (IOB) for each sentence
+    :param y_pred: predicted labels (IOB) for each sentence
+    :return: numbers of true positives, false positives and false negatives
+    """
+    tp, fp, fn = 0, 0, 0
+    for true_sentence, pred_sentence in zip(y_true, y_pred):
+        true_entities = set(get_entities(true_sentence))
+        pred_entities = set(get_entities(pred_sentence))
+        matched = len(true_entities & pred_entities)
+        tp += matched
+        fp += len(pred_entities) - matched
+        fn += len(true_entities) - matched
+    return tp, fp, fn
+
+
+def episode_counts(episode: FewNerdEpisode, prediction: Dict, entity_classes: List[str],
+                   coarse_grained: bool = True) -> List[Tuple[int, int, int]]:
+    """
+    Count true positive, false positive and false negative entities of one predicted episode, for each class.
+
+    :param episode: ground truth FewNerdEpisode object
+    :param prediction: predictions for the episode, as written by prompt_llm.py ({"text": ..., "label": ...})
+    :param entity_classes: entity classes to count entities for
+    :param coarse_grained: if true, use coarse-grained classes
+    :return: (tp, fp, fn) for each entity class (all 0 for skipped classes)
+    """
+    counts = []
+    for entity_class in entity_classes:
+        if entity_class in prediction.get("skipped", []):
+            counts.append((0, 0, 0))
+            continue
+        true_labels = episode_true_labels(episode, entity_class, coarse_grained)
+        # Fill the labels that errored out with O's, as in build_report
+        pred_labels = [labels_to_iob(pred) if pred else ["O"] * len(true)
+                       for pred, true in zip(prediction["label"][entity_class], true_labels)]
+        counts.append(count_entity_matches(true_labels, pred_labels))
+    return counts
+
+
+class IncrementalScores:
+    """
+    Per-class counts of true positive, false positive and false negative entities,
+    updated one predicted episode at a time.
+    """
+
+    def __init__(self, entity_classes: List[str]):
+        self.entity_classes = entity_classes
+        self.counts = {entity_class: [0, 0, 0] for entity_class in entity_classes}
+        self.n_episodes = 0
+
+    def add_episode(self, episode: FewNerdEpisode, prediction: Dict, coarse_grained: bool = True) -> None:
+        """
+        Add the predictions for one episode.
+
+        :param episode: ground truth FewNerdEpisode object
+        :param prediction: predictions for the episode, as written by prompt_llm.py ({"text": ..., "label": ...})
+        :param coarse_grained: if true, use coarse-grained classes
+        """
+        for entity_class, class_counts in zip(self.entity_classes,
+                                              episode_counts(episode, prediction, self.entity_classes, coarse_grained)):
+            for i, count in enumerate(class_counts):
+                self.counts[entity_class][i] += count
+        self.n_episodes += 1
+
+    def scores(self, entity_class: str) -> Dict[str, float]:
+        return scores_from_counts(*self.counts[entity_class])
+
+    def report(self, round_to: int) -> str:
+        """
+        Build a table of metrics x entity classes in the same layout as build_report.
+
+        :param round_to: max decimal places for metrics
+        :return: string showing a table of metrics x entity classes
+        """
+        width = max(len(entity_class) for entity_class in self.entity_classes)
+        lines = [f"{'':>{width}} {'precision':>9} {'recall':>9} {'f1-score':>9} {'support':>9}", ""]
+        for entity_class in self.entity_classes:
+            scores = self.scores(entity_class)
+            lines.append(f"{entity_class:>{width}} {scores['precision']:>9.{round_to}f} {scores['recall']:>9.{round_to}f} "
+                         f"{scores['f1']:>9.{round_to}f} {scores['support']:>9}")
+        return "\n".join(lines)
+
+
+def entity_spans(labels: List[str]) -> FrozenSet[Tuple[int, int]]:
+    """
+    Find the (start, end) token positions of all entities in a sentence, as seqeval does.
+
+    :param labels: token labels in IOB format
+    :return: set of entity spans
+    """
+    return frozenset((start, end) for _, start, end in get_entities(labels))
+
+
+def encode_ground_truth(true_file: str, entity_classes: List[str], full_labels: bool,
+                        full_labels_path: Optional[str], full_labels_dict: Optional[Dict[str, array]] = None
+                        ) -> Dict[int, Dict[str, List[FrozenSet[Tuple[int, int]]]]]:
+    """
+    Read a Few-NERD episode file once and keep only the true entity spans of each query sentence, for every class.
+    The result is small and can be shared between processes scoring different prediction files.
+
+    :param true_file: path to Few-NERD episode data file with ground truth labels
+    :param entity_classes: entity classes to calculate scores for
+    :param full_labels: use full labels from the supervised task
+    :param full_labels_path: path to files containing labels from the supervised task
+    :param full_labels_dict: already loaded labels from the supervised task
+    :return: dictionary mapping episode IDs to entity classes to entity spans for each query sentence
+    """
+    episodes_set = FewNerdEpisodesSet(filename=true_file, full_labels_path=full_labels_path, full_labels=full_labels,
+                                      full_labels_dict=full_labels_dict)
+    return {episode_id: {entity_class: [entity_spans(labels) for labels in episode_true_labels(episode, entity_class)]
+                         for entity_class in entity_classes}
+            for episode_id, episode in enumerate(episodes_set.episodes)}
+
+
+def count_file_matches(pred_file: str, ground_truth: Dict[int, Dict[str, List[FrozenSet[Tuple[int, int]]]]],
+                       entity_classes: List[str]) -> Tuple[int, Dict[str, List[int]]]:
+    """
+    Count true positive, false positive and false negative entities of a prediction file, for each class.
+    Only the episodes present in the prediction file are scored; predictions that errored out count as all "O",
+    skipped classes are left out.
+
+    :param pred_file: path to file containing model predictions (generated by prompt_llm.py)
+    :param ground_truth: true entity spans, see encode_ground_truth
+    :param entity_classes: entity classes to calculate scores for
+    :return: number of scored episodes and dictionary mapping entity classes to [tp, fp, fn]
+    """
+    counts = {entity_class: [0, 0, 0] for entity_class in entity_classes}
+    seen_episodes = set()
+    with open_text(pred_file) as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            prediction = loads(line)
+            episode_id = list(prediction.keys())[0]
+            # As in read_predicted_labels_single_class, the first prediction for an episode is used
+            if int(episode_id) in seen_episodes:
+                continue
+            seen_episodes.add(int(episode_id))
+            if int(episode_id) not in ground_truth:
+                raise Exception(f"Episode {episode_id} of {pred_file} is not in the ground truth file")
+            for entity_class in entity_classes:
+                if entity_class in prediction[episode_id].get("skipped", []):
+                    continue
+                for pred, true_spans in zip(prediction[episode_id]["label"][entity_class],
+                                            ground_truth[int(episode_id)][entity_class]):
+                    pred_spans = entity_spans(labels_to_iob(pred)) if pred else frozenset()
+                    matched = len(true_spans & pred_spans)
+                    counts[entity_class][0] += matched
+                    counts[entity_class][1] += len(pred_spans) - matched
+                    counts[entity_class][2] += len(true_spans) - matched
+    return len(seen_episodes), counts
+
+
+# Ground truth of a scoring worker process, set once by _init_scoring_worker
+_worker_ground_truth = None
+
+
+def _init_scoring_worker(ground_truth: Dict[int, Dict[str, List[FrozenSet[Tuple[int, int]]]]]) -> None:
+    global _worker_ground_truth
+    _worker_ground_truth = ground_truth
+
+
+def _count_file_matches_in_worker(pred_file: str, entity_classes: List[str]) -> Tuple[int, Dict[str, List[int]]]:
+    return count_file_matches(pred_file, _worker_ground_truth, entity_classes)
+
+
+def build_leaderboard(pred_files: List[str], ground_truth: Dict[int, Dict[str, List[FrozenSet[Tuple[int, int]]]]],
+                      entity_classes: List[str], n_processes: Optional[int] = None) -> List[Dict]:
+    """
+    Score several prediction files against the same ground truth, in parallel processes.
+    The ground truth is sent to each process once, when it starts.
+
+    :param pred_files: paths to files containing model predictions (generated by prompt_llm.py)
+    :param ground_truth: true entity spans, see encode_ground_truth
+    :param entity_classes: entity classes to calculate scores for
+    :param n_processes: number of processes (number of CPUs by default); files are scored in this process if 1
+    :return: one row per prediction file with the F1-score for each class and the micro and macro averages,
+             sorted by micro F1-score, best first
+    """
+    if n_processes == 1 or len(pred_files) == 1:
+        all_counts = [count_file_matches(pred_file, ground_truth, entity_classes) for pred_file in pred_files]
+    else:
+        with ProcessPoolExecutor(max_workers=n_processes, initializer=_init_scoring_worker,
+                                 initargs=(ground_truth,)) as pool:
+            all_counts = list(pool.map(_count_file_matches_in_worker, pred_files,
+                                       [entity_classes] * len(pred_files)))
+
+    rows = []
+    for pred_file, (n_episodes, counts) in zip(pred_files, all_counts):
+        row = {"pred_file": pred_file, "episodes": n_episodes}
+        for entity_class in entity_classes:
+            row[entity_class] = scores_from_counts(*counts[entity_class])["f1"]
+        row["micro_f1"] = scores_from_counts(*[sum(counts[entity_class][i] for entity_class in entity_classes)
+                                               for i in range(3)])["f1"]
+        row["macro_f1"] = sum(row[entity_class] for entity_class in entity_classes) / len(entity_classes)
+        rows.append(row)
+    return sorted(rows, key=lambda row: -row["micro_f1"])
+
+
+def format_leaderboard(rows: List[Dict], entity_classes: List[str], round_to: int) -> str:
+    """
+    Format a leaderboard as a table of prediction files x F1-scores.
+
+    :param rows: rows returned by build_leaderboard
+    :param entity_classes: entity classes
+    :param round_to: max decimal places for scores
+    :return: table as a string
+    """
+    columns = entity_classes + ["micro_f1", "macro_f1"]
+    name_width = max(len(row["pred_file"]) for row in rows)
+    lines = [f"{'':<{name_width}} " + " ".join(f"{column:>10}" for column in columns)]
+    for row in rows:
+        lines.append(f"{row['pred_file']:<{name_width}} "
+                     + " ".join(f"{row[column]:>10.{round_to}f}" for column in columns))
+    return "\n".join(lines)
+
+
+def write_leaderboard(rows: List[Dict], path: str) -> None:
+    """
+    Write a leaderboard as JSON if the path ends with .json, as CSV otherwise.
+
+    :param rows: rows returned by build_leaderboard
+    :param path: output file path
+    """
+    with open(path, 'w', encoding='utf8', newline='') as fh:
+        if path.endswith(".json"):
+            json.dump(rows, fh, indent=1)
+        else:
+            writer = csv.DictWriter(fh, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def confidence_interval_report(entity_classes: List[str], pred_file: str, true_file: str, round_to: int,
+                               full_labels: bool, full_labels_path: Optional[str],
+                               full_labels_dict: Optional[Dict[str, array]] = None, confidence: float = 0.95,
+                               n_resamples: int = 1000, seed: Optional[int] = None) -> str:
+    """
+    Estimate F1-scores with stratified bootstrap confidence intervals, treating the predicted episodes
+    (e.g. from prompt_llm.py --sample) as a stratified sample of the episode file (see episode_sampling.stratum_key).
+
+    :param entity_classes: all entity classes to calculate scores for
+    :param pred_file: path to file containing model predictions (generated by prompt_llm.py)
+    :param true_file: path to Few-NERD episode data file with ground truth labels
+    :param round_to: max decimal places for metrics
+    :param full_labels: use full labels from the supervised task
+    :param full_labels_path: path to files containing labels from the supervised task
+    :param full_labels_dict: already loaded labels from the supervised task
+    :param confidence: confidence level of the intervals
+    :param n_resamples: number of bootstrap samples
+    :param seed: random seed for bootstrap sampling
+    :return: table of F1-scores and confidence intervals per class, with micro and macro averages
+    """
+    episodes_set = FewNerdEpisodesSet(filename=true_file, full_labels_path=full_labels_path, full_labels=full_labels,
+                                      full_labels_dict=full_labels_dict)
+    offsets = episodes_set.episode_offsets()
+    estimate = StratifiedF1Estimate(entity_classes, confidence=confidence, n_resamples=n_resamples, seed=seed)
+    seen_episodes = set()
+    with open_text(pred_file) as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            prediction = loads(line)
+            episode_id = list(prediction.keys())[0]
+            if int(episode_id) in seen_episodes:
+                continue
+            seen_episodes.add(int(episode_id))
+            episode = episodes_set.read_episode(offsets[int(episode_id)])
+            estimate.add_episode(stratum_key(episode.types, len(episode.query_tokens)),
+                                 episode_counts(episode, prediction[episode_id], entity_classes))
+    return f"{estimate.n_episodes} episodes\n{estimate.report(round_to)}"
+
+
+def follow_predictions(entity_classes: List[str], pred_file: str, true_file: str, round_to: int,
+                       full_labels: bool, full_labels_path: Optional[str], interval: float,
+                       idle_timeout: Optional[float]) -> IncrementalScores:
+    """
+    Evaluate a prediction file while it is being written by prompt_llm.py.
+    Only newly appended episodes are read; their ground truth is looked up by episode ID.
+    Scores are logged every `interval` seconds if new episodes were added.
+
+    :param entity_classes: all entity classes to calculate scores for
+    :param pred_file: path to file containing model predictions (generated by prompt_llm.py)
+    :param true_file: path to Few-NERD episode data file with ground truth labels
+    :param round_to: max decimal places for metrics
+    :param full_labels: use full labels from the supervised task
+    :param full_labels_path: path to files containing labels from the supervised task
+    :param interval: seconds between score updates
+    :param idle_timeout: stop after this many seconds without new predictions (never stop if None)
+    :return: final scores
+    """
+    if is_compressed(pred_file):
+        raise Exception(f"--follow only works with uncompressed prediction files, as a compressed file "
+                        f"cannot be read while it is written: {pred_file}")
+    episodes_set = FewNerdEpisodesSet(filename=true_file, full_labels_path=full_labels_path, full_labels=full_labels)
+    offsets = episodes_set.episode_offsets()
+    scores = IncrementalScores(entity_classes)
+
+    while not os.path.exists(pred_file):
+        time.sleep(interval)
+
+    last_data_time = last_report_time = time.monotonic()
+    updated = False
+    partial_line = ""
+    try:
+        with open(pred_file, 'r', encoding='utf8') as fh:
+            while True:
+                chunk = fh.read()
+                now = time.monotonic()
+                if chunk:
+                    last_data_time = now
+                    lines = (partial_line + chunk).split("\n")
+                    # The last line may still be incomplete
+                    partial_line = lines.pop()
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        prediction = loads(line)
+                        episode_id = list(prediction.keys())[0]
+                        scores.add_episode(episodes_set.read_episode(offsets[int(episode_id)]), prediction[episode_id])
+                        updated = True
+                if updated and now - last_report_time >= interval:
+                    logging.info(f"Scores after {scores.n_episodes} episodes:\n{scores.report(round_to)}")
+                    last_report_time, updated = now, False
+                if idle_timeout is not None and now - last_data_time > idle_timeout:
+                    break
+                if not chunk:
+                    # prompt_llm.py replaces the file when it merges deferred prompts (--absent_class_policy defer);
+                    # the open file would never change again
+                    if os.stat(pred_file).st_ino != os.fstat(fh.fileno()).st_ino:
+                        logging.warning(f"{pred_file} was replaced, stopping; "
+                                        f"evaluate the new file without --follow for the final scores")
+                        break
+                    time.sleep(min(interval, 1.0))
+    except KeyboardInterrupt:
+        pass
+
+    logging.info(f"Final scores after {scores.n_episodes} episodes:\n{scores.report(round_to)}")
+    return scores
+
+
 def main(args):
-    scores = build_report(entity_classes=args.entity_classes, pred_file=args.pred_file,
+    profiler = StageProfiler(args.profile)
+    if args.follow:
+        if len(args.pred_file) > 1:
+            raise Exception("--follow works with a single prediction file")
+        follow_predictions(entity_classes=args.entity_classes, pred_file=args.pred_file[0],
+                           true_file=args.few_nerd_file, round_to=args.decimal_places,
+                           full_labels=args.full_labels, full_labels_path=args.full_labels_data_path,
+                           interval=args.follow_interval, idle_timeout=args.idle_timeout)
+        return
+
+    # Labels from the supervised task are loaded once for all entity classes
+    with profiler.stage("load_full_labels"):
+        full_labels_dict = load_full_labels(args.full_labels_data_path) \
+            if args.full_labels and args.full_labels_data_path else None
+
+    if args.confidence_intervals:
+        for pred_file in args.pred_file:
+            with profiler.stage("metrics"):
+                intervals = confidence_interval_report(args.entity_classes, pred_file, args.few_nerd_file,
+                                                       args.decimal_places, args.full_labels,
+                                                       args.full_labels_data_path, full_labels_dict,
+                                                       confidence=args.confidence, n_resamples=args.n_bootstrap,
+                                                       seed=args.seed)
+            logging.info(f"F1-scores of {pred_file}, {intervals}")
+        profiler.close()
+        return
+
+    if len(args.pred_file) > 1 or args.leaderboard:
+        # The ground truth is read once for all prediction files and classes
+        with profiler.stage("read_episodes"):
+            ground_truth = encode_ground_truth(args.few_nerd_file, args.entity_classes, args.full_labels,
+                                               args.full_labels_data_path, full_labels_dict)
+        with profiler.stage("metrics"):
+            rows = build_leaderboard(args.pred_file, ground_truth, args.entity_classes, args.n_processes)
+        logging.info(f"F1-scores:\n{format_leaderboard(rows, args.entity_classes, args.decimal_places)}")
+        if args.leaderboard:
+            write_leaderboard(rows, args.leaderboard)
+        profiler.close()
+        return
+
+    scores = build_report(entity_classes=args.entity_classes, pred_file=args.pred_file[0],
                           true_file=args.few_nerd_file, round_to=args.decimal_places,
-                          full_labels=args.full_labels, full_labels_path=args.full_labels_data_path)
+                          full_labels=args.full_labels, full_labels_path=args.full_labels_data_path,
+                          full_labels_dict=full_labels_dict, profiler=profiler)
     logging.info(f"Scores:\n{scores}")
+    profiler.close()
     # print(scores)
 
 
@@ -187,7 +668,21 @@ if __name__ == '__main__':
     parser.add_argument(
         '--pred_file',
         type=str,
-        help='File with LLM predictions.'
+        nargs='+',
+        help='File(s) with LLM predictions. With several files, F1-scores of all files are shown as a leaderboard.'
+    )
+    parser.add_argument(
+        '--leaderboard',
+        type=str,
+        default=None,
+        help='Write F1-scores of all prediction files per class, with micro and macro averages, to this file '
+             '(JSON if it ends with .json, CSV otherwise).'
+    )
+    parser.add_argument(
+        '--n_processes',
+        type=int,
+        default=None,
+        help='Number of processes scoring prediction files in parallel (number of CPUs by default).'
     )
     parser.add_argument(
         '-c', '--entity_classes',
@@ -214,5 +709,59 @@ if __name__ == '__main__':
         help='Path to files with full data labels.'
     )
 
+    parser.add_argument(
+        '--confidence_intervals',
+        default=False,
+        action='store_true',
+        help='Report F1-scores with stratified bootstrap confidence intervals, e.g. for runs of prompt_llm.py --sample.'
+    )
+    parser.add_argument(
+        '--confidence',
+        default=0.95,
+        type=float,
+        help='Confidence level of the intervals.'
+    )
+    parser.add_argument(
+        '--n_bootstrap',
+        default=1000,
+        type=int,
+        help='Number of bootstrap samples for the confidence intervals.'
+    )
+    parser.add_argument(
+        '--seed',
+        default=None,
+        type=int,
+        help='Random seed for bootstrap sampling.'
+    )
+    parser.add_argument(
+        '--follow',
+        default=False,
+        action='store_true',
+        help='Keep reading the prediction file as new episodes are appended, and report scores periodically. '
+             'Only works with uncompressed prediction files; stops if the file is replaced '
+             '(e.g. when prompt_llm.py merges deferred prompts).'
+    )
+    parser.add_argument(
+        '--follow_interval',
+        default=30.0,
+        type=float,
+        help='Seconds between score reports with --follow.'
+    )
+    parser.add_argument(
+        '--idle_timeout',
+        default=None,
+        type=float,
+        help='With --follow, stop after this many seconds without new predictions (default: run until interrupted).'
+    )
+
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default=None,
+        metavar='DIR',
+        help='Time and profile each stage (label loading, reading, metric computation), writing a summary, '
+             'pstats files and a memory report to DIR (not used with --follow).'
+    )
+
     arguments = parser.parse_args()
     main(arguments)
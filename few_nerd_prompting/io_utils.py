@@ -0,0 +1,102 @@
+import io
+import gzip
+import json
+
+from typing import Any, BinaryIO, TextIO
+
+# Optional dependencies: orjson for faster JSON encoding and decoding, zstandard for .zst files
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Large buffers reduce the number of reads, which matters on network storage
+BUFFER_SIZE = 1 << 20
+
+COMPRESSED_EXTENSIONS = (".gz", ".zst")
+
+
+def is_compressed(path: str) -> bool:
+    return path.endswith(COMPRESSED_EXTENSIONS)
+
+
+def open_binary(path: str, mode: str = "r") -> BinaryIO:
+    """
+    Open a file in binary mode, compressing or decompressing it as a stream if it ends with .gz or .zst.
+
+    :param path: file path
+    :param mode: "r", "w" or "a"
+    :return: binary file object
+    """
+    if path.endswith(".gz"):
+        # Level 6 is a good trade-off between size and speed for text
+        gzip_file = gzip.open(path, mode + "b", compresslevel=6)
+        return io.BufferedReader(gzip_file, BUFFER_SIZE) if mode == "r" else io.BufferedWriter(gzip_file,
+                                                                                              BUFFER_SIZE)
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(f"Reading or writing {path} requires the zstandard package")
+        return zstandard.open(path, mode + "b", dctx=zstandard.ZstdDecompressor(),
+                              cctx=zstandard.ZstdCompressor(level=3, threads=-1) if mode != "r" else None)
+    return open(path, mode + "b", buffering=BUFFER_SIZE)
+
+
+def open_text(path: str, mode: str = "r") -> TextIO:
+    """
+    Open a UTF-8 text file, compressing or decompressing it as a stream if it ends with .gz or .zst.
+
+    :param path: file path
+    :param mode: "r", "w" or "a"
+    :return: text file object
+    """
+    if is_compressed(path):
+        return io.TextIOWrapper(open_binary(path, mode), encoding="utf8")
+    return open(path, mode, encoding="utf8", buffering=BUFFER_SIZE)
+
+
+def read_line_at(path: str, offset: int) -> bytes:
+    """
+    Read the line starting at an offset of an uncompressed file.
+    Compressed files cannot be read at an offset without decompressing them from the start,
+    see FewNerdEpisodesSet.read_episode for how episode files are handled.
+
+    :param path: file path
+    :param offset: byte offset
+    :return: line as bytes
+    """
+    if is_compressed(path):
+        raise ValueError(f"Cannot read {path} at an offset, as it is compressed")
+    with open(path, 'rb') as fh:
+        fh.seek(offset)
+        return fh.readline()
+
+
+def loads(text: Any) -> Any:
+    """
+    Decode JSON, with orjson if it is installed.
+
+    :param text: JSON as str or bytes
+    :return: decoded object
+    """
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def dumps(obj: Any) -> str:
+    """
+    Encode an object as a single line of JSON, with orjson if it is installed.
+    Non-string dictionary keys (e.g. episode IDs) are converted to strings, as json.dumps does.
+    Without orjson, the output is formatted like orjson's (compact, non-ASCII characters kept),
+    so that written files do not depend on the installed packages.
+
+    :param obj: object to encode
+    :return: JSON string
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf8")
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
@@ -1,44 +1,58 @@
 import argparse
-import json
+import logging
 
-from typing import List
+from typing import List, Optional
 
+from io_utils import loads, open_text
+from profiling import StageProfiler
 
-def process_files(input_files: List[str], output_file: str) -> None:
+logging.basicConfig(format="{asctime} {levelname}: {message}",
+                    style="{", level=logging.INFO)
+
+
+def process_files(input_files: List[str], output_file: str, profiler: Optional[StageProfiler] = None) -> None:
     """
     Process a list of input files containing JSON-formatted lines,
     extract numeric keys from each JSON object, sort lines based on
     the keys, write the sorted lines to the output file.
+    Input and output files may be compressed (.gz or .zst).
 
     :param input_files: list of input files
     :param output_file: path to write merged and sorted output
+    :param profiler: optional profiler measuring each stage
     :return: None
     """
+    profiler = profiler if profiler is not None else StageProfiler()
     all_lines = []
 
     # Read lines from each input file
-    for input_file in input_files:
-        with open(input_file, 'r', encoding='utf8') as file:
-            lines = file.readlines()
-            all_lines.extend(lines)
+    with profiler.stage("read_files"):
+        for input_file in input_files:
+            with open_text(input_file) as file:
+                lines = file.readlines()
+                all_lines.extend(lines)
 
     # Parse JSON and extract numeric keys
     parsed_lines = []
-    for line in all_lines:
-        try:
-            data = json.loads(line)
-            key = int(list(data.keys())[0])
-            parsed_lines.append((key, line))
-        except (json.JSONDecodeError, IndexError, ValueError):
-            print(f"Skipping invalid JSON line: {line}")
+    with profiler.stage("parse_json"):
+        for line in all_lines:
+            try:
+                data = loads(line)
+                key = int(list(data.keys())[0])
+                parsed_lines.append((key, line))
+            # orjson.JSONDecodeError and json.JSONDecodeError are both subclasses of ValueError
+            except (IndexError, ValueError):
+                print(f"Skipping invalid JSON line: {line}")
 
     # Sort lines based on numeric keys
-    sorted_lines = sorted(parsed_lines, key=lambda x: x[0])
+    with profiler.stage("sort"):
+        sorted_lines = sorted(parsed_lines, key=lambda x: x[0])
 
     # Write sorted lines to the output file
-    with open(output_file, 'w') as out_file:
-        for _, line in sorted_lines:
-            out_file.write(line)
+    with profiler.stage("write_output"):
+        with open_text(output_file, 'w') as out_file:
+            for _, line in sorted_lines:
+                out_file.write(line)
 
 
 if __name__ == '__main__':
@@ -57,5 +71,16 @@ if __name__ == '__main__':
         help='Output file.'
     )
 
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default=None,
+        metavar='DIR',
+        help='Time and profile each stage (reading, parsing, sorting, writing), writing a summary, '
+             'pstats files and a memory report to DIR.'
+    )
+
     arguments = parser.parse_args()
-    process_files(arguments.input_files, arguments.output_file)
+    stage_profiler = StageProfiler(arguments.profile)
+    process_files(arguments.input_files, arguments.output_file, stage_profiler)
+    stage_profiler.close()
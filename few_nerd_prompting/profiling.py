@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import logging
+import cProfile
+import tracemalloc
+
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Number of allocation sites listed in the memory report
+TOP_ALLOCATIONS = 25
+
+
+class StageProfiler:
+    """
+    Measure pipeline stages (e.g. reading episodes, building prompts, waiting on the network) separately:
+    wall time, CPU time of the calling thread, memory allocated (with tracemalloc) and a cProfile profile per stage.
+    Stages must not be nested, so that every profile only covers its own stage.
+    Without an output directory the profiler is disabled and stages cost nothing.
+    """
+
+    def __init__(self, output_dir: Optional[str] = None, trace_memory: bool = True):
+        self.output_dir = output_dir
+        self.enabled = output_dir is not None
+        self.trace_memory = trace_memory and self.enabled
+        self.stats = {}
+        self._profiles = {}
+        self._active_stage = None
+        self._start_time = time.perf_counter()
+        self._started_tracing = False
+
+        if self.enabled:
+            os.makedirs(output_dir, exist_ok=True)
+            if self.trace_memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+
+    def stage(self, name: str):
+        """
+        Context manager measuring one run of a stage; runs of the same stage are added up.
+
+        :param name: stage name
+        :return: context manager
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(name)
+
+    @contextmanager
+    def _measure(self, name: str):
+        if self._active_stage is not None:
+            raise RuntimeError(f"Stage {name} started inside stage {self._active_stage}")
+        self._active_stage = name
+        stats = self.stats.setdefault(name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                             "allocated_bytes": 0 if self.trace_memory else None,
+                                             "peak_bytes": None})
+        profile = self._profiles.setdefault(name, cProfile.Profile())
+
+        if self.trace_memory:
+            # Peak memory per stage needs tracemalloc.reset_peak (Python 3.9+)
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            stats["calls"] += 1
+            stats["wall_seconds"] += time.perf_counter() - wall_start
+            stats["cpu_seconds"] += time.thread_time() - cpu_start
+            if self.trace_memory:
+                memory_after, memory_peak = tracemalloc.get_traced_memory()
+                stats["allocated_bytes"] += memory_after - memory_before
+                if hasattr(tracemalloc, "reset_peak"):
+                    stats["peak_bytes"] = max(stats["peak_bytes"] or 0, memory_peak - memory_before)
+            self._active_stage = None
+
+    def iterate(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        """
+        Iterate over a lazy iterable (e.g. episodes read from a file), measuring the time spent producing each item
+        as a stage. The loop body is not part of the stage.
+
+        :param name: stage name
+        :param iterable: iterable to measure
+        :return: iterator over the same items
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self) -> Dict:
+        """
+        :return: per-stage statistics and the total wall time since the profiler was created
+        """
+        return {"total_wall_seconds": time.perf_counter() - self._start_time, "stages": self.stats}
+
+    def close(self) -> None:
+        """
+        Write the per-stage summary (summary.txt and summary.json), a pstats file per stage (STAGE.pstats)
+        and the largest live allocations (memory.txt) to the output directory.
+        """
+        if not self.enabled:
+            return
+        summary = self.summary()
+        with open(os.path.join(self.output_dir, "summary.json"), 'w', encoding='utf8') as fh:
+            json.dump(summary, fh, indent=1)
+        table = format_summary(summary)
+        with open(os.path.join(self.output_dir, "summary.txt"), 'w', encoding='utf8') as fh:
+            fh.write(table + "\n")
+        for name, profile in self._profiles.items():
+            profile.dump_stats(os.path.join(self.output_dir, f"{name}.pstats"))
+
+        if self.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            if self._started_tracing:
+                tracemalloc.stop()
+            with open(os.path.join(self.output_dir, "memory.txt"), 'w', encoding='utf8') as fh:
+                for statistic in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                    fh.write(f"{statistic}\n")
+        logging.info(f"Profile written to {self.output_dir}:\n{table}")
+
+
+def format_summary(summary: Dict) -> str:
+    """
+    Format a profiler summary as a table of stages.
+
+    :param summary: dictionary returned by StageProfiler.summary
+    :return: table as a string
+    """
+    total = summary["total_wall_seconds"]
+    measured = sum(stats["wall_seconds"] for stats in summary["stages"].values())
+    lines = [f"{'stage':>20} {'calls':>8} {'wall (s)':>10} {'% total':>8} {'cpu (s)':>10} "
+             f"{'alloc (MB)':>11} {'peak (MB)':>10}"]
+    rows = sorted(summary["stages"].items(), key=lambda item: -item[1]["wall_seconds"])
+    rows.append(("(not measured)", {"calls": "", "wall_seconds": total - measured, "cpu_seconds": None,
+                                    "allocated_bytes": None, "peak_bytes": None}))
+    for name, stats in rows:
+        cpu = "" if stats["cpu_seconds"] is None else f"{stats['cpu_seconds']:.3f}"
+        allocated = "" if stats["allocated_bytes"] is None else f"{stats['allocated_bytes'] / 2 ** 20:.2f}"
+        peak = "" if stats["peak_bytes"] is None else f"{stats['peak_bytes'] / 2 ** 20:.2f}"
+        share = 100 * stats["wall_seconds"] / total if total else 0.0
+        lines.append(f"{name:>20} {stats['calls']:>8} {stats['wall_seconds']:>10.3f} {share:>8.1f} {cpu:>10} "
+                     f"{allocated:>11} {peak:>10}")
+    return "\n".join(lines)
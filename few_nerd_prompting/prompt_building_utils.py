@@ -1,9 +1,17 @@
-from typing import List, Tuple, Iterator
+import re
+import math
+import logging
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Iterator
 
 from nltk import word_tokenize
 
 TAG_START = "@@"
 TAG_END = "##"
+TAG_PATTERN = re.compile(f"{re.escape(TAG_START)}|{re.escape(TAG_END)}")
+
+# Instructions following the GPT-NER preprint
+SYSTEM_MESSAGE = "I am an excellent linguist."
 
 
 def make_output_example(sentence: List[str], labels: List[str], entity_class: str) -> str:
@@ -38,9 +46,97 @@ def make_output_example(sentence: List[str], labels: List[str], entity_class: st
                 entity_in_progress = False
             # Then add current non-entity token
             sentence_list.append(w)
+    # Close an entity at the end of the sentence
+    if entity_in_progress:
+        sentence_list[-1] = f"{sentence_list[-1]}{TAG_END}"
     return ' '.join(sentence_list)
 
 
+class EntitySpan(NamedTuple):
+    # Entity text without tags, and character offsets of the tagged region in the output (excluding the tags)
+    text: str
+    start: int
+    end: int
+
+
+class TagRepair(NamedTuple):
+    # "drop_orphan_end", "drop_nested_start" or "drop_unclosed_start", and the character offset of the tag
+    action: str
+    position: int
+
+
+class TagScan(NamedTuple):
+    valid: bool
+    spans: List[EntitySpan]
+    repairs: List[TagRepair]
+
+
+def scan_tags(sentence: str) -> TagScan:
+    """
+    Find all entity tags in a model output in a single pass.
+    The output is well-formed if each TAG_START is followed by a TAG_END before the next TAG_START.
+    Malformed outputs are interpreted as follows, recording a repair action for each ignored tag:
+    - TAG_END without an open entity is dropped ("drop_orphan_end"),
+    - TAG_START inside an open entity is dropped ("drop_nested_start"),
+      e.g. "We live in @@New @@York##." -> entity "New York",
+    - TAG_START that is never closed is dropped ("drop_unclosed_start").
+    E.g. "We live in @@New York##." -> TagScan(valid=True, spans=[EntitySpan("New York", 13, 21)], repairs=[])
+
+    :param sentence: string which may contain entity tags
+    :return: validity flag, entity spans and repair actions
+    """
+    spans, repairs = [], []
+    # Offset of the text after the currently open TAG_START, if any
+    entity_start = None
+    nested_starts = []
+
+    for match in TAG_PATTERN.finditer(sentence):
+        if match.group() == TAG_START:
+            if entity_start is None:
+                entity_start = match.end()
+                nested_starts = []
+            else:
+                repairs.append(TagRepair("drop_nested_start", match.start()))
+                nested_starts.append(match)
+        elif entity_start is None:
+            repairs.append(TagRepair("drop_orphan_end", match.start()))
+        else:
+            # Entity text without any nested start tags
+            pieces, piece_start = [], entity_start
+            for nested_start in nested_starts:
+                pieces.append(sentence[piece_start:nested_start.start()])
+                piece_start = nested_start.end()
+            pieces.append(sentence[piece_start:match.start()])
+            spans.append(EntitySpan("".join(pieces), entity_start, match.start()))
+            entity_start = None
+
+    if entity_start is not None:
+        repairs.append(TagRepair("drop_unclosed_start", entity_start - len(TAG_START)))
+        # Keep repairs in the order of the tags in the output
+        repairs.sort(key=lambda repair: repair.position)
+
+    return TagScan(not repairs, spans, repairs)
+
+
+def repair_tags(sentence: str, scan: Optional[TagScan] = None) -> str:
+    """
+    Remove the tags that make an output malformed (see scan_tags), giving a well-formed output.
+    E.g. "We live in @@New @@York##." -> "We live in @@New York##."
+
+    :param sentence: string which may contain entity tags
+    :param scan: result of scan_tags for the sentence, if already available
+    :return: sentence without the dropped tags
+    """
+    if scan is None:
+        scan = scan_tags(sentence)
+    pieces, piece_start = [], 0
+    for repair in scan.repairs:
+        pieces.append(sentence[piece_start:repair.position])
+        piece_start = repair.position + len(TAG_END if repair.action == "drop_orphan_end" else TAG_START)
+    pieces.append(sentence[piece_start:])
+    return "".join(pieces)
+
+
 def output_well_formed(sentence: str) -> bool:
     """
     Check whether the sentence with entity tags is well-formed: 
@@ -53,74 +149,19 @@ def output_well_formed(sentence: str) -> bool:
     :param sentence: string which may contain entity tags
     :return: True if sentence is well-formed, False otherwise
     """
-    # TODO: do we need to check for things like "@!"? How to find them?
-
-    start, end = 0, len(sentence)
-    start_pos = sentence.find(TAG_START, start, end)
-    end_pos = sentence.find(TAG_END, start, end)
-
-    # If there are no start or end tags found -> no entities -> good
-    if start_pos == -1 and end_pos == -1:
-        return True
-
-    # End but no start -> bad
-    if start_pos == -1 and end_pos != -1:
-        return False
-
-    # If there is a start tag
-    while start_pos != -1:
-        # End does not exist (-1) or comes before start -> bad
-        if end_pos < start_pos:
-            return False
-        elif end_pos > start_pos:
-            # Find next start
-            next_start_pos = sentence.find(TAG_START, start_pos + 2, end)
-            # No more starts
-            if next_start_pos == -1:
-                # Are there more ends?
-                next_end_pos = sentence.find(TAG_END, end_pos + 2, end)
-                # There is end after -> bad
-                if next_end_pos != -1:
-                    return False
-                # No end after -> good
-                elif next_end_pos == -1:
-                    return True
-            # If there are more starts
-            else:
-                # Next start comes before current end -> bad
-                if end_pos > next_start_pos:
-                    return False
-                # If next start comes after current end, continue
-                elif end_pos < next_start_pos:
-                    start_pos = next_start_pos
-                    end_pos = sentence.find(TAG_END, start_pos + 2, end)
+    return scan_tags(sentence).valid
 
 
 def extract_predicted_entities(sentence: str) -> List[str]:
     """
     Extract predicted entities from sentences with entity start and end tags.
+    Malformed tags are handled as described in scan_tags.
     E.g. "I am in @@New York##." -> ['New York']
     
     :param sentence: sentence string which may include named entities marked with start and end tags
     :return: list of marked entities
     """
-    predicted_entities = []
-    start, end = 0, len(sentence)
-    # Look for TAG_START
-    entity_start = sentence.find(TAG_START, start, end)
-    # If TAG_START found
-    while entity_start != -1:
-        # Move start of next search to the start of entity after TAG_START
-        start = entity_start + 2
-        # Look for TAG_END
-        entity_end = sentence.find(TAG_END, start, end)
-        # If TAG_END found
-        if entity_end != -1:
-            # Add found entity to list
-            predicted_entities.append(sentence[start:entity_end])
-        # Look for next entity
-        entity_start = sentence.find(TAG_START, start, end)
-    return predicted_entities
+    return [span.text for span in scan_tags(sentence).spans]
 
 
 def build_llama2_prompt(
@@ -158,10 +199,234 @@ def build_llama2_prompt_plain(
     :param input_example: input example to predict for
     :return: full prompt
     """
+    return build_prompt_from_prefix(build_llama2_prompt_plain_prefix(few_shot_examples, system_msg, instr_msg),
+                                    input_example)
+
+
+def build_llama2_prompt_plain_prefix(
+        few_shot_examples: Iterator[Tuple[str, str]], system_msg: str, instr_msg: str
+) -> str:
+    """
+    Create the part of a plain text prompt for Llama 2 that does not depend on the input example,
+    so that it can be built once and shared by many prompts (see build_prompt_from_prefix).
+
+    :param few_shot_examples: iterable containing pairs of input and output few-shot examples
+    :param system_msg: system message
+    :param instr_msg: instruction message
+    :return: prompt prefix
+    """
     few_shot_examples_string = "\n".join([f"Input: {example[0]}\nOutput: {example[1]}"
                                           for example in few_shot_examples])
-    input_example_string = f"Input: {input_example}"
-    return f"{system_msg} {instr_msg}\n{few_shot_examples_string}\n{input_example_string}\nOutput: "
+    return f"{system_msg} {instr_msg}\n{few_shot_examples_string}\n"
+
+
+def build_prompt_from_prefix(prefix: str, input_example: str) -> str:
+    """
+    Complete a prompt prefix with the input example to predict for.
+
+    :param prefix: prompt prefix built with build_llama2_prompt_plain_prefix
+    :param input_example: input example to predict for
+    :return: full prompt, the same as build_llama2_prompt_plain would create
+    """
+    return f"{prefix}Input: {input_example}\nOutput: "
+
+
+def instruction_message(entity_class: str) -> str:
+    """
+    Create the instruction message asking to label entities of a single class.
+
+    :param entity_class: entity class (e.g. "person", "location" etc.)
+    :return: instruction message
+    """
+    return f"The task is to label {entity_class} entities in the given sentence. Below are some examples:"
+
+
+def build_episode_prompts(episode: Any, episode_id: int, entity_classes: List[str],
+                          system_msg: str, instr_messages: Dict[str, str],
+                          retriever: Optional[Any] = None,
+                          packer: Optional["PromptPacker"] = None) -> List[Tuple[str, Tuple[int, str, int]]]:
+    """
+    Create one prompt per entity class and query sentence of an episode.
+    As the model is prompted to predict one class at a time, the support output examples are rebuilt for each class
+    (by the packer, if there is one); query output examples are not needed for prompting and are not built.
+    By default, the whole support set is used as few-shot examples; with a retriever
+    (e.g. demonstration_retrieval.DemonstrationRetriever), only the support sentences it selects for each query are used.
+    With a packer, the demonstrations of each prompt are further filtered to fit its class and token budget.
+
+    :param episode: FewNerdEpisode object
+    :param episode_id: episode ID (0-based)
+    :param entity_classes: entity classes to prompt for
+    :param system_msg: system message
+    :param instr_messages: dictionary mapping entity classes to instruction messages
+    :param retriever: object with a select(pool_texts, query_texts) method returning support indices for each query
+    :param packer: PromptPacker choosing the few-shot examples of each prompt
+    :return: list of (prompt, (episode_id, entity_class, query_id)) pairs
+    """
+    support_input_examples = episode.support_input_examples
+    query_input_examples = episode.query_input_examples
+    # Demonstrations only depend on the input sentences, so they are selected once for all classes
+    if retriever is not None:
+        demonstration_ids = retriever.select(support_input_examples, query_input_examples)
+    else:
+        demonstration_ids = [range(len(support_input_examples))] * len(query_input_examples)
+
+    support_labels = episode.support_labels
+
+    prompts = []
+    for entity_class in entity_classes:
+        if packer is None:
+            few_shot_examples = [(input_example, make_output_example(tokens, labels, entity_class))
+                                 for input_example, tokens, labels in zip(support_input_examples,
+                                                                          episode.support_tokens, support_labels)]
+        for i, query_input_example in enumerate(query_input_examples):
+            if packer is not None:
+                query_examples = packer.pack(
+                    [(episode.support_tokens[j], support_labels[j]) for j in demonstration_ids[i]],
+                    entity_class,
+                    build_llama2_prompt_plain([], system_msg, instr_messages[entity_class], query_input_example)
+                )
+            else:
+                query_examples = [few_shot_examples[j] for j in demonstration_ids[i]]
+            prompts.append((build_llama2_prompt_plain(few_shot_examples=query_examples,
+                                                      system_msg=system_msg,
+                                                      instr_msg=instr_messages[entity_class],
+                                                      input_example=query_input_example),
+                            (episode_id, entity_class, i)))
+    return prompts
+
+
+def count_tokens_whitespace(text: str) -> int:
+    return len(text.split())
+
+
+def count_tokens_chars(text: str) -> int:
+    # Rough estimate for subword tokenizers: about 4 characters per token for English text
+    return math.ceil(len(text) / 4)
+
+
+def count_tokens_nltk(text: str) -> int:
+    return len(word_tokenize(text))
+
+
+TOKEN_COUNTERS = {
+    "whitespace": count_tokens_whitespace,
+    "chars": count_tokens_chars,
+    "nltk": count_tokens_nltk,
+}
+
+
+def get_token_counter(name: str) -> Callable[[str], int]:
+    """
+    Get a function counting the tokens in a text.
+    Either one of TOKEN_COUNTERS, or "hf:MODEL_NAME" to use a Hugging Face tokenizer (requires transformers).
+
+    :param name: token counter name
+    :return: function mapping a text to its number of tokens
+    """
+    if name.startswith("hf:"):
+        try:
+            from transformers import AutoTokenizer
+        except ImportError:
+            raise ImportError("Counting tokens with a Hugging Face tokenizer requires the transformers package")
+        tokenizer = AutoTokenizer.from_pretrained(name[len("hf:"):])
+        return lambda text: len(tokenizer.encode(text, add_special_tokens=True))
+    if name not in TOKEN_COUNTERS:
+        raise ValueError(f"Unknown token counter: {name}, expected one of {sorted(TOKEN_COUNTERS)} or hf:MODEL_NAME")
+    return TOKEN_COUNTERS[name]
+
+
+class PromptPacker:
+    """
+    Choose which support sentences to use as few-shot examples in a single-class prompt.
+    Sentences containing the target class (positives) are preferred over sentences without it (negatives),
+    of which at most max_negatives are kept. Sentences longer than max_sentence_tokens are dropped or truncated,
+    and examples are added in order of preference as long as the whole prompt fits into token_budget,
+    so negatives only use the budget left after all positives that fit.
+    A warning is logged when positives are left out (or truncated before their entities) to meet these limits.
+    Selected examples keep their original relative order.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], token_budget: Optional[int] = None,
+                 max_negatives: Optional[int] = None, max_sentence_tokens: Optional[int] = None,
+                 truncate: bool = False):
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.max_negatives = max_negatives
+        self.max_sentence_tokens = max_sentence_tokens
+        self.truncate = truncate
+
+    def _fit_sentence(self, sentence: Sequence[str], labels: Sequence[str]) -> Optional[Tuple[Sequence[str],
+                                                                                             Sequence[str]]]:
+        # Returns the sentence (possibly truncated to its longest fitting prefix), or None if it should be dropped
+        if self.max_sentence_tokens is None or self.count_tokens(' '.join(sentence)) <= self.max_sentence_tokens:
+            return sentence, labels
+        if not self.truncate:
+            return None
+        low, high = 0, len(sentence)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(' '.join(sentence[:middle])) <= self.max_sentence_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return (sentence[:low], labels[:low]) if low else None
+
+    def pack(self, support_examples: Sequence[Tuple[Sequence[str], Sequence[str]]], entity_class: str,
+             prompt_without_examples: str) -> List[Tuple[str, str]]:
+        """
+        Select and format few-shot examples for one prompt.
+
+        :param support_examples: candidate (tokens, labels) pairs, in the order they would appear in the prompt
+        :param entity_class: entity class the prompt asks about
+        :param prompt_without_examples: the prompt built without any few-shot examples (counted towards the budget)
+        :return: list of (input example, output example) pairs
+        """
+        positives, negatives = [], []
+        n_dropped_positives = 0
+        for position, (sentence, labels) in enumerate(support_examples):
+            # Same criterion as make_output_example for marking an entity
+            is_positive = any(label.startswith(entity_class) for label in labels)
+            fitted = self._fit_sentence(sentence, labels)
+            if fitted is None:
+                n_dropped_positives += is_positive
+                continue
+            sentence, labels = fitted
+            example = (position, ' '.join(sentence), make_output_example(sentence, labels, entity_class))
+            # Truncation may cut off all entities of a positive, which then counts as a negative
+            has_entity = any(label.startswith(entity_class) for label in labels)
+            if is_positive and not has_entity:
+                n_dropped_positives += 1
+            if has_entity:
+                positives.append(example)
+            else:
+                negatives.append(example)
+        if self.max_negatives is not None:
+            negatives = negatives[:self.max_negatives]
+
+        selected = []
+        used_tokens = self.count_tokens(prompt_without_examples)
+        for rank, example in enumerate(positives + negatives):
+            if self.token_budget is not None:
+                example_tokens = self.count_tokens(f"Input: {example[1]}\nOutput: {example[2]}\n")
+                if used_tokens + example_tokens > self.token_budget:
+                    n_dropped_positives += rank < len(positives)
+                    continue
+                used_tokens += example_tokens
+            selected.append(example)
+        if n_dropped_positives:
+            logging.warning(f"{n_dropped_positives} support sentences with {entity_class} entities were left out "
+                            f"of a prompt or truncated before their entities to fit the token limits")
+        return [(input_example, output_example) for _, input_example, output_example in sorted(selected)]
+
+
+def verification_system_message(entity_class: str) -> str:
+    """
+    Create the system message for verifying predicted entities of a single class.
+
+    :param entity_class: entity class (e.g. "person", "location" etc.)
+    :return: system message
+    """
+    return f"The task is to verify whether the word is a {entity_class} entity extracted from the given sentence"
 
 
 def build_self_verification_prompt_plain(system_msg: str, input_example: str, candidate_entity: str, entity_class: str) -> str:
@@ -202,20 +467,60 @@ def labels_from_output(llm_output: str, input_tokens: List[str], entity_class: s
     # TODO: What to do with different punctuation in input and output? e.g. ``` vs. ``
     # TODO: What to do when tokens don't match? e.g. "ohne filter" translated into "without filter"
     predicted_entities = extract_predicted_entities(llm_output)
-    temp_input_tokens = [t for t in input_tokens]
-    result_pairs = [[token, "O"] for token in input_tokens]
+    labels = ["O"] * len(input_tokens)
+    # Position of the next input token to compare; raises IndexError if an entity cannot be matched to the input
     result_index = 0
 
     for entity in predicted_entities:
         # NLTK tokenizer as described in Few-NERD paper
         entity_tokens = word_tokenize(entity)
-        matched_tokens = 0
-        while entity_tokens:
-            if temp_input_tokens[0] == entity_tokens[0]:
-                result_pairs[result_index][1] = entity_class
-                matched_tokens += 1
-                entity_tokens.pop(0)
-
-            temp_input_tokens.pop(0)
+        entity_index = 0
+        while entity_index < len(entity_tokens):
+            if input_tokens[result_index] == entity_tokens[entity_index]:
+                labels[result_index] = entity_class
+                entity_index += 1
             result_index += 1
-    return [t[1] for t in result_pairs]
+    return labels
+
+
+# Explanations added to a prompt when it is repeated because of a problem with the output (see build_reprompt)
+REPROMPT_MESSAGES = {
+    "malformed": f"Each entity has to start with {TAG_START} and end with {TAG_END}, and entities cannot overlap.",
+    "alignment": f"The output has to repeat the input sentence word for word, only adding {TAG_START} and {TAG_END} "
+                 f"around entities.",
+    "verification": "Not all of the marked words are {entity_class} entities.",
+}
+
+
+def output_problem(llm_output: str, input_tokens: List[str], entity_class: str) -> Optional[str]:
+    """
+    Check whether labels can be created from a generated output sentence (see labels_from_output).
+    E.g. llm_output = "We live in @@New York.", tokens = ["We", "live", "in", "New", "York", "."] -> "malformed"
+
+    :param llm_output: a generated sentence with predicted entities marked with start and end tags
+    :param input_tokens: list of original input tokens
+    :param entity_class: entity class
+    :return: "malformed" if the tags are malformed (see output_well_formed),
+             "alignment" if the entities cannot be matched to the input tokens, None if the output can be used
+    """
+    if not output_well_formed(llm_output):
+        return "malformed"
+    try:
+        labels_from_output(llm_output, input_tokens, entity_class)
+    except IndexError:
+        return "alignment"
+    return None
+
+
+def build_reprompt(prompt: str, llm_output: str, problem: str, entity_class: str) -> str:
+    """
+    Repeat a prompt together with the rejected output and an explanation of the problem.
+
+    :param prompt: original prompt, ending with "Output: "
+    :param llm_output: rejected output (first line)
+    :param problem: "malformed", "alignment" (see output_problem) or "verification"
+    :param entity_class: entity class
+    :return: new prompt, also ending with "Output: "
+    """
+    message = REPROMPT_MESSAGES[problem].format(entity_class=entity_class)
+    return f"{prompt}{llm_output}\n{message} Please try again.\nOutput: "
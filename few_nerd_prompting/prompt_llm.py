@@ -1,95 +1,361 @@
+import os
 import argparse
 import logging
-import json
 
 from itertools import islice
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Executor, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from tqdm import tqdm
 
-from read_few_nerd import FewNerdEpisodesSet
-from clarifai_prompter import ClarifaiPrompter
-from prompt_building_utils import build_llama2_prompt, build_llama2_prompt_plain, labels_from_output
+from io_utils import dumps, loads, open_text
+from read_few_nerd import FewNerdEpisode, FewNerdEpisodesSet, load_full_labels
+from clarifai_prompter import ClarifaiPrompter, ChannelPool, HedgingPolicy
+from cascade import CascadeTier, ModelCascade, parse_model_spec
+from telemetry import Telemetry, TelemetryExporter
+from dry_run import LatencyProfile, plan_run, format_plan
+from profiling import StageProfiler
+from episode_sampling import StratifiedF1Estimate, read_strata, stratified_order, stratum_key
+from evaluate_outputs import episode_counts
+from demonstration_retrieval import DemonstrationRetriever
+from prompt_building_utils import (SYSTEM_MESSAGE, PromptPacker, build_episode_prompts, get_token_counter,
+                                   instruction_message, labels_from_output, make_output_example)
 
 logging.basicConfig(format="{asctime} {levelname}: {message}",
                     style="{", level=logging.INFO)
 
 
+def build_retriever_and_packer(count_tokens: Callable[[str], int], retrieval_k: Optional[int] = None,
+                               token_budget: Optional[int] = None, max_negatives: Optional[int] = None,
+                               max_sentence_tokens: Optional[int] = None,
+                               truncate_long_sentences: bool = False
+                               ) -> Tuple[Optional[DemonstrationRetriever], Optional[PromptPacker]]:
+    """
+    Create the optional components selecting few-shot examples for each prompt (see build_episode_prompts).
+
+    :param count_tokens: function counting tokens in a text
+    :param retrieval_k: number of most similar support sentences to use per query (all if not set)
+    :param token_budget: max number of tokens per prompt
+    :param max_negatives: max number of support sentences without the prompted class
+    :param max_sentence_tokens: max number of tokens in a support sentence
+    :param truncate_long_sentences: truncate long support sentences instead of dropping them
+    :return: demonstration retriever and prompt packer, or None for each one that is not needed
+    """
+    retriever = DemonstrationRetriever(retrieval_k) if retrieval_k else None
+    packer = None
+    if token_budget or max_negatives is not None or max_sentence_tokens:
+        packer = PromptPacker(count_tokens, token_budget=token_budget, max_negatives=max_negatives,
+                              max_sentence_tokens=max_sentence_tokens, truncate=truncate_long_sentences)
+    return retriever, packer
+
+
+def results_from_outputs(episode: FewNerdEpisode, episode_id: int, entity_classes: List[str],
+                         output_first_lines: Dict[str, List[Tuple[str, int]]]) -> Dict:
+    """
+    Turn the model outputs for an episode into the results written to the output file:
+    output texts and predicted token labels for each entity class and query sentence.
+
+    :param episode: FewNerdEpisode object
+    :param episode_id: episode ID
+    :param entity_classes: entity classes the model was prompted for
+    :param output_first_lines: dictionary mapping entity classes to (first line of output, query ID) pairs
+    :return: dictionary {episode_id: {"text": {class: [outputs]}, "label": {class: [labels]}}}
+    """
+    results = {episode_id: {"text": {entity_class: [] for entity_class in entity_classes},
+                            "label": {entity_class: [] for entity_class in entity_classes}}}
+
+    for entity_class in entity_classes:
+        results[episode_id]["text"][entity_class] = [t[0] for t
+                                                     in sorted(output_first_lines[entity_class],
+                                                               key=lambda x: x[1])]
+        for output, input_tokens in zip(results[episode_id]["text"][entity_class],
+                                        episode.query_tokens):
+            # Create a list of labels based on the generated tags; if that fails, return an empty list instead
+            try:
+                class_labels = labels_from_output(output, input_tokens, entity_class)
+            except IndexError:
+                class_labels = []
+            results[episode_id]["label"][entity_class].append(class_labels)
+
+        logging.debug("CLASS: %s", entity_class)
+        logging.debug("OUTPUT (1st lines): %s", results[episode_id]['text'][entity_class])
+        # Correct outputs are only built for debugging
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("CORRECT OUTPUT: %s", [make_output_example(tokens, labels, entity_class)
+                                                 for tokens, labels in zip(episode.query_tokens,
+                                                                           episode.query_labels)])
+
+    return results
+
+
+def add_absent_classes(episode_results: Dict, episode: FewNerdEpisode, absent_classes: List[str],
+                       policy: str) -> None:
+    """
+    Record the entity classes that were not prompted for because they do not occur among the episode's types.
+    With the "fill" policy, all their labels are "O" and the output texts are the untagged sentences;
+    otherwise ("skip", "defer") they are listed under "skipped" and left out of evaluation
+    until deferred prompts are run.
+
+    :param episode_results: results of the episode, see results_from_outputs
+    :param episode: FewNerdEpisode object
+    :param absent_classes: entity classes that were not prompted for
+    :param policy: absent class policy, "fill", "skip" or "defer"
+    """
+    if not absent_classes:
+        return
+    if policy == "fill":
+        for entity_class in absent_classes:
+            episode_results["text"][entity_class] = episode.query_input_examples
+            episode_results["label"][entity_class] = [["O"] * len(tokens) for tokens in episode.query_tokens]
+        episode_results["filled"] = absent_classes
+    else:
+        episode_results["skipped"] = absent_classes
+
+
+def check_absent_class_policy(policy: str, full_labels: bool) -> None:
+    """
+    Check that an absent class policy can be used with the chosen labels.
+    Episode types only list the classes annotated in the episode, but with full labels from the supervised task,
+    query sentences also contain entities of other classes: skipping them would leave gold entities out of evaluation,
+    and filling them with "O" would turn them all into false negatives.
+
+    :param policy: absent class policy, "prompt", "skip", "fill" or "defer"
+    :param full_labels: full labels from the supervised task are used
+    """
+    if full_labels and policy in ("skip", "fill"):
+        raise Exception(f"--absent_class_policy {policy} cannot be used with --full_labels, "
+                        f"as query sentences can contain entities of classes that are not among the episode's types")
+
+
+def merge_deferred_results(output_file: str, deferred_results: Dict[int, Dict]) -> None:
+    """
+    Add the results of deferred prompts to the episodes of an output file, removing them from the skipped classes.
+    The output file is replaced by a new file, so evaluate_outputs.py --follow stops when it notices the replacement.
+
+    :param output_file: path to the output file
+    :param deferred_results: dictionary mapping episode IDs to results for their deferred classes
+    """
+    # The temporary file keeps the extension, so that it is compressed in the same way
+    tmp_file = os.path.join(os.path.dirname(output_file), f"tmp.{os.path.basename(output_file)}")
+    with open_text(output_file) as in_fh, open_text(tmp_file, 'w') as out_fh:
+        for line in in_fh:
+            results = loads(line)
+            episode_id = list(results.keys())[0]
+            extra_results = deferred_results.get(int(episode_id))
+            if extra_results is not None:
+                episode_results = results[episode_id]
+                episode_results["text"].update(extra_results["text"])
+                episode_results["label"].update(extra_results["label"])
+                episode_results["skipped"] = [entity_class for entity_class in episode_results["skipped"]
+                                              if entity_class not in extra_results["label"]]
+                if not episode_results["skipped"]:
+                    del episode_results["skipped"]
+            out_fh.write(dumps(results) + "\n")
+    os.replace(tmp_file, output_file)
+
+
+def predict_episode(episode: FewNerdEpisode, episode_id: int, raw_texts_ner: List[Tuple[str, Tuple[int, str, int]]],
+                    prompter: ClarifaiPrompter, executor: Executor, model_id: str, entity_classes: List[str],
+                    show_progress: bool = True, profiler: Optional[StageProfiler] = None,
+                    cascade: Optional[ModelCascade] = None) -> Dict:
+    """
+    Send all prompts of an episode to the model and wait for the outputs.
+    With a cascade, prompts are sent to its tiers instead (see cascade.ModelCascade).
+
+    :param episode: FewNerdEpisode object
+    :param episode_id: episode ID
+    :param raw_texts_ner: (prompt, (episode_id, entity_class, query_id)) pairs, see build_episode_prompts
+    :param prompter: ClarifaiPrompter object
+    :param executor: executor running the requests
+    :param model_id: model ID
+    :param entity_classes: entity classes the model is prompted for
+    :param show_progress: show progress bars
+    :param profiler: optional profiler measuring the "network" and "parse_outputs" stages
+    :param cascade: optional model cascade (prompter and model_id are not used then)
+    :return: episode results, see results_from_outputs
+    """
+    profiler = profiler if profiler is not None else StageProfiler()
+    threads = []
+    output_first_lines = {entity_class: [] for entity_class in entity_classes}
+
+    with profiler.stage("network"):
+        if cascade is not None:
+            for output, (_, entity_class, query_id) in cascade.predict(executor, raw_texts_ner, episode.query_tokens,
+                                                                       show_progress=show_progress):
+                output_first_lines[entity_class].append((output, query_id))
+        else:
+            for raw_text, query_index in tqdm(raw_texts_ner, total=len(raw_texts_ner),
+                                              desc="Getting predictions (submit)", disable=not show_progress):
+                threads.append(prompter.submit(executor, model_id, raw_text, query_index))
+
+            for task in tqdm(as_completed(threads), total=len(raw_texts_ner), desc='Getting predictions (results)',
+                             disable=not show_progress):
+                result_text, (received_episode_id, entity_class, query_id) = task.result()
+                # Only use the first line of each output, as the model is prone to over-generation
+                output_first_lines[entity_class].append((result_text.split('\n')[0], query_id))
+
+    with profiler.stage("parse_outputs"):
+        return results_from_outputs(episode, episode_id, entity_classes, output_first_lines)
+
+
+def sampled_episodes(episodes_set: FewNerdEpisodesSet, seed: Optional[int] = None,
+                     n_episodes: Optional[int] = None) -> Iterator[Tuple[int, FewNerdEpisode]]:
+    """
+    Read episodes in a random stratified order (see episode_sampling.stratified_order),
+    so that the episodes read so far are a stratified sample of the file at any point.
+
+    :param episodes_set: episodes to sample from
+    :param seed: random seed
+    :param n_episodes: max number of episodes to read (all by default)
+    :return: iterator of (episode_id, FewNerdEpisode) pairs
+    """
+    offsets = episodes_set.episode_offsets()
+    for episode_id in islice(stratified_order(read_strata(episodes_set.episode_dicts()), seed), n_episodes):
+        yield episode_id, episodes_set.read_episode(offsets[episode_id])
+
+
 def main(args):
+    check_absent_class_policy(args.absent_class_policy, args.full_labels)
+    profiler = StageProfiler(args.profile)
+
     # Read episode data from file (args.data_file)
-    all_episodes = FewNerdEpisodesSet(args.data_file, args.full_labels_data_path, args.full_labels)
+    with profiler.stage("load_full_labels"):
+        full_labels_dict = load_full_labels(args.full_labels_data_path) \
+            if args.full_labels and args.full_labels_data_path else None
+    all_episodes = FewNerdEpisodesSet(args.data_file, args.full_labels_data_path, args.full_labels,
+                                      full_labels_dict=full_labels_dict)
 
-    # Define instructions (following GPT-NER preprint) and initialize a prompter object
-    system_message = "I am an excellent linguist."
-    instr_messages = {entity_class: f"The task is to label {entity_class} entities "
-                                    "in the given sentence. Below are some examples:"
-                      for entity_class in args.entity_classes}
-    prompter = ClarifaiPrompter(args.user_id, args.app_id, args.pat, args.max_tokens)
+    # Define instructions (following GPT-NER preprint)
+    system_message = SYSTEM_MESSAGE
+    instr_messages = {entity_class: instruction_message(entity_class) for entity_class in args.entity_classes}
 
     # first_episode with 0-based indexing
     first_episode = args.first_episode - 1
     # Calculate ID of the last episode to process based on the first episode and number of episodes.
     # If no number of episodes is given, process all episodes starting from the first episode
     last_episode_id = first_episode + args.n_episodes if args.n_episodes else None
+    if args.sample:
+        episodes = sampled_episodes(all_episodes, args.seed, args.n_episodes)
+    else:
+        episodes = enumerate(islice(all_episodes.episodes, first_episode, last_episode_id), start=first_episode)
+    count_tokens = get_token_counter(args.tokenizer)
+    retriever, packer = build_retriever_and_packer(count_tokens, args.retrieval_k, args.token_budget,
+                                                   args.max_negatives, args.max_sentence_tokens,
+                                                   args.truncate_long_sentences)
+
+    if args.dry_run:
+        with profiler.stage("dry_run"):
+            plan = plan_run(episodes, args.entity_classes, system_message, instr_messages,
+                            count_tokens=count_tokens, max_tokens=args.max_tokens,
+                            concurrency=args.max_workers,
+                            latency_profile=LatencyProfile(*args.latency_profile), retriever=retriever, packer=packer,
+                            absent_class_policy=args.absent_class_policy)
+        logging.info(f"Dry run estimates:\n{format_plan(plan)}")
+        profiler.close()
+        return
 
-    with open(args.output_file, 'w', encoding='utf8') as out_fh:
-        episode_id = first_episode
-        for episode in islice(all_episodes.episodes, first_episode, last_episode_id):
-            results = {episode_id: {"text": {entity_class: [] for entity_class in args.entity_classes},
-                                    "label": {entity_class: [] for entity_class in args.entity_classes}}}
+    # Initialize a prompter object
+    telemetry = Telemetry()
+    hedging = HedgingPolicy(args.hedge_percentile, args.hedge_budget) if args.hedge_percentile else None
+    channels = ChannelPool(args.n_channels, selection=args.channel_selection, keepalive_time_ms=args.keepalive_ms,
+                           compression=args.compression)
+    prompter = ClarifaiPrompter(args.user_id, args.app_id, args.pat, args.max_tokens,
+                                telemetry=telemetry, hedging=hedging, channels=channels)
+    if args.cascade_verify and not (args.cascade_models or args.cascade_reprompt):
+        raise Exception("--cascade_verify needs --cascade_models or --cascade_reprompt to escalate to")
+    cascade = None
+    if args.cascade_models or args.cascade_reprompt:
+        tiers = [CascadeTier(prompter, args.model_id)]
+        for spec in args.cascade_models:
+            user_id, app_id, model_id = parse_model_spec(spec, args.user_id, args.app_id)
+            # Models from other apps need their own prompter; requests still share the channels
+            tier_prompter = prompter if (user_id, app_id) == (args.user_id, args.app_id) else \
+                ClarifaiPrompter(user_id, app_id, args.pat, args.max_tokens, telemetry=telemetry, hedging=hedging,
+                                 channels=channels)
+            tiers.append(CascadeTier(tier_prompter, model_id, reprompt=args.cascade_reprompt))
+        if not args.cascade_models:
+            # Reprompt the same model
+            tiers.append(CascadeTier(prompter, args.model_id, reprompt=True))
+        cascade = ModelCascade(tiers, verify=args.cascade_verify, telemetry=telemetry)
+    estimate = StratifiedF1Estimate(args.entity_classes, confidence=args.confidence,
+                                    n_resamples=args.n_bootstrap, seed=args.seed) if args.sample else None
+    # Episodes with classes to prompt for after all other prompts (with --absent_class_policy defer)
+    deferred = []
+    n_absent_prompts = 0
+
+    with open_text(args.output_file, 'w') as out_fh, \
+            TelemetryExporter(telemetry, args.metrics_file, args.metrics_interval), \
+            ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        for episode_id, episode in profiler.iterate("read_episodes", episodes):
             logging.info(f"Episode {episode_id}")
 
-            raw_texts_ner = []
-            # Iterate over entity classes and create prompts for each,
-            # as the model is prompted to predict one class at a time
-            for entity_class in args.entity_classes:
-                episode.gpt_ner_examples_from_episode(entity_class)
-                raw_texts_ner.extend([
-                    (build_llama2_prompt_plain(few_shot_examples=zip(episode.support_input_examples,
-                                                                     episode.support_output_examples),
-                                               system_msg=system_message,
-                                               instr_msg=instr_messages[entity_class],
-                                               input_example=query_input_example),
-                     (episode_id, entity_class, i))
-                    for i, query_input_example in enumerate(episode.query_input_examples)
-                ])
-
-            threads = []
-            output_first_lines = {entity_class: [] for entity_class in args.entity_classes}
-
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                for raw_text, query_index in tqdm(
-                    raw_texts_ner,
-                    total=len(episode.query_input_examples) * len(args.entity_classes),
-                    desc="Getting predictions (submit)"
-                ):
-                    threads.append(executor.submit(prompter.predict, args.model_id, raw_text, query_index))
-                    # logging.info(f"Raw text: {raw_text}")
-
-                for task in tqdm(as_completed(threads), total=len(raw_texts_ner), desc='Getting predictions (results)'):
-                    result_text, (received_episode_id, entity_class, query_id) = task.result()
-                    # Only use the first line of each output, as the model is prone to over-generation
-                    output_first_lines[entity_class].append((result_text.split('\n')[0], query_id))
-
-            for entity_class in args.entity_classes:
-                episode.gpt_ner_examples_from_episode(entity_class)
-                results[episode_id]["text"][entity_class] = [t[0] for t
-                                                             in sorted(output_first_lines[entity_class],
-                                                                       key=lambda x: x[1])]
-                for output, input_tokens in zip(results[episode_id]["text"][entity_class],
-                                                episode.query_tokens):
-                    # Create a list of labels based on the generated tags; if that fails, return an empty list instead
-                    try:
-                        class_labels = labels_from_output(output, input_tokens, entity_class)
-                    except IndexError:
-                        class_labels = []
-                    results[episode_id]["label"][entity_class].append(class_labels)
-
-                logging.info(f"CLASS: {entity_class}")
-                logging.info(f"OUTPUT (1st lines): {results[episode_id]['text'][entity_class]}")
-                logging.info(f"CORRECT OUTPUT: {episode.query_output_examples}")
-
-            out_fh.write(json.dumps(results) + "\n")
-            episode_id += 1
+            # Classes that cannot occur in the episode are handled according to the absent class policy
+            entity_classes = args.entity_classes
+            absent_classes = []
+            if args.absent_class_policy != "prompt":
+                entity_classes = episode.present_classes(args.entity_classes)
+                absent_classes = [entity_class for entity_class in args.entity_classes
+                                  if entity_class not in entity_classes]
+                n_absent_prompts += len(absent_classes) * len(episode.query_tokens)
+
+            # Create prompts for each entity class, as the model is prompted to predict one class at a time
+            with profiler.stage("build_prompts"):
+                raw_texts_ner = build_episode_prompts(episode, episode_id, entity_classes,
+                                                      system_message, instr_messages, retriever, packer)
+            results = predict_episode(episode, episode_id, raw_texts_ner, prompter, executor,
+                                      args.model_id, entity_classes, profiler=profiler, cascade=cascade)
+            add_absent_classes(results[episode_id], episode, absent_classes, args.absent_class_policy)
+            if args.absent_class_policy == "defer" and absent_classes:
+                deferred.append((episode_id, absent_classes))
+
+            with profiler.stage("write_output"):
+                out_fh.write(dumps(results) + "\n")
+
+            if estimate is not None:
+                with profiler.stage("metrics"):
+                    estimate.add_episode(stratum_key(episode.types, len(episode.query_tokens)),
+                                         episode_counts(episode, results[episode_id], args.entity_classes))
+                    if estimate.n_episodes % args.sample_batch_size == 0:
+                        intervals = estimate.intervals()
+                        logging.info(f"F1-scores after {estimate.n_episodes} episodes:\n"
+                                     f"{estimate.report(args.decimal_places, intervals)}")
+                        _, low, high = intervals["macro"]
+                        if estimate.n_episodes >= args.min_sample_episodes and high - low <= args.target_ci_width:
+                            logging.info(f"Macro F1 interval width {high - low:.3f} is below "
+                                         f"{args.target_ci_width}, stopping")
+                            break
+
+        # Deferred prompts are run once all other prompts are done; episodes are read again by offset
+        deferred_results = {}
+        if deferred:
+            logging.info(f"Running deferred prompts for {len(deferred)} episodes")
+            offsets = all_episodes.episode_offsets()
+            for episode_id, absent_classes in deferred:
+                episode = all_episodes.read_episode(offsets[episode_id])
+                raw_texts_ner = build_episode_prompts(episode, episode_id, absent_classes,
+                                                      system_message, instr_messages, retriever, packer)
+                deferred_results[episode_id] = predict_episode(episode, episode_id, raw_texts_ner, prompter, executor,
+                                                               args.model_id, absent_classes,
+                                                               show_progress=False, cascade=cascade)[episode_id]
+    if deferred_results:
+        merge_deferred_results(args.output_file, deferred_results)
+
+    logging.info(f"Requests: {telemetry.counter_value('fewnerd_requests_total', model=args.model_id):.0f}, "
+                 f"prompt chars: {telemetry.counter_value('fewnerd_prompt_chars_total', model=args.model_id):.0f}, "
+                 f"completion chars: "
+                 f"{telemetry.counter_value('fewnerd_completion_chars_total', model=args.model_id):.0f}, "
+                 f"coalesced: {telemetry.counter_value('fewnerd_coalesced_requests_total', model=args.model_id):.0f}")
+    if cascade is not None:
+        logging.info(f"Cascade tiers:\n{cascade.report()}")
+    if args.absent_class_policy != "prompt":
+        logging.info(f"Prompts for classes absent from their episode ({args.absent_class_policy}): {n_absent_prompts}")
+    if hedging is not None:
+        hedging_stats = hedging.stats()
+        logging.info(f"Hedging: {hedging_stats['hedges_fired']} hedges fired, {hedging_stats['hedges_won']} won, "
+                     f"out of {hedging_stats['calls']} calls")
+    if estimate is not None and estimate.n_episodes:
+        logging.info(f"Final F1-scores from {estimate.n_episodes} sampled episodes:\n"
+                     f"{estimate.report(args.decimal_places)}")
+    profiler.close()
 
 
 if __name__ == '__main__':
@@ -155,12 +421,211 @@ if __name__ == '__main__':
         default=None,
         help='Number of episodes to predict'
     )
+    parser.add_argument(
+        '--absent_class_policy',
+        type=str,
+        default='prompt',
+        choices=['prompt', 'skip', 'fill', 'defer'],
+        help='What to do with entity classes that do not occur among the types of an episode: prompt for them anyway, '
+             'skip them (they are listed as "skipped" in the output and not evaluated), fill their labels with "O", '
+             'or defer their prompts until all other prompts are done (skip and fill cannot be used with --full_labels)'
+    )
+    parser.add_argument(
+        '--sample',
+        default=False,
+        action='store_true',
+        help='Predict episodes in a random order stratified by episode types and sizes (instead of a contiguous '
+             'slice), reporting F1-scores with confidence intervals and stopping when they are narrow enough. '
+             '--first_episode is not used; --n_episodes is the max sample size.'
+    )
+    parser.add_argument(
+        '--sample_batch_size',
+        type=int,
+        default=50,
+        help='With --sample, update the F1 estimates every N episodes'
+    )
+    parser.add_argument(
+        '--target_ci_width',
+        type=float,
+        default=0.05,
+        help='With --sample, stop when the confidence interval of the macro F1-score is at most this wide'
+    )
+    parser.add_argument(
+        '--min_sample_episodes',
+        type=int,
+        default=100,
+        help='With --sample, predict at least this many episodes before stopping'
+    )
+    parser.add_argument(
+        '--confidence',
+        type=float,
+        default=0.95,
+        help='With --sample, confidence level of the intervals'
+    )
+    parser.add_argument(
+        '--n_bootstrap',
+        type=int,
+        default=1000,
+        help='With --sample, number of bootstrap samples for the confidence intervals'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help='With --sample, random seed for sampling episodes and bootstrap samples'
+    )
+    parser.add_argument(
+        '--decimal_places',
+        type=int,
+        default=3,
+        help='Round F1-scores reported with --sample to N decimal places'
+    )
     parser.add_argument(
         '--max_tokens',
         type=int,
         default=100,
         help="Max number of tokens to generate"
     )
+    parser.add_argument(
+        '--retrieval_k',
+        type=int,
+        default=None,
+        help='Use only the K support sentences most similar to each query as demonstrations '
+             '(by default, the whole support set is used)'
+    )
+    parser.add_argument(
+        '--token_budget',
+        type=int,
+        default=None,
+        help='Max number of tokens per prompt; support sentences that do not fit are left out'
+    )
+    parser.add_argument(
+        '--max_negatives',
+        type=int,
+        default=None,
+        help='Max number of support sentences without the prompted class to use as examples'
+    )
+    parser.add_argument(
+        '--max_sentence_tokens',
+        type=int,
+        default=None,
+        help='Drop (or truncate, with --truncate_long_sentences) support sentences longer than this many tokens'
+    )
+    parser.add_argument(
+        '--truncate_long_sentences',
+        default=False,
+        action='store_true',
+        help='Truncate support sentences longer than --max_sentence_tokens instead of dropping them'
+    )
+    parser.add_argument(
+        '--max_workers',
+        type=int,
+        default=10,
+        help='Number of concurrent requests to the model'
+    )
+    parser.add_argument(
+        '--n_channels',
+        type=int,
+        default=1,
+        help='Number of gRPC channels (connections) to spread requests over'
+    )
+    parser.add_argument(
+        '--channel_selection',
+        type=str,
+        default='round_robin',
+        choices=['round_robin', 'least_loaded'],
+        help='How to choose a channel for each request'
+    )
+    parser.add_argument(
+        '--keepalive_ms',
+        type=int,
+        default=None,
+        help='Interval of gRPC keepalive pings in milliseconds (no keepalive pings if not set)'
+    )
+    parser.add_argument(
+        '--compression',
+        type=str,
+        default=None,
+        choices=['gzip', 'deflate'],
+        help='Compress request messages'
+    )
+    parser.add_argument(
+        '--cascade_models',
+        type=str,
+        nargs='+',
+        default=[],
+        help='Larger models (MODEL_ID or USER_ID/APP_ID/MODEL_ID) to send prompts to, in order, '
+             'when the output of the previous model is malformed or does not match the input sentence'
+    )
+    parser.add_argument(
+        '--cascade_reprompt',
+        default=False,
+        action='store_true',
+        help='Repeat escalated prompts with the rejected output and the problem with it; '
+             'without --cascade_models, the same model is reprompted once'
+    )
+    parser.add_argument(
+        '--cascade_verify',
+        default=False,
+        action='store_true',
+        help='Also escalate outputs with an entity the model does not confirm when asked to verify it '
+             '(one extra request per predicted entity)'
+    )
+    parser.add_argument(
+        '--hedge_percentile',
+        type=float,
+        default=None,
+        help='Send a duplicate request when a call takes longer than this percentile of recent latencies '
+             '(e.g. 95); no hedging if not set'
+    )
+    parser.add_argument(
+        '--hedge_budget',
+        type=float,
+        default=0.05,
+        help='Max number of hedged requests as a fraction of all calls'
+    )
+    parser.add_argument(
+        '--dry_run',
+        default=False,
+        action='store_true',
+        help='Build all prompts and estimate tokens, calls and wall time without calling the model.'
+    )
+    parser.add_argument(
+        '--tokenizer',
+        type=str,
+        default='chars',
+        help='Token counter for --dry_run and prompt packing: whitespace, chars (~4 characters per token), nltk, '
+             'or hf:MODEL_NAME'
+    )
+    parser.add_argument(
+        '--latency_profile',
+        type=float,
+        nargs=3,
+        default=[0.5, 0.0005, 0.03],
+        metavar=('BASE', 'PER_INPUT_TOKEN', 'PER_OUTPUT_TOKEN'),
+        help='Latency model for --dry_run, in seconds: base + per input token + per output token'
+    )
+    parser.add_argument(
+        '--metrics_file',
+        type=str,
+        default=None,
+        help='File to periodically write request metrics to (JSON if it ends with .json, Prometheus text otherwise)'
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        type=float,
+        default=15.0,
+        help='Seconds between metrics file updates'
+    )
+
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default=None,
+        metavar='DIR',
+        help='Time and profile each stage (reading, prompt building, network, parsing, writing), '
+             'writing a summary, pstats files and a memory report to DIR. Slows the run down.'
+    )
 
     arguments = parser.parse_args()
     main(arguments)
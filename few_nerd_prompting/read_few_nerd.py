@@ -1,88 +1,207 @@
 import os
-import json
+import sys
+import shutil
+import tempfile
+import threading
 
-from typing import Generator, Dict, List, Optional
+from array import array
+from typing import Generator, Dict, Iterable, List, Optional, Tuple
 
+from io_utils import BUFFER_SIZE, is_compressed, loads, open_binary, open_text, read_line_at
 from prompt_building_utils import make_output_example
 
 
-def preprocess_file_to_dict(file_paths: List[str]) -> Dict[str, Dict[str, List[str]]]:
+class LabelVocabulary:
+    """
+    Shared vocabulary of label strings. Each distinct label (e.g. "O", "art-music") gets a small integer id,
+    so that label sequences can be stored as compact arrays of unsigned bytes instead of lists of strings.
+    """
+    __slots__ = ("_label_to_id", "_id_to_label")
+
+    def __init__(self):
+        self._label_to_id = {}
+        self._id_to_label = []
+
+    def __len__(self) -> int:
+        return len(self._id_to_label)
+
+    def encode(self, labels: Iterable[str]) -> array:
+        """
+        Encode a sequence of label strings, adding unseen labels to the vocabulary.
+
+        :param labels: list of token labels
+        :return: array('B') of label ids
+        """
+        label_ids = array('B')
+        for label in labels:
+            label_id = self._label_to_id.get(label)
+            if label_id is None:
+                label_id = len(self._id_to_label)
+                if label_id > 255:
+                    raise ValueError("Label vocabulary does not fit into unsigned bytes (more than 256 labels)")
+                self._label_to_id[label] = label_id
+                self._id_to_label.append(sys.intern(label))
+            label_ids.append(label_id)
+        return label_ids
+
+    def decode(self, label_ids: Iterable[int]) -> List[str]:
+        """
+        Decode a sequence of label ids back into label strings.
+
+        :param label_ids: sequence of label ids
+        :return: list of token labels
+        """
+        return [self._id_to_label[label_id] for label_id in label_ids]
+
+
+# Labels are shared between all episodes and the full labels table
+LABEL_VOCABULARY = LabelVocabulary()
+
+
+def intern_tokens(tokens: Iterable[str]) -> Tuple[str, ...]:
+    """
+    Intern token strings so that tokens repeated across sentences and episodes share one string object.
+
+    :param tokens: list of tokens
+    :return: tuple of interned tokens
+    """
+    return tuple(sys.intern(token) for token in tokens)
+
+
+def read_token_file(file_path: str) -> Generator[Tuple[List[str], List[str]], None, None]:
+    """
+    Stream sentences from a text file with one token and its label per line (sentences separated by blank lines).
+    The file may be compressed (.gz or .zst).
+
+    :param file_path: path to the text file
+    :return: generator of (tokens, labels) pairs, one per sentence
+    """
+    current_words = []
+    current_labels = []
+    with open_text(file_path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                if current_words:
+                    yield current_words, current_labels
+                    current_words = []
+                    current_labels = []
+            else:
+                token, tag = line.rsplit(maxsplit=1)
+                current_words.append(token)
+                current_labels.append(tag)
+
+    # Yield the last sentence if the file doesn't end with a blank line
+    if current_words:
+        yield current_words, current_labels
+
+
+def preprocess_file_to_dict(file_paths: List[str]) -> Dict[str, array]:
     """
     Process a list of text files where each file contains lines of tokens and their corresponding labels.
     Sentences are separated by blank lines. The function creates a dictionary where each key is a sentence
-    and the value is another dictionary containing the tokens and their corresponding labels.
+    (lowercased tokens joined with spaces) and the value is the sentence's label sequence,
+    encoded with the shared LABEL_VOCABULARY.
 
     :param file_paths: list of paths to the text files to be processed
-    :return: dictionary with sentences as keys and inner dictionaries as values,
-             each inner dictionary has two keys:
-             - 'word': a list of tokens in the sentence,
-             - 'label': a list of corresponding token labels
+    :return: dictionary with sentences as keys and array('B') of label ids as values
     """
     sentence_dict = {}
-    current_words = []
-    current_labels = []
 
     for file_path in file_paths:
-        with open(file_path, 'r') as file:
-            for line in file:
-                line = line.strip()
-                if not line:
-                    if current_words:
-                        sentence_str = ' '.join(current_words).lower()
-                        sentence_dict[sentence_str] = {"word": current_words, "label": current_labels}
-                        current_words = []
-                        current_labels = []
-                else:
-                    token, tag = line.rsplit(maxsplit=1)
-                    current_words.append(token.lower())
-                    current_labels.append(tag)
-
-            # Append the last sentence if the file doesn't end with a blank line
-            if current_words:
-                sentence_str = ' '.join(current_words)
-                sentence_dict[sentence_str] = {"word": current_words, "label": current_labels}
+        for words, labels in read_token_file(file_path):
+            sentence_str = ' '.join(words).lower()
+            sentence_dict[sentence_str] = LABEL_VOCABULARY.encode(labels)
 
     return sentence_dict
 
 
 class FewNerdEpisode:
+    """
+    Compact in-memory representation of a Few-NERD episode.
+    Tokens are stored as tuples of interned strings and labels as array('B') of ids from LABEL_VOCABULARY;
+    joined sentence strings and label strings are only materialised on demand.
+    """
+    __slots__ = ("types", "support_tokens", "support_label_ids", "query_tokens", "query_label_ids",
+                 "support_output_examples", "query_output_examples")
+
     def __init__(self, episode_dict: Dict,
-                 full_labels_dict: Optional[Dict[str, Dict[str, List[str]]]],
+                 full_labels_dict: Optional[Dict[str, array]],
                  full_labels: bool = True):
-        self.support_set = episode_dict['support']
-        self.query_set = episode_dict['query']
+        support_set = episode_dict['support']
+        query_set = episode_dict['query']
 
-        self.query_tokens = self.query_set['word']
+        self.types = intern_tokens(episode_dict.get('types', []))
+        self.support_tokens = tuple(intern_tokens(sentence) for sentence in support_set['word'])
+        self.query_tokens = tuple(intern_tokens(sentence) for sentence in query_set['word'])
+
+        if full_labels:
+            # Label arrays are shared with the full labels table rather than copied
+            self.support_label_ids = tuple(full_labels_dict[' '.join(sentence)] for sentence in self.support_tokens)
+            self.query_label_ids = tuple(full_labels_dict[' '.join(sentence)] for sentence in self.query_tokens)
+        else:
+            self.support_label_ids = tuple(LABEL_VOCABULARY.encode(labels) for labels in support_set['label'])
+            self.query_label_ids = tuple(LABEL_VOCABULARY.encode(labels) for labels in query_set['label'])
 
-        self.support_input_examples = [' '.join(sentence) for sentence in self.support_set['word']]
-        self.query_input_examples = [' '.join(sentence) for sentence in self.query_set['word']]
         self.support_output_examples, self.query_output_examples = None, None
 
-        if full_labels:
-            self.support_set['label'], self.query_set['label'] = [], []
-            for sentence_text in self.support_input_examples:
-                self.support_set['label'].append(full_labels_dict[sentence_text]['label'])
-            for sentence_text in self.query_input_examples:
-                self.query_set['label'].append(full_labels_dict[sentence_text]['label'])
+    @property
+    def support_input_examples(self) -> List[str]:
+        return [' '.join(sentence) for sentence in self.support_tokens]
+
+    @property
+    def query_input_examples(self) -> List[str]:
+        return [' '.join(sentence) for sentence in self.query_tokens]
 
-        self.query_labels = self.query_set['label']
+    @property
+    def support_labels(self) -> List[List[str]]:
+        return [LABEL_VOCABULARY.decode(label_ids) for label_ids in self.support_label_ids]
+
+    @property
+    def query_labels(self) -> List[List[str]]:
+        return [LABEL_VOCABULARY.decode(label_ids) for label_ids in self.query_label_ids]
+
+    def present_classes(self, entity_classes: List[str]) -> List[str]:
+        """
+        Keep the coarse-grained entity classes that occur among the episode's (fine-grained) types,
+        e.g. "location" for "location-GPE". All classes are kept if the episode has no types.
+
+        :param entity_classes: coarse-grained entity classes
+        :return: classes present in the episode, in the given order
+        """
+        if not self.types:
+            return list(entity_classes)
+        coarse_types = {entity_type.split("-")[0] for entity_type in self.types}
+        return [entity_class for entity_class in entity_classes if entity_class in coarse_types]
 
     def gpt_ner_examples_from_episode(self, entity_class: str):
         self.support_output_examples = [make_output_example(sentence, labels, entity_class)
-                                        for sentence, labels in
-                                        zip(self.support_set['word'], self.support_set['label'])]
+                                        for sentence, labels in zip(self.support_tokens, self.support_labels)]
 
         self.query_output_examples = [make_output_example(sentence, labels, entity_class)
-                                      for sentence, labels in zip(self.query_set['word'], self.query_set['label'])]
+                                      for sentence, labels in zip(self.query_tokens, self.query_labels)]
+
+
+def load_full_labels(full_labels_path: str) -> Dict[str, array]:
+    """
+    Load labels from the supervised task for all splits (see preprocess_file_to_dict).
+
+    :param full_labels_path: path to the directory with train.txt, dev.txt and test.txt
+    :return: dictionary with sentences as keys and array('B') of label ids as values
+    """
+    return preprocess_file_to_dict([f"{full_labels_path}/{split}.txt" for split in ["train", "dev", "test"]])
 
 
 class FewNerdEpisodesSet:
-    def __init__(self, filename: str, full_labels_path: Optional[str], full_labels: bool = False):
+    def __init__(self, filename: str, full_labels_path: Optional[str], full_labels: bool = False,
+                 full_labels_dict: Optional[Dict[str, array]] = None):
         self.full_labels = full_labels
-        if self.full_labels and not full_labels_path:
+        if self.full_labels and not full_labels_path and full_labels_dict is None:
             raise Exception("File with full dataset labels not provided")
-        all_label_files = [f"{full_labels_path}/{split}.txt" for split in ["train", "dev", "test"]]
-        self.full_labels_dict = preprocess_file_to_dict(all_label_files) if full_labels else None
+        # An already loaded full labels table can be shared between several episode sets
+        if full_labels and full_labels_dict is None:
+            full_labels_dict = load_full_labels(full_labels_path)
+        self.full_labels_dict = full_labels_dict if full_labels else None
 
         self.filename = filename
         # The below code assumes file names as in the original FewNERD structure,
@@ -97,9 +216,81 @@ class FewNerdEpisodesSet:
         self.n_shot = os.path.basename(filename).split("_")[2].split(".")[0]
 
         self.episodes = self.read_file()
+        # Decompressed copy of a compressed file for reading episodes by offset, see read_episode
+        self._decompressed_copy = None
+        self._decompressed_copy_lock = threading.Lock()
+
+    def episode_dicts(self) -> Generator[Dict, None, None]:
+        """
+        Stream the episodes of the file as parsed JSON, without building FewNerdEpisode objects.
+        The file may be compressed (.gz or .zst).
+
+        :return: generator of episode dictionaries
+        """
+        with open_text(self.filename) as json_file:
+            for line in json_file:
+                if line.strip():
+                    yield loads(line)
 
     def read_file(self) -> Generator[FewNerdEpisode, None, None]:
-        with open(self.filename, 'r', encoding='utf8') as json_file:
+        for episode_dict in self.episode_dicts():
+            yield FewNerdEpisode(episode_dict, self.full_labels_dict, self.full_labels)
+
+    def _random_access_file(self):
+        """
+        Decompress a compressed episode file once into a temporary file that supports seeking,
+        so that reading episodes by offset does not decompress the file from the start every time.
+        The temporary file is deleted when it is closed, at the latest when the episode set is garbage collected.
+
+        :return: open binary temporary file
+        """
+        with self._decompressed_copy_lock:
+            if self._decompressed_copy is None:
+                copy = tempfile.TemporaryFile()
+                with open_binary(self.filename) as json_file:
+                    shutil.copyfileobj(json_file, copy, BUFFER_SIZE)
+                self._decompressed_copy = copy
+            return self._decompressed_copy
+
+    def episode_offsets(self) -> array:
+        """
+        Find where each episode starts in the file, so that episodes can be read by ID without parsing the whole file.
+        For compressed files, offsets are in the uncompressed contents.
+
+        :return: array of byte offsets, indexed by episode ID (0-based)
+        """
+        offsets = array('Q')
+
+        def add_offsets(json_file):
+            offset = 0
             for line in json_file:
-                episode = FewNerdEpisode(json.loads(line.strip()), self.full_labels_dict, self.full_labels)
-                yield episode
+                if line.strip():
+                    offsets.append(offset)
+                offset += len(line)
+
+        if is_compressed(self.filename):
+            json_file = self._random_access_file()
+            with self._decompressed_copy_lock:
+                json_file.seek(0)
+                add_offsets(json_file)
+        else:
+            with open_binary(self.filename) as json_file:
+                add_offsets(json_file)
+        return offsets
+
+    def read_episode(self, offset: int) -> FewNerdEpisode:
+        """
+        Read a single episode starting at the given byte offset (see episode_offsets).
+        Compressed files are decompressed into a temporary file on first use.
+
+        :param offset: byte offset of the episode in the file
+        :return: FewNerdEpisode object
+        """
+        if is_compressed(self.filename):
+            json_file = self._random_access_file()
+            with self._decompressed_copy_lock:
+                json_file.seek(offset)
+                line = json_file.readline()
+        else:
+            line = read_line_at(self.filename, offset)
+        return FewNerdEpisode(loads(line), self.full_labels_dict, self.full_labels)
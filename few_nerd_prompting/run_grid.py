@@ -0,0 +1,262 @@
+import os
+import csv
+import json
+import argparse
+import logging
+
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, FrozenSet, List, Tuple
+
+from io_utils import dumps, open_text
+from read_few_nerd import FewNerdEpisodesSet, load_full_labels
+from clarifai_prompter import ClarifaiPrompter, ChannelPool, LRUCache
+from telemetry import Telemetry, TelemetryExporter
+from evaluate_outputs import count_file_matches, encode_ground_truth, scores_from_counts
+from prompt_building_utils import SYSTEM_MESSAGE, build_episode_prompts, get_token_counter, instruction_message
+from prompt_llm import build_retriever_and_packer, predict_episode
+
+logging.basicConfig(format="{asctime} {levelname}: {message}",
+                    style="{", level=logging.INFO)
+
+# Prompt variant options, passed to build_retriever_and_packer
+VARIANT_OPTIONS = ["retrieval_k", "token_budget", "max_negatives", "max_sentence_tokens", "truncate_long_sentences"]
+
+
+def read_manifest(filename: str) -> Dict:
+    """
+    Read a JSON manifest describing the experiment grid, e.g.
+    {
+        "episode_files": ["Few-NERD/data/episode-data/inter/dev_5_1.jsonl", ...],
+        "entity_classes": ["person", "location", ...],
+        "models": [{"user_id": "meta", "app_id": "Llama-2", "model_id": "llama2-7b-chat"}],
+        "prompt_variants": [{"name": "full_support"}, {"name": "knn_3", "retrieval_k": 3}],
+        "output_dir": "grid_outputs"
+    }
+    Optional keys: "full_labels_data_path" (use full labels from the supervised task), "first_episode",
+    "n_episodes", "max_tokens", "tokenizer", "max_workers", "n_channels", "channel_selection",
+    "cache_size" (max number of model outputs kept for identical prompts).
+
+    :param filename: path to the manifest
+    :return: manifest with default values filled in
+    """
+    with open(filename, 'r', encoding='utf8') as fh:
+        manifest = json.load(fh)
+    for key in ["episode_files", "entity_classes", "models"]:
+        if not manifest.get(key):
+            raise Exception(f"Manifest {filename} has no {key}")
+    manifest.setdefault("prompt_variants", [{"name": "default"}])
+    manifest.setdefault("output_dir", "grid_outputs")
+    manifest.setdefault("full_labels_data_path", None)
+    manifest.setdefault("first_episode", 1)
+    manifest.setdefault("n_episodes", None)
+    manifest.setdefault("max_tokens", 100)
+    manifest.setdefault("tokenizer", "chars")
+    manifest.setdefault("max_workers", 10)
+    manifest.setdefault("n_channels", 1)
+    manifest.setdefault("channel_selection", "round_robin")
+    manifest.setdefault("cache_size", 100000)
+    for model in manifest["models"]:
+        model.setdefault("user_id", "meta")
+        model.setdefault("app_id", "Llama-2")
+    # Configurations are named after their model and variant, so that each one has its own output file
+    variant_names = [variant.get("name") for variant in manifest["prompt_variants"]]
+    if None in variant_names or len(set(variant_names)) < len(variant_names):
+        raise Exception(f"Prompt variants in {filename} need unique names")
+    models = [(model["user_id"], model["app_id"], model["model_id"]) for model in manifest["models"]]
+    if len(set(models)) < len(models):
+        raise Exception(f"Models in {filename} are listed more than once")
+    for variant in manifest["prompt_variants"]:
+        unknown_options = set(variant) - set(VARIANT_OPTIONS) - {"name"}
+        if unknown_options:
+            raise Exception(f"Unknown options in prompt variant {variant.get('name')}: {sorted(unknown_options)}")
+    return manifest
+
+
+def configuration_name(episodes_set: FewNerdEpisodesSet, model: Dict, variant: Dict) -> str:
+    return (f"{episodes_set.task_type}_{episodes_set.split}_{episodes_set.n_way}_{episodes_set.n_shot}"
+            f"__{model['user_id']}_{model['app_id']}_{model['model_id']}__{variant['name']}")
+
+
+def run_configuration(episodes_set: FewNerdEpisodesSet, model: Dict, variant: Dict, manifest: Dict,
+                      prompter: ClarifaiPrompter, executor: ThreadPoolExecutor, output_file: str) -> None:
+    """
+    Predict labels for one episode file with one model and prompt variant, writing results as prompt_llm.py does.
+    Requests are sent to the shared executor, which limits the number of concurrent requests across all configurations.
+
+    :param episodes_set: episodes to predict for
+    :param model: model description from the manifest
+    :param variant: prompt variant from the manifest
+    :param manifest: experiment manifest
+    :param prompter: ClarifaiPrompter for the model's user and app
+    :param executor: executor shared by all configurations
+    :param output_file: path to the prediction file
+    """
+    entity_classes = manifest["entity_classes"]
+    instr_messages = {entity_class: instruction_message(entity_class) for entity_class in entity_classes}
+    retriever, packer = build_retriever_and_packer(get_token_counter(manifest["tokenizer"]),
+                                                   **{option: variant[option]
+                                                      for option in VARIANT_OPTIONS if option in variant})
+
+    first_episode = manifest["first_episode"] - 1
+    last_episode_id = first_episode + manifest["n_episodes"] if manifest["n_episodes"] else None
+    with open_text(output_file, 'w') as out_fh:
+        for episode_id, episode in enumerate(islice(episodes_set.episodes, first_episode, last_episode_id),
+                                             start=first_episode):
+            raw_texts_ner = build_episode_prompts(episode, episode_id, entity_classes, SYSTEM_MESSAGE,
+                                                  instr_messages, retriever, packer)
+            results = predict_episode(episode, episode_id, raw_texts_ner, prompter, executor,
+                                      model["model_id"], entity_classes, show_progress=False)
+            out_fh.write(dumps(results) + "\n")
+    logging.info(f"Finished {os.path.basename(output_file)}")
+
+
+def configuration_scores(output_file: str, ground_truth: Dict[int, Dict[str, List[FrozenSet[Tuple[int, int]]]]],
+                         entity_classes: List[str]) -> Dict[str, float]:
+    """
+    Calculate the F1-score of each class and their macro average for one prediction file.
+
+    :param output_file: path to the prediction file
+    :param ground_truth: true entity spans of the configuration's episode file, see encode_ground_truth
+    :param entity_classes: entity classes
+    :return: dictionary mapping entity classes and "macro" to F1-scores
+    """
+    _, counts = count_file_matches(output_file, ground_truth, entity_classes)
+    scores = {entity_class: scores_from_counts(*counts[entity_class])["f1"] for entity_class in entity_classes}
+    scores["macro"] = sum(scores.values()) / len(entity_classes)
+    return scores
+
+
+def format_table(rows: List[Dict], entity_classes: List[str], round_to: int) -> str:
+    """
+    Format F1-scores as a table of configurations x entity classes.
+
+    :param rows: one row per configuration, with an F1-score for each class and the macro average
+    :param entity_classes: entity classes
+    :param round_to: max decimal places for scores
+    :return: table as a string
+    """
+    columns = entity_classes + ["macro"]
+    name_width = max([len(row["configuration"]) for row in rows] + [len("configuration")])
+    lines = [f"{'configuration':<{name_width}} " + " ".join(f"{column:>10}" for column in columns)]
+    for row in rows:
+        lines.append(f"{row['configuration']:<{name_width}} "
+                     + " ".join(f"{round(row[column], round_to):>10}" for column in columns))
+    return "\n".join(lines)
+
+
+def main(args):
+    manifest = read_manifest(args.manifest)
+    os.makedirs(manifest["output_dir"], exist_ok=True)
+    entity_classes = manifest["entity_classes"]
+
+    # Shared data is loaded once for all configurations
+    full_labels = manifest["full_labels_data_path"] is not None
+    full_labels_dict = load_full_labels(manifest["full_labels_data_path"]) if full_labels else None
+
+    telemetry = Telemetry()
+    # Identical prompts (e.g. from variants that do not change some prompts) are only sent once per model
+    cache = LRUCache(manifest["cache_size"])
+    # All prompters send requests over the same connections
+    channels = ChannelPool(manifest["n_channels"], selection=manifest["channel_selection"])
+    prompters = {}
+    for model in manifest["models"]:
+        prompter_key = (model["user_id"], model["app_id"])
+        if prompter_key not in prompters:
+            prompters[prompter_key] = ClarifaiPrompter(model["user_id"], model["app_id"], args.pat,
+                                                       manifest["max_tokens"], telemetry=telemetry, cache=cache,
+                                                       channels=channels)
+
+    configurations = []
+    for episode_file in manifest["episode_files"]:
+        for model in manifest["models"]:
+            for variant in manifest["prompt_variants"]:
+                episodes_set = FewNerdEpisodesSet(episode_file, manifest["full_labels_data_path"], full_labels,
+                                                  full_labels_dict=full_labels_dict)
+                name = configuration_name(episodes_set, model, variant)
+                configurations.append((name, episode_file, episodes_set, model, variant,
+                                       os.path.join(manifest["output_dir"], f"{name}.jsonl")))
+    names = [configuration[0] for configuration in configurations]
+    if len(set(names)) < len(names):
+        # E.g. two episode files with the same name in different directories
+        raise Exception(f"Configurations with the same name (and output file): "
+                        f"{sorted({name for name in names if names.count(name) > 1})}")
+    logging.info(f"Running {len(configurations)} configurations")
+
+    # One executor limits concurrent requests globally; configurations are driven by their own threads
+    with TelemetryExporter(telemetry, args.metrics_file, args.metrics_interval), \
+            ThreadPoolExecutor(max_workers=manifest["max_workers"]) as executor, \
+            ThreadPoolExecutor(max_workers=args.max_parallel_configurations or len(configurations)) as drivers:
+        runs = [drivers.submit(run_configuration, episodes_set, model, variant, manifest,
+                               prompters[(model["user_id"], model["app_id"])], executor, output_file)
+                for _, _, episodes_set, model, variant, output_file in configurations]
+        for run in runs:
+            run.result()
+
+    rows = []
+    # The ground truth of each episode file is read once and shared by all its configurations
+    ground_truths = {}
+    for name, episode_file, episodes_set, model, variant, output_file in configurations:
+        if episode_file not in ground_truths:
+            ground_truths[episode_file] = encode_ground_truth(episode_file, entity_classes, full_labels,
+                                                              manifest["full_labels_data_path"], full_labels_dict)
+        row = {"configuration": name, "episode_file": episode_file, "task_type": episodes_set.task_type,
+               "split": episodes_set.split, "n_way": episodes_set.n_way, "n_shot": episodes_set.n_shot,
+               "model": model["model_id"], "variant": variant["name"]}
+        row.update(configuration_scores(output_file, ground_truths[episode_file], entity_classes))
+        rows.append(row)
+
+    metrics_table = os.path.join(manifest["output_dir"], "metrics.csv")
+    with open(metrics_table, 'w', encoding='utf8', newline='') as fh:
+        writer = csv.DictWriter(fh, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    logging.info(f"F1-scores (also written to {metrics_table}):\n"
+                 f"{format_table(rows, entity_classes, args.decimal_places)}")
+    model_ids = {model["model_id"] for model in manifest["models"]}
+    requests = sum(telemetry.counter_value("fewnerd_requests_total", model=model_id) for model_id in model_ids)
+    cache_hits = sum(telemetry.counter_value("fewnerd_cache_hits_total", model=model_id) for model_id in model_ids)
+    coalesced = sum(telemetry.counter_value("fewnerd_coalesced_requests_total", model=model_id)
+                    for model_id in model_ids)
+    logging.info(f"Requests: {requests:.0f}, cache hits: {cache_hits:.0f}, coalesced: {coalesced:.0f}")
+
+
+if __name__ == '__main__':
+    # Add arguments to argparser
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-t', '--pat',
+        type=str,
+        help='Personal Access Token.')
+    parser.add_argument(
+        '-g', '--manifest',
+        type=str,
+        help='JSON file describing episode files, models and prompt variants to run.'
+    )
+    parser.add_argument(
+        '--max_parallel_configurations',
+        type=int,
+        default=None,
+        help='Max number of configurations to run at the same time (all by default).'
+    )
+    parser.add_argument(
+        '-d', '--decimal_places',
+        default=3,
+        type=int,
+        help='Round scores in output to N decimal places.'
+    )
+    parser.add_argument(
+        '--metrics_file',
+        type=str,
+        default=None,
+        help='File to periodically write request metrics to (JSON if it ends with .json, Prometheus text otherwise)'
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        type=float,
+        default=15.0,
+        help='Seconds between metrics file updates'
+    )
+
+    arguments = parser.parse_args()
+    main(arguments)
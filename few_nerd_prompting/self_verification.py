@@ -1,13 +1,14 @@
 import argparse
 import logging
-import json
 
 # from concurrent.futures import ThreadPoolExecutor, as_completed
 # from tqdm import tqdm
 
+from io_utils import loads, open_text
 from read_few_nerd import FewNerdEpisodesSet
 from clarifai_prompter import ClarifaiPrompter
-from prompt_building_utils import build_self_verification_prompt_plain, extract_predicted_entities
+from prompt_building_utils import (build_self_verification_prompt_plain, extract_predicted_entities,
+                                   verification_system_message)
 
 logging.basicConfig(format="{asctime} {levelname}: {message}",
                     style="{", level=logging.INFO)
@@ -15,23 +16,23 @@ logging.basicConfig(format="{asctime} {levelname}: {message}",
 
 def read_input_file(filename):
     input_episodes = []
-    with open(filename, 'r', encoding="utf8") as fh:
-        for line in fh.readlines():
-            input_episodes.append(json.loads(line.strip()))
+    with open_text(filename) as fh:
+        for line in fh:
+            # Each line maps the episode ID to its results
+            input_episodes.append(list(loads(line).values())[0])
     return input_episodes
 
 
 def main(args):
-    raw_episodes = FewNerdEpisodesSet(args.raw_data_file).episodes
+    raw_episodes = FewNerdEpisodesSet(args.raw_data_file, full_labels_path=None).episodes
     pred_episodes = read_input_file(args.pred_data_file)
 
     # Predicted classes should be the same for each episode
     entity_classes = list(pred_episodes[0]["text"].keys())
 
-    system_messages_verification = {entity_class: f"The task is to verify whether the word is a "
-                                    f"{entity_class} entity extracted from the given sentence"
+    system_messages_verification = {entity_class: verification_system_message(entity_class)
                                     for entity_class in entity_classes}
-    prompter = ClarifaiPrompter(args.user_id, args.app_id, args.pat)
+    prompter = ClarifaiPrompter(args.user_id, args.app_id, args.pat, args.max_tokens)
 
     with open(args.output_file, 'w', encoding='utf8') as out_fh:
 
@@ -107,6 +108,12 @@ if __name__ == '__main__':
         type=str,
         help='Output file.'
     )
+    parser.add_argument(
+        '--max_tokens',
+        type=int,
+        default=100,
+        help="Max number of tokens to generate"
+    )
     parser.add_argument(
         '--max_episodes',
         default=10,
@@ -0,0 +1,334 @@
+import os
+import argparse
+import logging
+
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+from tqdm import tqdm
+
+from io_utils import dumps, is_compressed, loads, open_text
+from read_few_nerd import read_token_file
+from clarifai_prompter import ClarifaiPrompter, ChannelPool
+from telemetry import Telemetry, TelemetryExporter
+from prompt_llm import build_retriever_and_packer
+from prompt_building_utils import (SYSTEM_MESSAGE, PromptPacker, build_llama2_prompt_plain_prefix,
+                                   build_prompt_from_prefix, get_token_counter, instruction_message,
+                                   labels_from_output, make_output_example)
+
+logging.basicConfig(format="{asctime} {levelname}: {message}",
+                    style="{", level=logging.INFO)
+
+
+def class_prompt_prefixes(demonstrations: List[Tuple[List[str], List[str]]], entity_classes: List[str],
+                          system_msg: str, instr_messages: Dict[str, str],
+                          packer: Optional[PromptPacker] = None) -> Dict[str, str]:
+    """
+    Build the part of the prompt shared by all sentences for each entity class:
+    system and instruction messages followed by the few-shot examples from a fixed demonstration pool.
+    With a packer, the examples are chosen per class; the token budget then covers the prefix only.
+
+    :param demonstrations: (tokens, labels) pairs of the demonstration pool
+    :param entity_classes: entity classes to prompt for
+    :param system_msg: system message
+    :param instr_messages: dictionary mapping entity classes to instruction messages
+    :param packer: optional PromptPacker choosing the few-shot examples of each class
+    :return: dictionary mapping entity classes to prompt prefixes
+    """
+    prefixes = {}
+    for entity_class in entity_classes:
+        if packer is not None:
+            examples = packer.pack(demonstrations, entity_class,
+                                   build_llama2_prompt_plain_prefix([], system_msg, instr_messages[entity_class]))
+        else:
+            examples = [(' '.join(tokens), make_output_example(tokens, labels, entity_class))
+                        for tokens, labels in demonstrations]
+        prefixes[entity_class] = build_llama2_prompt_plain_prefix(examples, system_msg, instr_messages[entity_class])
+    return prefixes
+
+
+def resume_offset(output_file: str) -> Optional[int]:
+    """
+    Find the sentence to resume tagging from: the one after the last sentence written to an output file.
+    An incomplete last line (e.g. from an interrupted run) is removed from the file.
+
+    :param output_file: path to the output file
+    :return: sentence ID (0-based position in the corpus), or None if no sentence has been written
+    """
+    if not os.path.exists(output_file):
+        return None
+    last_line = None
+    last_line_end = 0
+    with open(output_file, 'rb') as fh:
+        position = 0
+        for line in fh:
+            position += len(line)
+            if line.endswith(b"\n"):
+                last_line = line
+                last_line_end = position
+    if last_line_end < os.path.getsize(output_file):
+        logging.warning(f"Removing an incomplete line at the end of {output_file}")
+        with open(output_file, 'r+b') as fh:
+            fh.truncate(last_line_end)
+    return loads(last_line)["id"] + 1 if last_line is not None else None
+
+
+def tag_sentences(sentences, first_sentence: int, prefixes: Dict[str, str], prompter: ClarifaiPrompter,
+                  executor: ThreadPoolExecutor, model_id: str, write: Callable[[Dict], None],
+                  max_pending_sentences: int = 100) -> int:
+    """
+    Prompt the model for every sentence and entity class, writing results in the order of the sentences.
+    At most max_pending_sentences sentences are in progress at a time, so memory use does not depend on
+    the size of the corpus.
+
+    :param sentences: iterable of (tokens, labels) pairs, see read_token_file (labels are not used)
+    :param first_sentence: ID of the first sentence (0-based position in the corpus)
+    :param prefixes: prompt prefix for each entity class, see class_prompt_prefixes
+    :param prompter: ClarifaiPrompter object
+    :param executor: executor running the requests
+    :param model_id: model ID
+    :param write: function writing the result for one sentence
+    :param max_pending_sentences: max number of sentences submitted but not written yet
+    :return: number of tagged sentences
+    """
+    pending = deque()
+    n_sentences = 0
+
+    def write_first_pending():
+        sentence_id, tokens, futures = pending.popleft()
+        result = {"id": sentence_id, "tokens": tokens, "text": {}, "label": {}}
+        for entity_class, future in futures.items():
+            output_text, _ = future.result()
+            # Only use the first line of each output, as the model is prone to over-generation
+            result["text"][entity_class] = output_text.split('\n')[0]
+            # If the output does not match the sentence, return an empty list instead
+            try:
+                result["label"][entity_class] = labels_from_output(result["text"][entity_class], tokens, entity_class)
+            except IndexError:
+                result["label"][entity_class] = []
+        write(result)
+
+    for sentence_id, (tokens, _) in enumerate(sentences, start=first_sentence):
+        input_example = ' '.join(tokens)
+        futures = {entity_class: prompter.submit(executor, model_id, build_prompt_from_prefix(prefix, input_example),
+                                                 (sentence_id, entity_class, 0))
+                   for entity_class, prefix in prefixes.items()}
+        pending.append((sentence_id, tokens, futures))
+        n_sentences += 1
+        if len(pending) >= max_pending_sentences:
+            write_first_pending()
+    while pending:
+        write_first_pending()
+    return n_sentences
+
+
+def main(args):
+    entity_classes = args.entity_classes
+    instr_messages = {entity_class: instruction_message(entity_class) for entity_class in entity_classes}
+
+    # The demonstration pool is fixed for the whole corpus, so each class prefix is built once
+    demonstrations = list(islice(read_token_file(args.demonstrations_file), args.n_demonstrations))
+    # The demonstrations are fixed, so there is nothing to retrieve per sentence
+    _, packer = build_retriever_and_packer(get_token_counter(args.tokenizer), token_budget=args.token_budget,
+                                           max_negatives=args.max_negatives,
+                                           max_sentence_tokens=args.max_sentence_tokens,
+                                           truncate_long_sentences=args.truncate_long_sentences)
+    prefixes = class_prompt_prefixes(demonstrations, entity_classes, SYSTEM_MESSAGE, instr_messages, packer)
+
+    first_sentence = args.first_sentence
+    if args.resume and is_compressed(args.output_file):
+        # An interrupted compressed stream cannot be repaired by removing its last line
+        raise Exception("--resume requires an uncompressed output file")
+    if args.resume:
+        resumed_sentence = resume_offset(args.output_file)
+        if resumed_sentence is not None:
+            first_sentence = resumed_sentence
+            logging.info(f"Resuming from sentence {first_sentence}")
+    # --n_sentences counts from --first_sentence, also when resuming
+    last_sentence = args.first_sentence + args.n_sentences if args.n_sentences else None
+    sentences = islice(read_token_file(args.corpus_file), first_sentence, last_sentence)
+
+    telemetry = Telemetry()
+    channels = ChannelPool(args.n_channels, selection=args.channel_selection, keepalive_time_ms=args.keepalive_ms,
+                           compression=args.compression)
+    prompter = ClarifaiPrompter(args.user_id, args.app_id, args.pat, args.max_tokens,
+                                telemetry=telemetry, channels=channels)
+
+    with open_text(args.output_file, 'a' if args.resume else 'w') as out_fh, \
+            TelemetryExporter(telemetry, args.metrics_file, args.metrics_interval), \
+            ThreadPoolExecutor(max_workers=args.max_workers) as executor, \
+            tqdm(desc="Tagging sentences", unit=" sentences") as progress:
+
+        def write(result):
+            out_fh.write(dumps(result) + "\n")
+            progress.update()
+
+        n_sentences = tag_sentences(sentences, first_sentence, prefixes, prompter, executor, args.model_id, write,
+                                    max_pending_sentences=args.max_pending_sentences)
+
+    logging.info(f"Tagged {n_sentences} sentences starting from sentence {first_sentence}, "
+                 f"requests: {telemetry.counter_value('fewnerd_requests_total', model=args.model_id):.0f}, "
+                 f"coalesced: {telemetry.counter_value('fewnerd_coalesced_requests_total', model=args.model_id):.0f}")
+
+
+if __name__ == '__main__':
+    # Add arguments to argparser
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-t', '--pat',
+        type=str,
+        help='Personal Access Token.')
+    parser.add_argument(
+        '-u', '--user_id',
+        default='meta',
+        type=str,
+        help='User ID.')
+    parser.add_argument(
+        '-a', '--app_id',
+        default="Llama-2",
+        help='App ID.')
+    parser.add_argument(
+        '-m', '--model_id',
+        default='llama2-7b-chat',
+        type=str,
+        help='Model ID.'
+    )
+    parser.add_argument(
+        '-i', '--corpus_file',
+        type=str,
+        help='File with sentences to tag, one token (and label) per line, e.g. Few-NERD/data/supervised/test.txt.'
+    )
+    parser.add_argument(
+        '--demonstrations_file',
+        type=str,
+        help='File with labelled sentences to use as few-shot examples, in the same format, '
+             'e.g. Few-NERD/data/supervised/train.txt.'
+    )
+    parser.add_argument(
+        '--n_demonstrations',
+        type=int,
+        default=10,
+        help='Use the first N sentences of the demonstrations file as the demonstration pool.'
+    )
+    parser.add_argument(
+        '-c', '--entity_classes',
+        default=['event'],
+        type=str,
+        nargs='+',
+        help='Entity classes to tag.'
+    )
+    parser.add_argument(
+        '-o', '--output_file',
+        default='tagged.jsonl',
+        type=str,
+        help='Output file, with one JSON line per sentence.'
+    )
+    parser.add_argument(
+        '--first_sentence',
+        type=int,
+        default=0,
+        help='Index of the first sentence to tag (0-based).'
+    )
+    parser.add_argument(
+        '--n_sentences',
+        type=int,
+        default=None,
+        help='Number of sentences to tag (all remaining sentences by default).'
+    )
+    parser.add_argument(
+        '--resume',
+        default=False,
+        action='store_true',
+        help='Continue after the last sentence in the output file.'
+    )
+    parser.add_argument(
+        '--max_tokens',
+        type=int,
+        default=100,
+        help="Max number of tokens to generate"
+    )
+    parser.add_argument(
+        '--token_budget',
+        type=int,
+        default=None,
+        help='Max number of tokens in the shared part of each prompt; demonstrations that do not fit are left out'
+    )
+    parser.add_argument(
+        '--max_negatives',
+        type=int,
+        default=None,
+        help='Max number of demonstrations without the prompted class to use as examples'
+    )
+    parser.add_argument(
+        '--max_sentence_tokens',
+        type=int,
+        default=None,
+        help='Drop (or truncate, with --truncate_long_sentences) demonstrations longer than this many tokens'
+    )
+    parser.add_argument(
+        '--truncate_long_sentences',
+        default=False,
+        action='store_true',
+        help='Truncate demonstrations longer than --max_sentence_tokens instead of dropping them'
+    )
+    parser.add_argument(
+        '--tokenizer',
+        type=str,
+        default='chars',
+        help='Token counter for the limits above: whitespace, chars (~4 characters per token), nltk, '
+             'or hf:MODEL_NAME'
+    )
+    parser.add_argument(
+        '--max_workers',
+        type=int,
+        default=10,
+        help='Number of concurrent requests to the model'
+    )
+    parser.add_argument(
+        '--max_pending_sentences',
+        type=int,
+        default=100,
+        help='Max number of sentences being tagged at a time (limits memory use)'
+    )
+    parser.add_argument(
+        '--n_channels',
+        type=int,
+        default=1,
+        help='Number of gRPC channels (connections) to spread requests over'
+    )
+    parser.add_argument(
+        '--channel_selection',
+        type=str,
+        default='round_robin',
+        choices=['round_robin', 'least_loaded'],
+        help='How to choose a channel for each request'
+    )
+    parser.add_argument(
+        '--keepalive_ms',
+        type=int,
+        default=None,
+        help='Interval of gRPC keepalive pings in milliseconds (no keepalive pings if not set)'
+    )
+    parser.add_argument(
+        '--compression',
+        type=str,
+        default=None,
+        choices=['gzip', 'deflate'],
+        help='Compress request messages'
+    )
+    parser.add_argument(
+        '--metrics_file',
+        type=str,
+        default=None,
+        help='File to periodically write request metrics to (JSON if it ends with .json, Prometheus text otherwise)'
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        type=float,
+        default=15.0,
+        help='Seconds between metrics file updates'
+    )
+
+    arguments = parser.parse_args()
+    main(arguments)
@@ -0,0 +1,201 @@
+import os
+import json
+import bisect
+import logging
+import threading
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Upper bounds (in seconds) of request latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 60.0, 120.0)
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _metric_key(name: str, labels: Dict[str, str]) -> MetricKey:
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    escaped = [(key, value.replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Telemetry:
+    """
+    Thread-safe in-process registry of counters, gauges and histograms.
+    Metrics are identified by a name and a set of labels (e.g. model="llama2-7b-chat", entity_class="person"),
+    and can be exported as a Prometheus text file or a JSON snapshot.
+    """
+
+    def __init__(self, latency_buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.latency_buckets = tuple(latency_buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        # Histogram values are lists of bucket counts (with an extra +Inf bucket), followed by the sum of observations
+        self._histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Increment a counter.
+
+        :param name: metric name
+        :param value: amount to add
+        :param labels: metric labels
+        """
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_gauge(self, name: str, delta: float, **labels) -> None:
+        """
+        Add a (possibly negative) delta to a gauge.
+
+        :param name: metric name
+        :param delta: amount to add
+        :param labels: metric labels
+        """
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        Record an observation in a histogram.
+
+        :param name: metric name
+        :param value: observed value (e.g. latency in seconds)
+        :param labels: metric labels
+        """
+        key = _metric_key(name, labels)
+        bucket = bisect.bisect_left(self.latency_buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.latency_buckets) + 2)
+            histogram[bucket] += 1
+            histogram[-1] += value
+
+    def counter_value(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(_metric_key(name, labels), 0)
+
+    def snapshot(self) -> Dict[str, List[Dict]]:
+        """
+        Take a consistent copy of all metrics.
+
+        :return: dictionary with lists of counters, gauges and histograms
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted((key, list(value)) for key, value in self._histograms.items())
+
+        result = {"counters": [], "gauges": [], "histograms": []}
+        for kind, items in (("counters", counters), ("gauges", gauges)):
+            for (name, labels), value in items:
+                result[kind].append({"name": name, "labels": dict(labels), "value": value})
+        for (name, labels), value in histograms:
+            bucket_counts = value[:-1]
+            result["histograms"].append({
+                "name": name,
+                "labels": dict(labels),
+                "buckets": [[bound, count] for bound, count in zip(list(self.latency_buckets) + ["+Inf"],
+                                                                    bucket_counts)],
+                "count": sum(bucket_counts),
+                "sum": value[-1]
+            })
+        return result
+
+    def to_prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+
+        :return: metrics as text
+        """
+        snapshot = self.snapshot()
+        lines = []
+        seen_types = set()
+
+        def add_type(name, metric_type):
+            if name not in seen_types:
+                lines.append(f"# TYPE {name} {metric_type}")
+                seen_types.add(name)
+
+        for kind, metric_type in (("counters", "counter"), ("gauges", "gauge")):
+            for metric in snapshot[kind]:
+                add_type(metric["name"], metric_type)
+                lines.append(f"{metric['name']}{_format_labels(sorted(metric['labels'].items()))} {metric['value']}")
+        for metric in snapshot["histograms"]:
+            name = metric["name"]
+            labels = sorted(metric["labels"].items())
+            add_type(name, "histogram")
+            cumulative = 0
+            for bound, count in metric["buckets"]:
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + [('le', str(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {metric['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {metric['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Atomically write the metrics to a file: a JSON snapshot if the path ends with .json,
+        Prometheus text format otherwise.
+
+        :param path: output file path
+        """
+        if path.endswith(".json"):
+            content = json.dumps(self.snapshot(), indent=1)
+        else:
+            content = self.to_prometheus()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf8') as fh:
+            fh.write(content)
+        os.replace(tmp_path, path)
+
+
+class TelemetryExporter:
+    """
+    Periodically write a Telemetry registry to a file from a background thread.
+    Can be used as a context manager; the file is written one last time on exit.
+    """
+
+    def __init__(self, telemetry: Telemetry, path: Optional[str], interval: float = 15.0):
+        self.telemetry = telemetry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        try:
+            self.telemetry.write(self.path)
+        except OSError as e:
+            logging.warning(f"Could not write metrics to {self.path}: {e}")
+
+    def start(self) -> None:
+        if self.path and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="telemetry-exporter", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self._write()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Modules in few_nerd_prompting import each other as top-level modules (they are run as scripts),
+# so the directory has to be on the path for tests of modules with sibling imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "few_nerd_prompting"))
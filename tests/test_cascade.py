@@ -0,0 +1,148 @@
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from cascade import CascadeTier, ModelCascade, parse_model_spec
+from telemetry import Telemetry
+from prompt_building_utils import build_reprompt
+
+QUERY_TOKENS = [["rome", "is", "far"], ["bob", "met", "anna"], ["oslo"]]
+RAW_TEXTS_NER = [(f"prompt {query_id}", (0, "location", query_id)) for query_id in range(len(QUERY_TOKENS))]
+GOOD_OUTPUTS = ["@@rome## is far", "bob met anna", "@@oslo##"]
+VERIFICATION_PATTERN = re.compile(r'Is the word "(.*)" in the input sentence')
+
+
+class StubPrompter:
+    """
+    Prompter answering from a dictionary instead of calling a model.
+    Verification prompts are answered with "no" for the given entities and "yes" otherwise.
+    """
+
+    def __init__(self, outputs, rejected_entities=()):
+        self.outputs = outputs
+        self.rejected_entities = set(rejected_entities)
+        self.prompts = []
+        self.verified_entities = []
+
+    def submit(self, executor, model_id, raw_text_ner, index):
+        verification = VERIFICATION_PATTERN.search(raw_text_ner)
+        if verification is not None:
+            entity = verification.group(1)
+            self.verified_entities.append(entity)
+            output = "No" if entity in self.rejected_entities else " Yes."
+        else:
+            self.prompts.append(raw_text_ner)
+            output = self.outputs[raw_text_ner]
+        future = Future()
+        future.set_result((output, index))
+        return future
+
+
+def run_cascade(cascade):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        return cascade.predict(executor, RAW_TEXTS_NER, QUERY_TOKENS, show_progress=False)
+
+
+class TestModelCascade:
+    """
+    Tests for escalating prompts through the tiers of a ModelCascade
+    """
+
+    def test_stops_at_first_acceptable_tier(self):
+        # Test that later tiers are not used when all outputs of the first tier are usable
+        first = StubPrompter(dict(zip(["prompt 0", "prompt 1", "prompt 2"], GOOD_OUTPUTS)))
+        second = StubPrompter({})
+        cascade = ModelCascade([CascadeTier(first, "small"), CascadeTier(second, "large")])
+        assert run_cascade(cascade) == [(output, index) for output, (_, index) in zip(GOOD_OUTPUTS, RAW_TEXTS_NER)]
+        assert second.prompts == []
+        assert cascade.prompt_counts == [3, 0]
+
+    def test_escalates_unusable_outputs(self):
+        # Test that only malformed and unaligned outputs go to the next tier, with their original prompts
+        first = StubPrompter({"prompt 0": "@@rome is far", "prompt 1": "bob met anna\nand more",
+                              "prompt 2": "@@london##"})
+        second = StubPrompter({"prompt 0": GOOD_OUTPUTS[0], "prompt 2": GOOD_OUTPUTS[2]})
+        telemetry = Telemetry()
+        cascade = ModelCascade([CascadeTier(first, "small"), CascadeTier(second, "large")], telemetry=telemetry)
+        # Only the first line of each output is used
+        assert [output for output, _ in run_cascade(cascade)] == GOOD_OUTPUTS
+        assert sorted(second.prompts) == ["prompt 0", "prompt 2"]
+        assert cascade.prompt_counts == [3, 2]
+        assert cascade.problem_counts[0] == {"malformed": 1, "alignment": 1, "verification": 0}
+        assert telemetry.counter_value("fewnerd_cascade_escalations_total", model="small", reason="malformed") == 1
+        assert telemetry.counter_value("fewnerd_cascade_escalations_total", model="small", reason="alignment") == 1
+
+    def test_last_tier_output_used(self):
+        # Test that the last tier's output is used even if it is unusable, and that its problems are counted
+        first = StubPrompter({"prompt 0": "@@rome is far", "prompt 1": GOOD_OUTPUTS[1], "prompt 2": GOOD_OUTPUTS[2]})
+        second = StubPrompter({"prompt 0": "@@london## is far"})
+        telemetry = Telemetry()
+        cascade = ModelCascade([CascadeTier(first, "small"), CascadeTier(second, "large")], telemetry=telemetry)
+        assert run_cascade(cascade)[0] == ("@@london## is far", (0, "location", 0))
+        assert cascade.problem_counts[1]["alignment"] == 1
+        assert telemetry.counter_value("fewnerd_cascade_escalations_total", model="large", reason="alignment") == 0
+
+    def test_reprompt(self):
+        # Test that a reprompting tier gets the rejected output and the problem
+        reprompt = build_reprompt("prompt 0", "@@rome is far", "malformed", "location")
+        first = StubPrompter({"prompt 0": "@@rome is far", "prompt 1": GOOD_OUTPUTS[1], "prompt 2": GOOD_OUTPUTS[2]})
+        second = StubPrompter({reprompt: GOOD_OUTPUTS[0]})
+        cascade = ModelCascade([CascadeTier(first, "small"), CascadeTier(second, "small", reprompt=True)])
+        assert run_cascade(cascade)[0][0] == GOOD_OUTPUTS[0]
+        assert second.prompts == [reprompt]
+
+    def test_verification(self):
+        # Test that outputs with an entity the model does not confirm are escalated, and that the last tier
+        # is not asked to verify
+        first = StubPrompter(dict(zip(["prompt 0", "prompt 1", "prompt 2"], GOOD_OUTPUTS)), rejected_entities={"oslo"})
+        second = StubPrompter({"prompt 2": "oslo"}, rejected_entities={"oslo"})
+        cascade = ModelCascade([CascadeTier(first, "small"), CascadeTier(second, "large")], verify=True)
+        assert [output for output, _ in run_cascade(cascade)] == GOOD_OUTPUTS[:2] + ["oslo"]
+        # Outputs without entities are not verified
+        assert sorted(first.verified_entities) == ["oslo", "rome"]
+        assert second.verified_entities == []
+        assert cascade.problem_counts[0]["verification"] == 1
+
+    def test_rejected_by_verification(self):
+        # Test that an output is rejected if any of its entities is not confirmed
+        prompter = StubPrompter({}, rejected_entities={"anna"})
+        cascade = ModelCascade([CascadeTier(prompter, "small")])
+        candidates = {0: ("@@rome## is far", "rome is far", (0, "location", 0)),
+                      1: ("@@bob## met @@anna##", "bob met anna", (0, "person", 1))}
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            assert cascade._rejected_by_verification(cascade.tiers[0], executor, candidates) == {1}
+        assert sorted(prompter.verified_entities) == ["anna", "bob", "rome"]
+
+    def test_report(self):
+        first = StubPrompter({"prompt 0": "@@rome is far", "prompt 1": GOOD_OUTPUTS[1], "prompt 2": GOOD_OUTPUTS[2]})
+        second = StubPrompter({build_reprompt("prompt 0", "@@rome is far", "malformed", "location"): "@@rome is"})
+        cascade = ModelCascade([CascadeTier(first, "small"), CascadeTier(second, "large", reprompt=True)])
+        run_cascade(cascade)
+        lines = [line.split() for line in cascade.report().split("\n")]
+        assert lines[0] == ["tier", "model", "prompts", "malformed", "alignment", "verification", "escalated"]
+        assert lines[1] == ["0", "small", "3", "1", "0", "0", "1", "(33%)"]
+        # Problems of the last tier are counted but not escalated
+        assert lines[2] == ["1", "large", "(reprompt)", "1", "1", "0", "0", "0", "(0%)"]
+
+    def test_no_tiers(self):
+        with pytest.raises(ValueError):
+            ModelCascade([])
+
+
+class TestParseModelSpec:
+    """
+    Tests for the parse_model_spec function
+    """
+
+    def test_model_id(self):
+        assert parse_model_spec("llama2-70b-chat", "meta", "Llama-2") == ("meta", "Llama-2", "llama2-70b-chat")
+
+    def test_full_spec(self):
+        assert parse_model_spec("openai/chat-completion/gpt-4", "meta", "Llama-2") == \
+               ("openai", "chat-completion", "gpt-4")
+
+    @pytest.mark.parametrize("spec", ["Llama-2/llama2-70b-chat", "a/b/c/d"])
+    def test_invalid(self, spec):
+        with pytest.raises(ValueError):
+            parse_model_spec(spec, "meta", "Llama-2")
@@ -0,0 +1,233 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import grpc
+import pytest
+
+from clarifai_prompter import ChannelPool, ClarifaiPrompter, HedgingPolicy, LRUCache
+
+
+class TestLRUCache:
+    """
+    Tests for the LRUCache class
+    """
+
+    def test_least_recently_used_is_dropped(self):
+        # Test that the entry used longest ago is dropped when the cache is full
+        cache = LRUCache(max_size=2)
+        cache["a"] = "1"
+        cache["b"] = "2"
+        assert cache.get("a") == "1"
+        cache["c"] = "3"
+        assert len(cache) == 2
+        assert cache.get("b") is None
+        assert cache.get("a") == "1" and cache.get("c") == "3"
+
+    def test_shared_cache_separates_apps(self):
+        # Test that prompters for different apps do not share outputs of models with the same ID
+        cache = LRUCache()
+        prompters = [ClarifaiPrompter("meta", app_id, "pat", 10, cache=cache) for app_id in ("app1", "app2")]
+        for prompter in prompters:
+            prompter.predict = lambda model_id, prompt, index, app_id=prompter.app_id: (f"{app_id} output", index)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            outputs = [prompter.submit(executor, "model", "prompt", 0).result()[0] for prompter in prompters]
+        assert outputs == ["app1 output", "app2 output"]
+        assert len(cache) == 2
+
+
+class TestRequestCoalescing:
+    """
+    Tests for the submit method of the ClarifaiPrompter class
+    """
+
+    @staticmethod
+    def make_prompter(predict, cache=None):
+        prompter = ClarifaiPrompter("meta", "Llama-2", "pat", 10, cache=cache)
+        prompter.predict = predict
+        return prompter
+
+    def test_duplicates_collapse_to_one_call(self):
+        # Test that identical requests submitted while the first one is running share its output
+        release = threading.Event()
+        calls = []
+
+        def predict(model_id, prompt, index):
+            calls.append(prompt)
+            release.wait(5)
+            return f"output for {prompt}", index
+
+        prompter = self.make_prompter(predict)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [prompter.submit(executor, "model", "prompt", i) for i in range(3)]
+            other = prompter.submit(executor, "model", "other prompt", 3)
+            release.set()
+            results = [future.result() for future in futures]
+            other.result()
+        assert sorted(calls) == ["other prompt", "prompt"]
+        # Every caller gets its own index back
+        assert results == [("output for prompt", i) for i in range(3)]
+        assert prompter.telemetry.counter_value("fewnerd_coalesced_requests_total", model="model") == 2
+        assert prompter._in_flight == {}
+
+    def test_error_reaches_every_waiter(self):
+        # Test that a failed request fails all coalesced requests and is not kept in flight
+        release = threading.Event()
+
+        def predict(model_id, prompt, index):
+            release.wait(5)
+            raise RuntimeError("request failed")
+
+        prompter = self.make_prompter(predict)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [prompter.submit(executor, "model", "prompt", i) for i in range(3)]
+            release.set()
+            for future in futures:
+                with pytest.raises(RuntimeError):
+                    future.result()
+        assert prompter._in_flight == {}
+
+    def test_request_after_failure_is_sent_again(self):
+        # Test that a request is sent again after an identical one failed
+        outcomes = [RuntimeError("request failed"), "output"]
+
+        def predict(model_id, prompt, index):
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome, index
+
+        prompter = self.make_prompter(predict)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with pytest.raises(RuntimeError):
+                prompter.submit(executor, "model", "prompt", 0).result()
+            assert prompter.submit(executor, "model", "prompt", 1).result() == ("output", 1)
+        assert outcomes == []
+
+    def test_cache_hit(self):
+        # Test that a cached output is returned without a request
+        calls = []
+
+        def predict(model_id, prompt, index):
+            calls.append(prompt)
+            return "output", index
+
+        prompter = self.make_prompter(predict, cache=LRUCache())
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            assert prompter.submit(executor, "model", "prompt", 0).result() == ("output", 0)
+            assert prompter.submit(executor, "model", "prompt", 1).result() == ("output", 1)
+        assert calls == ["prompt"]
+        assert prompter.telemetry.counter_value("fewnerd_cache_hits_total", model="model") == 1
+
+
+class UnavailableError(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+
+class TestHedging:
+    """
+    Tests for the HedgingPolicy class and hedged requests of the ClarifaiPrompter class
+    """
+
+    def test_delay_is_percentile_of_latencies(self):
+        # Test that no delay is given before min_samples latencies and then the percentile of recent latencies
+        policy = HedgingPolicy(percentile=95, min_samples=10)
+        for latency in range(1, 10):
+            policy.record_latency(latency)
+        assert policy.start_call() is None
+        for latency in range(10, 101):
+            policy.record_latency(latency)
+        assert policy.start_call() == 96
+
+    def test_budget(self):
+        # Test that hedges are limited to a fraction of all calls
+        policy = HedgingPolicy(budget=0.1)
+        for _ in range(10):
+            policy.start_call()
+        assert policy.acquire_hedge()
+        assert not policy.acquire_hedge()
+        for _ in range(10):
+            policy.start_call()
+        assert policy.acquire_hedge()
+        assert policy.stats() == {"calls": 20, "hedges_fired": 2, "hedges_won": 0}
+
+    @staticmethod
+    def make_prompter(calls):
+        policy = HedgingPolicy(percentile=50, budget=1.0, min_samples=1)
+        policy.record_latency(0.01)
+        prompter = ClarifaiPrompter("meta", "Llama-2", "pat", 10, hedging=policy)
+        calls = iter(calls)
+        prompter._call_future = lambda request: next(calls)
+        return prompter
+
+    def test_hedge_wins_race(self):
+        # Test that a hedge answering before the primary call is counted as a win and the primary call is cancelled
+        primary, hedge = Future(), Future()
+        prompter = self.make_prompter([primary, hedge])
+        threading.Timer(0.1, hedge.set_result, ["hedge response"]).start()
+        assert prompter._predict_hedged("model", ["prompt"]) == "hedge response"
+        assert prompter.hedging.hedges_won == 1
+        assert primary.cancelled()
+
+    def test_failed_primary_is_not_a_win(self):
+        # Test that a hedge answering after the primary call failed is used but not counted as a win
+        primary, hedge = Future(), Future()
+        prompter = self.make_prompter([primary, hedge])
+        threading.Timer(0.1, primary.set_exception, [RuntimeError("request failed")]).start()
+        threading.Timer(0.2, hedge.set_result, ["hedge response"]).start()
+        assert prompter._predict_hedged("model", ["prompt"]) == "hedge response"
+        assert prompter.hedging.stats() == {"calls": 1, "hedges_fired": 1, "hedges_won": 0}
+
+    def test_unavailable_is_retried(self):
+        # Test that hedged requests are retried once when the connection is unavailable, as unhedged ones are
+        outcomes = [UnavailableError(), "response"]
+
+        def predict_hedged(model_id, raw_texts_ner):
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        prompter = self.make_prompter([])
+        prompter._predict_hedged = predict_hedged
+        assert prompter._predict("model", ["prompt"]) == "response"
+
+        outcomes = [UnavailableError(), UnavailableError()]
+        with pytest.raises(grpc.RpcError):
+            prompter._predict("model", ["prompt"])
+
+
+class TestChannelPool:
+    """
+    Tests for the ChannelPool class (channels do not connect until a request is sent)
+    """
+
+    def test_round_robin(self):
+        # Test that channels are chosen in turn
+        pool = ChannelPool(3)
+        slots = [pool.acquire()[0] for _ in range(4)]
+        assert slots == [0, 1, 2, 0]
+        assert pool.in_flight() == [2, 1, 1]
+
+    def test_least_loaded(self):
+        # Test that the channel with the fewest requests in flight is chosen
+        pool = ChannelPool(3, selection="least_loaded")
+        assert [pool.acquire()[0] for _ in range(3)] == [0, 1, 2]
+        pool.release(1)
+        assert pool.acquire()[0] == 1
+        pool.release(0)
+        pool.release(2)
+        assert pool.in_flight() == [0, 1, 0]
+        assert pool.acquire()[0] == 0
+
+    def test_recreate(self):
+        # Test that a channel is replaced once, even if several requests on it failed
+        pool = ChannelPool(2)
+        slot, stub = pool.acquire()
+        pool.recreate(slot, stub)
+        new_slot, new_stub = pool.acquire()
+        new_slot, new_stub = pool.acquire()
+        assert new_slot == slot and new_stub is not stub
+        pool.recreate(slot, stub)
+        assert pool.acquire()[1] is not stub
+        assert pool.acquire()[1] is new_stub
@@ -0,0 +1,44 @@
+from few_nerd_prompting.demonstration_retrieval import HashedNgramVectorizer, DemonstrationRetriever
+
+
+class TestHashedNgramVectorizer:
+    """
+    Tests for the HashedNgramVectorizer class
+    """
+
+    def test_vectors_are_normalised(self):
+        # Test that non-empty sentences get unit-length vectors
+        vectorizer = HashedNgramVectorizer().fit(["we live in new york", "we live in the swamp"])
+        vectors = vectorizer.transform(["we live in new york", "the swamp"])
+        norms = vectors.multiply(vectors).sum(axis=1)
+        assert abs(norms[0, 0] - 1) < 1e-6 and abs(norms[1, 0] - 1) < 1e-6
+
+    def test_empty_sentence(self):
+        # Test that an empty sentence gets a zero vector
+        vectorizer = HashedNgramVectorizer().fit(["we live in new york"])
+        assert vectorizer.transform([""]).nnz == 0
+
+
+class TestDemonstrationRetriever:
+    """
+    Tests for the DemonstrationRetriever class
+    """
+
+    def test_select_most_similar_last(self):
+        # Test that the most similar sentence comes last, closest to the query
+        pool = ["the weather is nice today", "we live in new york city", "new york is a big city"]
+        queries = ["i moved to new york city"]
+        assert DemonstrationRetriever(k=2).select(pool, queries) == [[2, 1]]
+
+    def test_select_k_larger_than_pool(self):
+        # Test with k larger than the number of pool sentences
+        pool = ["the weather is nice today", "we live in new york city"]
+        queries = ["nice weather", "new york"]
+        selected = DemonstrationRetriever(k=5).select(pool, queries)
+        assert [sorted(s) for s in selected] == [[0, 1], [0, 1]]
+        assert selected[0][-1] == 0 and selected[1][-1] == 1
+
+    def test_select_ties_in_pool_order(self):
+        # Test that pool sentences with equal scores are ranked by their position in the pool
+        pool = ["a b", "c d", "e f"]
+        assert DemonstrationRetriever(k=2).select(pool, ["x y"]) == [[1, 0]]
@@ -0,0 +1,128 @@
+import pytest
+
+from dry_run import LatencyProfile, LengthDistribution, format_plan, makespan, plan_run
+from read_few_nerd import FewNerdEpisode
+from prompt_building_utils import SYSTEM_MESSAGE, build_episode_prompts, count_tokens_whitespace, instruction_message
+
+ENTITY_CLASSES = ["location", "person"]
+INSTR_MESSAGES = {entity_class: instruction_message(entity_class) for entity_class in ENTITY_CLASSES}
+
+
+def make_episode():
+    return FewNerdEpisode({"support": {"word": [["we", "live", "in", "paris"], ["anna", "sings"]],
+                                       "label": [["O", "O", "O", "location-GPE"], ["person-artist", "O"]]},
+                           "query": {"word": [["rome", "is", "far"], ["bob", "met", "anna", "in", "oslo"]],
+                                     "label": [["location-GPE", "O", "O"],
+                                               ["person-other", "O", "person-artist", "O", "location-GPE"]]},
+                           "types": ["location-GPE"]},
+                          None, full_labels=False)
+
+
+class TestLengthDistribution:
+    """
+    Tests for the LengthDistribution class
+    """
+
+    def test_empty(self):
+        distribution = LengthDistribution()
+        assert distribution.mean() == 0.0
+        assert distribution.percentile(50) == 0
+        assert distribution.min is None and distribution.max is None
+
+    def test_summary(self):
+        # Test that percentiles are the upper bounds of the buckets containing them, capped at the max
+        distribution = LengthDistribution(bucket_width=10)
+        for length in range(1, 101):
+            distribution.add(length)
+        assert distribution.count == 100
+        assert distribution.mean() == 50.5
+        assert (distribution.min, distribution.max) == (1, 100)
+        assert distribution.percentile(50) == 59
+        assert distribution.percentile(90) == 99
+        assert distribution.percentile(100) == 100
+
+    def test_overflow_bucket(self):
+        # Test that lengths beyond the last bucket are counted in it and reported as the max
+        distribution = LengthDistribution(bucket_width=10, n_buckets=2)
+        for length in (5, 15, 1000):
+            distribution.add(length)
+        assert distribution.buckets == [1, 1, 1]
+        assert distribution.percentile(50) == 19
+        assert distribution.percentile(99) == 1000
+
+
+class TestMakespan:
+    """
+    Tests for the makespan function
+    """
+
+    @pytest.mark.parametrize("latencies, concurrency, expected", [
+        ([], 2, 0.0),
+        ([1.0, 2.0, 3.0], 1, 6.0),
+        ([1.0, 1.0, 1.0, 1.0], 2, 2.0),
+        # The long request keeps one worker busy while the other runs the rest
+        ([3.0, 1.0, 1.0, 1.0], 2, 3.0),
+        ([1.0, 1.0, 3.0], 2, 4.0),
+        ([1.0, 2.0], 10, 2.0),
+    ])
+    def test_makespan(self, latencies, concurrency, expected):
+        assert makespan(latencies, concurrency) == expected
+
+
+class TestPlanRun:
+    """
+    Tests for the plan_run and format_plan functions
+    """
+
+    def plan(self, **kwargs):
+        options = dict(count_tokens=count_tokens_whitespace, max_tokens=100, concurrency=10,
+                       latency_profile=LatencyProfile(1.0, 0.0, 0.0))
+        options.update(kwargs)
+        return plan_run(enumerate([make_episode(), make_episode()]), ENTITY_CLASSES, SYSTEM_MESSAGE, INSTR_MESSAGES,
+                        **options)
+
+    def test_counts(self):
+        # Test that every prompt is counted, with the correct outputs as expected output lengths
+        plan = self.plan()
+        prompts = build_episode_prompts(make_episode(), 0, ENTITY_CLASSES, SYSTEM_MESSAGE, INSTR_MESSAGES)
+        assert plan["episodes"] == 2
+        assert plan["calls"] == 8
+        assert plan["input_tokens"] == 2 * sum(count_tokens_whitespace(prompt) for prompt, _ in prompts)
+        # Tags are attached to tokens, so the correct outputs have as many whitespace tokens as the queries
+        assert plan["expected_output_tokens"] == 2 * 2 * (3 + 5)
+        assert plan["max_output_tokens"] == 800
+        # All requests of an episode run at once
+        assert plan["expected_wall_time_seconds"] == 2.0
+        location = plan["prompt_tokens_per_class"]["location"]
+        assert location["count"] == 4
+        assert location["min"] < location["max"]
+
+    def test_output_tokens_capped(self):
+        # Test that expected outputs are capped at max_tokens
+        plan = self.plan(max_tokens=4, latency_profile=LatencyProfile(0.0, 0.0, 1.0))
+        assert plan["expected_output_tokens"] == 2 * 2 * (3 + 4)
+        assert plan["max_output_tokens"] == 32
+        assert plan["expected_wall_time_seconds"] == 2 * 4.0
+        assert plan["max_wall_time_seconds"] == 2 * 4.0
+
+    def test_concurrency(self):
+        # Test that requests beyond the concurrency limit wait for a free worker
+        plan = self.plan(concurrency=1)
+        assert plan["expected_wall_time_seconds"] == 8.0
+
+    @pytest.mark.parametrize("policy, n_calls", [("prompt", 8), ("defer", 8), ("skip", 4), ("fill", 4)])
+    def test_absent_classes(self, policy, n_calls):
+        # Test that classes absent from the episode's types are not prompted for with skip and fill
+        plan = self.plan(absent_class_policy=policy)
+        assert plan["calls"] == n_calls
+
+    def test_format_plan(self):
+        plan = self.plan(absent_class_policy="skip")
+        lines = format_plan(plan).split("\n")
+        assert lines[:5] == ["Episodes: 2", "Calls: 4", f"Input tokens: {plan['input_tokens']}",
+                             "Output tokens: 16 expected, 400 max", "Wall time (s): 2.0 expected, 2.0 max"]
+        assert lines[7].split() == ["location", "4", str(round(plan["prompt_tokens_per_class"]["location"]["mean"], 1)),
+                                    *[str(plan["prompt_tokens_per_class"]["location"][key])
+                                      for key in ("min", "p50", "p90", "p99", "max")]]
+        # A class without prompts has no min or max
+        assert lines[8].split() == ["person", "0", "0.0", "None", "0", "0", "0", "None"]
@@ -0,0 +1,53 @@
+from few_nerd_prompting.episode_sampling import StratifiedF1Estimate, stratified_order, stratum_key
+
+
+class TestStratifiedOrder:
+    """
+    Tests for the stratified_order function
+    """
+
+    strata = {"a": list(range(0, 60)), "b": list(range(60, 90)), "c": list(range(90, 100))}
+
+    def test_order_is_permutation(self):
+        # Test that every episode appears exactly once
+        assert sorted(stratified_order(self.strata, seed=0)) == list(range(100))
+
+    def test_prefix_is_proportional(self):
+        # Test that a prefix of the order has about the same share of each stratum as the whole file
+        prefix = stratified_order(self.strata, seed=0)[:20]
+        assert sum(1 for i in prefix if i < 60) in (11, 12, 13)
+        assert sum(1 for i in prefix if 60 <= i < 90) in (5, 6, 7)
+        assert sum(1 for i in prefix if i >= 90) in (1, 2, 3)
+
+    def test_seed(self):
+        # Test that the same seed gives the same order
+        assert stratified_order(self.strata, seed=1) == stratified_order(self.strata, seed=1)
+
+
+class TestStratifiedF1Estimate:
+    """
+    Tests for the StratifiedF1Estimate class
+    """
+
+    def test_stratum_key(self):
+        # Test that strata use coarse-grained types and the query set size
+        assert stratum_key(["person-artist/author", "art-music", "art-film"], 5) == (("art", "person"), 5)
+
+    def test_interval_contains_estimate_and_narrows(self):
+        # Test that the interval contains the point estimate and gets narrower with more episodes
+        widths = []
+        for n_episodes in (20, 500):
+            estimate = StratifiedF1Estimate(["person"], seed=0)
+            for i in range(n_episodes):
+                estimate.add_episode(i % 2, [[i % 3, 1, i % 2]])
+            value, low, high = estimate.intervals()["macro"]
+            assert low <= value <= high
+            widths.append(high - low)
+        assert widths[1] < widths[0]
+
+    def test_perfect_predictions(self):
+        # Test that perfect predictions give an F1-score of 1 with no uncertainty
+        estimate = StratifiedF1Estimate(["person", "location"], seed=0)
+        for i in range(10):
+            estimate.add_episode("a", [[2, 0, 0], [1, 0, 0]])
+        assert estimate.intervals()["micro"] == (1.0, 1.0, 1.0)
@@ -0,0 +1,155 @@
+import json
+import threading
+import time
+
+import pytest
+
+from evaluate_outputs import build_leaderboard, build_report, encode_ground_truth, follow_predictions
+
+QUERIES = [["we", "visited", "berlin"], ["rome", "is", "far"]]
+QUERY_LABELS = [["O", "O", "location-GPE"], ["location-GPE", "O", "O"]]
+
+
+def write_episode_file(tmp_path, queries=QUERIES, query_labels=QUERY_LABELS, types=("location-GPE",)):
+    # Episode files are named as in Few-NERD, see FewNerdEpisodesSet; each query sentence is an episode
+    directory = tmp_path / "inter"
+    directory.mkdir()
+    path = directory / "dev_5_1.jsonl"
+    with open(path, 'w', encoding='utf8') as fh:
+        for words, labels in zip(queries, query_labels):
+            episode = {"support": {"word": [["we", "live", "in", "paris"]], "label": [["O", "O", "O", "location-GPE"]]},
+                       "query": {"word": [words], "label": [labels]},
+                       "types": list(types)}
+            fh.write(json.dumps(episode) + "\n")
+    return str(path)
+
+
+def prediction_line(episode_id, labels, entity_class="location"):
+    return json.dumps({str(episode_id): {"text": {entity_class: [""]}, "label": {entity_class: [labels]}}}) + "\n"
+
+
+class TestFollowPredictions:
+    """
+    Tests for evaluating a prediction file while it is being written
+    """
+
+    def test_idle_timeout(self, tmp_path):
+        # Test that all complete lines are scored and that the loop stops once no new lines are written
+        true_file = write_episode_file(tmp_path)
+        pred_file = tmp_path / "predictions.jsonl"
+        pred_file.write_text(prediction_line(0, ["O", "O", "location"]) + prediction_line(1, ["O", "O", "O"]))
+
+        start = time.monotonic()
+        scores = follow_predictions(["location"], str(pred_file), true_file, round_to=2, full_labels=False,
+                                    full_labels_path=None, interval=0.05, idle_timeout=0.3)
+        assert time.monotonic() - start < 5
+        assert scores.n_episodes == 2
+        # One entity found, one missed
+        assert scores.counts["location"] == [1, 0, 1]
+
+    def test_partial_line(self, tmp_path):
+        # Test that a line is only scored once it is complete
+        true_file = write_episode_file(tmp_path)
+        pred_file = tmp_path / "predictions.jsonl"
+        second_line = prediction_line(1, ["location", "O", "O"])
+        pred_file.write_text(prediction_line(0, ["O", "O", "location"]) + second_line[:10])
+
+        def finish_line():
+            with open(pred_file, 'a', encoding='utf8') as fh:
+                fh.write(second_line[10:])
+
+        timer = threading.Timer(0.3, finish_line)
+        timer.start()
+        try:
+            scores = follow_predictions(["location"], str(pred_file), true_file, round_to=2, full_labels=False,
+                                        full_labels_path=None, interval=0.05, idle_timeout=1.0)
+        finally:
+            timer.join()
+        assert scores.n_episodes == 2
+        assert scores.counts["location"] == [2, 0, 0]
+
+    def test_incomplete_last_line(self, tmp_path):
+        # Test that a last line that is never completed is not scored
+        true_file = write_episode_file(tmp_path)
+        pred_file = tmp_path / "predictions.jsonl"
+        pred_file.write_text(prediction_line(0, ["O", "O", "location"]) + prediction_line(1, ["O", "O", "O"])[:10])
+
+        scores = follow_predictions(["location"], str(pred_file), true_file, round_to=2, full_labels=False,
+                                    full_labels_path=None, interval=0.05, idle_timeout=0.3)
+        assert scores.n_episodes == 1
+
+    def test_replaced_file(self, tmp_path):
+        # Test that the loop stops when the file is replaced, without waiting for the idle timeout
+        true_file = write_episode_file(tmp_path)
+        pred_file = tmp_path / "predictions.jsonl"
+        pred_file.write_text(prediction_line(0, ["O", "O", "location"]))
+        new_file = tmp_path / "tmp.predictions.jsonl"
+        new_file.write_text(prediction_line(0, ["O", "O", "location"]) + prediction_line(1, ["O", "O", "O"]))
+
+        timer = threading.Timer(0.3, new_file.replace, args=(pred_file,))
+        timer.start()
+        start = time.monotonic()
+        try:
+            scores = follow_predictions(["location"], str(pred_file), true_file, round_to=2, full_labels=False,
+                                        full_labels_path=None, interval=0.05, idle_timeout=30)
+        finally:
+            timer.join()
+        assert time.monotonic() - start < 10
+        assert scores.n_episodes == 1
+
+    def test_compressed_file(self, tmp_path):
+        # Test that compressed prediction files are rejected
+        true_file = write_episode_file(tmp_path)
+        with pytest.raises(Exception, match="uncompressed"):
+            follow_predictions(["location"], str(tmp_path / "predictions.jsonl.gz"), true_file, round_to=2,
+                               full_labels=False, full_labels_path=None, interval=0.05, idle_timeout=0.3)
+
+
+class TestLeaderboard:
+    """
+    Tests that the leaderboard scores match the per-file report
+    """
+
+    entity_classes = ["location", "person"]
+    queries = [["anna", "visited", "berlin"], ["rome", "is", "far"], ["bob", "met", "anna", "smith"]]
+    query_labels = [["person-artist", "O", "location-GPE"], ["location-GPE", "O", "O"],
+                    ["person-other", "O", "person-artist", "person-artist"]]
+    # Predicted labels of each episode for location and person
+    predictions = {
+        "good.jsonl": [(["O", "O", "location"], ["person", "O", "O"]),
+                       (["location", "O", "O"], ["O", "O", "O"]),
+                       (["O", "O", "O", "O"], ["person", "O", "person", "person"])],
+        "bad.jsonl": [(["location", "O", "O"], []),
+                      (["O", "O", "O"], ["person", "O", "O"]),
+                      (["O", "location", "O", "O"], ["person", "O", "person", "O"])],
+    }
+
+    def write_predictions(self, tmp_path, name):
+        path = tmp_path / name
+        with open(path, 'w', encoding='utf8') as fh:
+            # Only the first prediction of an episode is scored, so the repeated episode 0 is left out
+            for episode_id, (location, person) in (list(enumerate(self.predictions[name]))
+                                                   + [(0, (["location"] * 3, ["person"] * 3))]):
+                fh.write(json.dumps({str(episode_id): {"text": {"location": [""], "person": [""]},
+                                                       "label": {"location": [location], "person": [person]}}})
+                         + "\n")
+        return str(path)
+
+    @pytest.mark.parametrize("n_processes", [1, 2])
+    def test_matches_report(self, tmp_path, n_processes):
+        true_file = write_episode_file(tmp_path, self.queries, self.query_labels,
+                                       types=("location-GPE", "person-artist", "person-other"))
+        pred_files = [self.write_predictions(tmp_path, name) for name in self.predictions]
+        ground_truth = encode_ground_truth(true_file, self.entity_classes, full_labels=False, full_labels_path=None)
+
+        rows = build_leaderboard(pred_files, ground_truth, self.entity_classes, n_processes=n_processes)
+        assert [row["pred_file"] for row in rows] == pred_files
+        for row in rows:
+            assert row["episodes"] == 3
+            report = build_report(self.entity_classes, row["pred_file"], true_file, round_to=4, full_labels=False,
+                                  full_labels_path=None)
+            # Rows of the report: class, precision, recall, F1-score, support
+            expected = {line.split()[0]: float(line.split()[3]) for line in report.split("\n")[2:] if line.strip()}
+            for entity_class in self.entity_classes:
+                assert row[entity_class] == pytest.approx(expected[entity_class], abs=1e-4)
+            assert row["macro_f1"] == pytest.approx(sum(expected.values()) / 2, abs=1e-4)
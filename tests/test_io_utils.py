@@ -0,0 +1,70 @@
+import gzip
+
+import pytest
+
+from few_nerd_prompting import io_utils
+from few_nerd_prompting.io_utils import dumps, loads, open_binary, open_text, read_line_at
+
+
+class TestOpenText:
+    """
+    Tests for the open_text and read_line_at functions
+    """
+
+    lines = ['{"0": {"text": "Paris"}}\n', '{"1": {"text": "Zürich"}}\n']
+
+    @pytest.mark.parametrize("extension", [".jsonl", ".jsonl.gz"])
+    def test_round_trip(self, tmp_path, extension):
+        # Test that lines written to a file are read back unchanged, with or without compression
+        path = str(tmp_path / f"results{extension}")
+        with open_text(path, 'w') as fh:
+            fh.writelines(self.lines)
+        with open_text(path) as fh:
+            assert list(fh) == self.lines
+
+    def test_gzip_is_compressed(self, tmp_path):
+        # Test that .gz files are readable by gzip
+        path = str(tmp_path / "results.jsonl.gz")
+        with open_text(path, 'w') as fh:
+            fh.writelines(self.lines)
+        with gzip.open(path, 'rt', encoding='utf8') as fh:
+            assert fh.read() == "".join(self.lines)
+
+    def test_read_line_at(self, tmp_path):
+        # Test that the line starting at an offset is read
+        path = str(tmp_path / "results.jsonl")
+        with open_binary(path, 'w') as fh:
+            fh.write("".join(self.lines).encode('utf8'))
+        assert read_line_at(path, len(self.lines[0].encode('utf8'))).decode('utf8') == self.lines[1]
+
+    def test_read_line_at_compressed(self, tmp_path):
+        # Test that compressed files cannot be read at an offset
+        path = str(tmp_path / "results.jsonl.gz")
+        with open_binary(path, 'w') as fh:
+            fh.write("".join(self.lines).encode('utf8'))
+        with pytest.raises(ValueError):
+            read_line_at(path, 0)
+
+
+class TestJson:
+    """
+    Tests for the loads and dumps functions
+    """
+
+    def test_round_trip(self):
+        # Test that integer keys become strings, as with json.dumps
+        assert loads(dumps({0: {"label": {"art": [["O", "art"]]}}})) == {"0": {"label": {"art": [["O", "art"]]}}}
+
+    def test_single_line(self):
+        # Test that encoded objects fit on one line
+        assert "\n" not in dumps({"text": {"person": "a\nb"}})
+
+    def test_same_output_without_orjson(self, monkeypatch):
+        # Test that the standard library fallback writes the same bytes as orjson
+        pytest.importorskip("orjson")
+        obj = {0: {"text": {"location": ["@@Zürich## is in \"Switzerland\"", "a\tb"]},
+                   "label": {"location": [["location", "O", "O"], []]}, "skipped": ["art"]}}
+        with_orjson = dumps(obj)
+        monkeypatch.setattr(io_utils, "orjson", None)
+        assert dumps(obj) == with_orjson
+        assert "Zürich" in with_orjson
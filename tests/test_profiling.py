@@ -0,0 +1,45 @@
+import os
+import json
+
+import pytest
+
+from few_nerd_prompting.profiling import StageProfiler
+
+
+class TestStageProfiler:
+    """
+    Tests for the StageProfiler class
+    """
+
+    def test_disabled(self):
+        # Test that a profiler without an output directory records nothing
+        profiler = StageProfiler()
+        with profiler.stage("build_prompts"):
+            sum(range(100))
+        profiler.close()
+        assert profiler.stats == {}
+
+    def test_stages_are_added_up(self, tmp_path):
+        # Test that runs of the same stage are added up and written to the output directory
+        profiler = StageProfiler(str(tmp_path), trace_memory=False)
+        for _ in range(3):
+            with profiler.stage("build_prompts"):
+                sum(range(100))
+        assert list(profiler.iterate("read_episodes", iter([1, 2]))) == [1, 2]
+        profiler.close()
+
+        assert profiler.stats["build_prompts"]["calls"] == 3
+        # One call per item, plus the call finding the end of the iterable
+        assert profiler.stats["read_episodes"]["calls"] == 3
+        assert {"summary.json", "summary.txt", "build_prompts.pstats", "read_episodes.pstats"} <= set(
+            os.listdir(tmp_path))
+        with open(tmp_path / "summary.json", encoding="utf8") as fh:
+            assert set(json.load(fh)["stages"]) == {"build_prompts", "read_episodes"}
+
+    def test_nested_stages(self, tmp_path):
+        # Test that stages cannot be nested
+        profiler = StageProfiler(str(tmp_path), trace_memory=False)
+        with pytest.raises(RuntimeError):
+            with profiler.stage("network"):
+                with profiler.stage("parse_outputs"):
+                    pass
@@ -1,5 +1,42 @@
+import logging
+
 from few_nerd_prompting.prompt_building_utils import extract_predicted_entities, output_well_formed, labels_from_output
 from few_nerd_prompting.prompt_building_utils import TAG_START, TAG_END
+from few_nerd_prompting.prompt_building_utils import PromptPacker, count_tokens_whitespace, make_output_example
+from few_nerd_prompting.prompt_building_utils import scan_tags, repair_tags
+from few_nerd_prompting.prompt_building_utils import build_reprompt, output_problem
+from few_nerd_prompting.prompt_building_utils import (build_llama2_prompt_plain, build_llama2_prompt_plain_prefix,
+                                                      build_prompt_from_prefix)
+
+
+class TestMakeOutputExample:
+    """
+    Tests for the make_output_example function
+    """
+
+    def test_make_output_example_entity_inside(self):
+        # Test with an entity in the middle of the sentence
+        result = make_output_example(["I", "am", "in", "Tallinn", "."], ["O", "O", "O", "location", "O"], "location")
+        assert result == f"I am in {TAG_START}Tallinn{TAG_END} ."
+
+    def test_make_output_example_entity_at_end(self):
+        # Test with an entity at the end of the sentence
+        result = make_output_example(["I", "am", "in", "New", "York"],
+                                     ["O", "O", "O", "location-GPE", "location-GPE"], "location")
+        assert result == f"I am in {TAG_START}New York{TAG_END}"
+
+
+class TestPromptPrefix:
+    """
+    Tests for building prompts from a shared prefix
+    """
+
+    def test_prefix_and_input_give_full_prompt(self):
+        # Test that a prompt built from a prefix is the same as a prompt built at once
+        examples = [("I am in Tallinn .", f"I am in {TAG_START}Tallinn{TAG_END} ."), ("Hello .", "Hello .")]
+        prefix = build_llama2_prompt_plain_prefix(examples, "System.", "Instruction.")
+        assert build_prompt_from_prefix(prefix, "We live in Paris .") == \
+            build_llama2_prompt_plain(examples, "System.", "Instruction.", "We live in Paris .")
 
 
 class TestExtractPredictedEntities:
@@ -32,6 +69,43 @@ class TestExtractPredictedEntities:
         assert extract_predicted_entities(snt) == result
 
 
+class TestScanTags:
+    """
+    Tests for the scan_tags and repair_tags functions
+    """
+
+    def test_scan_tags_offsets(self):
+        # Test that span offsets point to the entity text in the output
+        snt = f"We live in {TAG_START}New York{TAG_END}, on {TAG_START}Madison Avenue{TAG_END}."
+        scan = scan_tags(snt)
+        assert scan.valid is True and scan.repairs == []
+        assert [snt[span.start:span.end] for span in scan.spans] == ["New York", "Madison Avenue"]
+
+    def test_scan_tags_nested_start(self):
+        # Test that a start tag inside an open entity is dropped
+        snt = f"We live in {TAG_START}New {TAG_START}York{TAG_END}."
+        scan = scan_tags(snt)
+        assert scan.valid is False
+        assert [span.text for span in scan.spans] == ["New York"]
+        assert [repair.action for repair in scan.repairs] == ["drop_nested_start"]
+        assert repair_tags(snt) == f"We live in {TAG_START}New York{TAG_END}."
+
+    def test_scan_tags_orphan_end(self):
+        # Test that an end tag without a start tag is dropped
+        snt = f"{TAG_START}We{TAG_END} live{TAG_END} in the swamp."
+        scan = scan_tags(snt)
+        assert [span.text for span in scan.spans] == ["We"]
+        assert scan.repairs[0].action == "drop_orphan_end" and scan.repairs[0].position == len(f"{TAG_START}We{TAG_END} live")
+        assert repair_tags(snt) == f"{TAG_START}We{TAG_END} live in the swamp."
+
+    def test_scan_tags_unclosed_start(self):
+        # Test that an unclosed start tag is dropped
+        snt = f"We live in {TAG_START}the swamp."
+        scan = scan_tags(snt)
+        assert scan.spans == [] and [repair.action for repair in scan.repairs] == ["drop_unclosed_start"]
+        assert repair_tags(snt) == "We live in the swamp."
+
+
 class TestOutputWellFormed:
     """
     Tests for the output_well_formed function
@@ -159,3 +233,107 @@ class TestLabelsFromOutput:
                   "O", "O", "O", "O", "O", "O", "O", "O", "O", "O", "O",
                   "O", "O", "O", "O", "O", "O", "O", "O", "O", "O"]
         assert labels_from_output(snt, tokens, "event") == result
+
+
+class TestOutputProblem:
+    """
+    Tests for the output_problem and build_reprompt functions
+    """
+
+    tokens = ["we", "live", "in", "new", "york", "."]
+
+    def test_output_problem_none(self):
+        # Test that a well-formed output matching the input has no problem
+        assert output_problem(f"we live in {TAG_START}new york{TAG_END}.", self.tokens, "location") is None
+
+    def test_output_problem_malformed(self):
+        # Test that an unclosed entity is malformed
+        assert output_problem(f"we live in {TAG_START}new york.", self.tokens, "location") == "malformed"
+
+    def test_output_problem_alignment(self):
+        # Test that an entity that is not in the input cannot be aligned
+        assert output_problem(f"we live in {TAG_START}paris{TAG_END}.", self.tokens, "location") == "alignment"
+
+    def test_build_reprompt(self):
+        # Test that the reprompt repeats the prompt and the rejected output and asks for a new output
+        prompt = "Input: we live in new york .\nOutput: "
+        reprompt = build_reprompt(prompt, "we live in @@paris##.", "alignment", "location")
+        assert reprompt.startswith(f"{prompt}we live in @@paris##.\n")
+        assert reprompt.endswith("\nOutput: ")
+
+
+class TestPromptPacker:
+    """
+    Tests for the PromptPacker class
+    """
+
+    support = [
+        (["we", "live", "in", "the", "swamp"], ["O", "O", "O", "O", "O"]),
+        (["we", "live", "in", "new", "york"], ["O", "O", "O", "location-GPE", "location-GPE"]),
+        (["the", "weather", "is", "nice"], ["O", "O", "O", "O"]),
+        (["paris", "is", "big"], ["location-GPE", "O", "O"]),
+    ]
+
+    def test_pack_without_limits(self):
+        # Test that all examples are kept in their original order
+        packer = PromptPacker(count_tokens_whitespace)
+        result = packer.pack(self.support, "location", "")
+        assert [example[0] for example in result] == [" ".join(s[0]) for s in self.support]
+        assert result[1][1] == f"we live in {TAG_START}new york{TAG_END}"
+
+    def test_pack_max_negatives(self):
+        # Test that positives are kept and only the first negative is
+        packer = PromptPacker(count_tokens_whitespace, max_negatives=1)
+        result = packer.pack(self.support, "location", "")
+        assert [example[0] for example in result] == ["we live in the swamp", "we live in new york", "paris is big"]
+
+    def test_pack_token_budget_prefers_positives(self):
+        # Test that positives are added before negatives when the budget is tight
+        # (each example costs twice the sentence length + 2 whitespace tokens for "Input:" and "Output:")
+        packer = PromptPacker(count_tokens_whitespace, token_budget=24)
+        result = packer.pack(self.support, "location", "one two three four")
+        assert [example[0] for example in result] == ["we live in new york", "paris is big"]
+
+    def test_pack_truncate_long_sentences(self):
+        # Test that long sentences are truncated to their longest fitting prefix
+        packer = PromptPacker(count_tokens_whitespace, max_sentence_tokens=4, truncate=True)
+        result = packer.pack(self.support[:2], "location", "")
+        assert result == [("we live in the", "we live in the"), ("we live in new", f"we live in {TAG_START}new{TAG_END}")]
+
+    def test_pack_drop_long_sentences(self):
+        # Test that long sentences are dropped without truncation
+        packer = PromptPacker(count_tokens_whitespace, max_sentence_tokens=4)
+        result = packer.pack(self.support, "location", "")
+        assert [example[0] for example in result] == ["the weather is nice", "paris is big"]
+
+    def test_pack_no_warning_for_negatives(self, caplog):
+        # Test that leaving out only negatives is not reported
+        packer = PromptPacker(count_tokens_whitespace, token_budget=24)
+        with caplog.at_level(logging.WARNING):
+            packer.pack(self.support, "location", "one two three four")
+        assert not caplog.records
+
+    def test_pack_warns_on_dropped_positives(self, caplog):
+        # Test that positives that do not fit into the budget are reported,
+        # while a smaller negative can still use the remaining budget
+        packer = PromptPacker(count_tokens_whitespace, token_budget=21)
+        with caplog.at_level(logging.WARNING):
+            result = packer.pack(self.support + [(["ok"], ["O"])], "location", "one two three four")
+        assert [example[0] for example in result] == ["we live in new york", "ok"]
+        assert "1 support sentences with location entities" in caplog.text
+
+    def test_pack_warns_on_truncated_positives(self, caplog):
+        # Test that a positive truncated before its entity is reported
+        packer = PromptPacker(count_tokens_whitespace, max_sentence_tokens=3, truncate=True)
+        with caplog.at_level(logging.WARNING):
+            result = packer.pack(self.support[1:2], "location", "")
+        assert result == [("we live in", "we live in")]
+        assert "1 support sentences with location entities" in caplog.text
+
+    def test_pack_no_warning_for_truncated_entities_kept(self, caplog):
+        # Test that a truncated positive that keeps its entity is not reported
+        packer = PromptPacker(count_tokens_whitespace, max_sentence_tokens=4, truncate=True)
+        with caplog.at_level(logging.WARNING):
+            result = packer.pack(self.support[1:2], "location", "")
+        assert result == [("we live in new", f"we live in {TAG_START}new{TAG_END}")]
+        assert not caplog.records
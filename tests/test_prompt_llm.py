@@ -0,0 +1,60 @@
+import logging
+
+import pytest
+
+from prompt_llm import check_absent_class_policy, results_from_outputs
+from read_few_nerd import FewNerdEpisode
+
+
+class TestCheckAbsentClassPolicy:
+    """
+    Tests for the check_absent_class_policy function
+    """
+
+    @pytest.mark.parametrize("policy", ["skip", "fill"])
+    def test_full_labels_rejected(self, policy):
+        # Test that classes cannot be skipped or filled when full labels can contain them
+        with pytest.raises(Exception):
+            check_absent_class_policy(policy, full_labels=True)
+
+    @pytest.mark.parametrize("policy", ["prompt", "defer"])
+    def test_full_labels_allowed(self, policy):
+        # Test that policies prompting for every class can be used with full labels
+        check_absent_class_policy(policy, full_labels=True)
+
+    @pytest.mark.parametrize("policy", ["prompt", "skip", "fill", "defer"])
+    def test_episode_labels_allowed(self, policy):
+        # Test that all policies can be used with episode labels
+        check_absent_class_policy(policy, full_labels=False)
+
+
+class TestResultsFromOutputs:
+    """
+    Tests for the results_from_outputs function
+    """
+
+    episode = FewNerdEpisode({"support": {"word": [["we", "live", "in", "paris"]],
+                                          "label": [["O", "O", "O", "location-GPE"]]},
+                              "query": {"word": [["rome", "is", "far"], ["bob", "met", "anna"]],
+                                        "label": [["location-GPE", "O", "O"], ["person-other", "O", "O"]]}},
+                             None, full_labels=False)
+    # (first line of output, query ID) pairs, not in query order
+    outputs = {"location": [("bob met anna", 1), ("@@rome## is far", 0)],
+               "person": [("@@london## is far", 0), ("@@bob## met anna", 1)]}
+
+    def test_results(self):
+        # Test that outputs are sorted by query and that unusable outputs get empty labels
+        results = results_from_outputs(self.episode, 3, ["location", "person"], self.outputs)
+        assert results == {3: {"text": {"location": ["@@rome## is far", "bob met anna"],
+                                        "person": ["@@london## is far", "@@bob## met anna"]},
+                               "label": {"location": [["location", "O", "O"], ["O", "O", "O"]],
+                                         "person": [[], ["person", "O", "O"]]}}}
+
+    def test_correct_output_logged(self, caplog):
+        # Test that the correct outputs are only built and logged at the DEBUG level
+        with caplog.at_level(logging.INFO):
+            results_from_outputs(self.episode, 3, ["location"], self.outputs)
+        assert "CORRECT OUTPUT" not in caplog.text
+        with caplog.at_level(logging.DEBUG):
+            results_from_outputs(self.episode, 3, ["location"], self.outputs)
+        assert "CORRECT OUTPUT: ['@@rome## is far', 'bob met anna']" in caplog.text
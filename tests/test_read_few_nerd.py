@@ -0,0 +1,40 @@
+import gzip
+import json
+
+import pytest
+
+from read_few_nerd import FewNerdEpisodesSet
+
+
+def make_episode(words):
+    return {"support": {"word": [["we", "live", "in", "paris"]], "label": [["O", "O", "O", "location-GPE"]]},
+            "query": {"word": [words], "label": [["O"] * len(words)]},
+            "types": ["location-GPE"]}
+
+
+class TestEpisodeOffsets:
+    """
+    Tests for reading episodes by offset from plain and compressed episode files
+    """
+
+    queries = [["first", "query"], ["second", "query", "é"], ["third"]]
+
+    @pytest.mark.parametrize("extension", [".jsonl", ".jsonl.gz"])
+    def test_read_episode(self, tmp_path, extension):
+        # Test that episodes can be read by offset in any order, with or without compression
+        lines = "".join(json.dumps(make_episode(words)) + "\n" for words in self.queries)
+        directory = tmp_path / "inter"
+        directory.mkdir()
+        path = directory / f"dev_5_1{extension}"
+        if extension.endswith(".gz"):
+            with gzip.open(path, 'wt', encoding='utf8') as fh:
+                fh.write(lines)
+        else:
+            path.write_text(lines, encoding='utf8')
+
+        episodes_set = FewNerdEpisodesSet(str(path), None)
+        offsets = episodes_set.episode_offsets()
+        assert len(offsets) == 3
+        for episode_id in (2, 0, 1):
+            episode = episodes_set.read_episode(offsets[episode_id])
+            assert list(episode.query_tokens[0]) == self.queries[episode_id]
@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from evaluate_outputs import encode_ground_truth, score_classes
+from run_grid import configuration_scores, read_manifest
+
+
+class TestReadManifest:
+    """
+    Tests for the read_manifest function
+    """
+
+    manifest = {"episode_files": ["Few-NERD/data/episode-data/inter/dev_5_1.jsonl"], "entity_classes": ["person"],
+                "models": [{"model_id": "llama2-7b-chat"}], "prompt_variants": [{"name": "default"}]}
+
+    def write_manifest(self, tmp_path, **changes):
+        path = tmp_path / "manifest.json"
+        path.write_text(json.dumps(dict(self.manifest, **changes)), encoding="utf8")
+        return str(path)
+
+    def test_defaults(self, tmp_path):
+        # Test that default values are filled in
+        manifest = read_manifest(self.write_manifest(tmp_path))
+        assert manifest["models"][0] == {"model_id": "llama2-7b-chat", "user_id": "meta", "app_id": "Llama-2"}
+        assert manifest["cache_size"] == 100000
+
+    def test_duplicate_variant_names(self, tmp_path):
+        # Test that variants with the same name (and so the same output file) are rejected
+        with pytest.raises(Exception):
+            read_manifest(self.write_manifest(tmp_path, prompt_variants=[{"name": "knn"},
+                                                                         {"name": "knn", "retrieval_k": 3}]))
+
+    def test_duplicate_models(self, tmp_path):
+        # Test that the same model cannot be listed twice, but the same model ID can be used from another app
+        with pytest.raises(Exception):
+            read_manifest(self.write_manifest(tmp_path, models=[{"model_id": "m"}, {"model_id": "m"}]))
+        read_manifest(self.write_manifest(tmp_path, models=[{"model_id": "m"}, {"model_id": "m", "app_id": "other"}]))
+
+
+class TestConfigurationScores:
+    """
+    Tests for the configuration_scores function
+    """
+
+    def test_matches_score_classes(self, tmp_path):
+        # Test that scores from the encoded ground truth match scores computed from the episode file
+        directory = tmp_path / "inter"
+        directory.mkdir()
+        true_file = directory / "dev_5_1.jsonl"
+        queries = [(["rome", "is", "far"], ["location-GPE", "O", "O"]),
+                   (["bob", "met", "anna", "in", "oslo"], ["person-other", "O", "person-artist", "O", "location-GPE"])]
+        true_file.write_text("".join(json.dumps({"support": {"word": [words], "label": [labels]},
+                                                 "query": {"word": [words], "label": [labels]},
+                                                 "types": ["location-GPE", "person-other"]}) + "\n"
+                                     for words, labels in queries), encoding="utf8")
+        pred_file = tmp_path / "predictions.jsonl"
+        predictions = [{"location": ["location", "O", "O"], "person": ["O", "O", "O"]},
+                       {"location": ["person", "O", "O", "O", "O"], "person": ["person", "O", "person", "O", "O"]}]
+        pred_file.write_text("".join(json.dumps({str(episode_id): {"text": {"location": [""], "person": [""]},
+                                                                   "label": {entity_class: [labels] for entity_class,
+                                                                             labels in prediction.items()}}}) + "\n"
+                                     for episode_id, prediction in enumerate(predictions)), encoding="utf8")
+
+        entity_classes = ["location", "person"]
+        ground_truth = encode_ground_truth(str(true_file), entity_classes, False, None)
+        scores = configuration_scores(str(pred_file), ground_truth, entity_classes)
+        expected = score_classes(entity_classes, str(pred_file), str(true_file), False, None)
+        for entity_class in entity_classes:
+            assert scores[entity_class] == pytest.approx(expected[entity_class]["f1"])
+        assert scores["macro"] == pytest.approx((expected["location"]["f1"] + expected["person"]["f1"]) / 2)
+        assert 0 < scores["macro"] < 1
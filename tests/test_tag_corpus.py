@@ -0,0 +1,40 @@
+from tag_corpus import resume_offset
+
+
+class TestResumeOffset:
+    """
+    Tests for finding where to continue an interrupted tagging run
+    """
+
+    def test_missing_file(self, tmp_path):
+        # Test that a run without an output file starts from the beginning
+        assert resume_offset(str(tmp_path / "tagged.jsonl")) is None
+
+    def test_empty_file(self, tmp_path):
+        # Test that a run without any written sentence starts from the beginning
+        path = tmp_path / "tagged.jsonl"
+        path.write_bytes(b"")
+        assert resume_offset(str(path)) is None
+
+    def test_complete_lines(self, tmp_path):
+        # Test that tagging continues after the last written sentence
+        path = tmp_path / "tagged.jsonl"
+        content = b'{"id": 7, "tokens": ["a"]}\n{"id": 8, "tokens": ["b"]}\n'
+        path.write_bytes(content)
+        assert resume_offset(str(path)) == 9
+        assert path.read_bytes() == content
+
+    def test_partial_last_line(self, tmp_path):
+        # Test that an incomplete last line is truncated and its sentence tagged again
+        path = tmp_path / "tagged.jsonl"
+        complete = '{"id": 0, "tokens": ["Zürich"]}\n'.encode('utf8')
+        path.write_bytes(complete + b'{"id": 1, "tok')
+        assert resume_offset(str(path)) == 1
+        assert path.read_bytes() == complete
+
+    def test_only_partial_line(self, tmp_path):
+        # Test that a file with just an incomplete line is emptied
+        path = tmp_path / "tagged.jsonl"
+        path.write_bytes(b'{"id": 0, "tok')
+        assert resume_offset(str(path)) is None
+        assert path.read_bytes() == b""
@@ -0,0 +1,124 @@
+import json
+import os
+import time
+
+from few_nerd_prompting import telemetry as telemetry_module
+from few_nerd_prompting.telemetry import Telemetry, TelemetryExporter
+
+
+class TestTelemetry:
+    """
+    Tests for the Telemetry registry and its export formats
+    """
+
+    def test_histogram_buckets(self):
+        # Test that observations go to the first bucket whose upper bound is not smaller than the value
+        telemetry = Telemetry(latency_buckets=(1.0, 2.0))
+        for value in (0.5, 1.0, 1.5, 3.0):
+            telemetry.observe("latency", value, model="m")
+        histogram = telemetry.snapshot()["histograms"][0]
+        assert histogram["labels"] == {"model": "m"}
+        assert histogram["buckets"] == [[1.0, 2], [2.0, 1], ["+Inf", 1]]
+        assert histogram["count"] == 4
+        assert histogram["sum"] == 6.0
+
+    def test_counters_and_gauges(self):
+        # Test that counters and gauges with the same name but different labels are kept apart
+        telemetry = Telemetry()
+        telemetry.inc("retries", code="UNAVAILABLE")
+        telemetry.inc("retries", 2, code="UNAVAILABLE")
+        telemetry.inc("retries", code="DEADLINE_EXCEEDED")
+        telemetry.add_gauge("in_flight", 3)
+        telemetry.add_gauge("in_flight", -1)
+        assert telemetry.counter_value("retries", code="UNAVAILABLE") == 3
+        assert telemetry.counter_value("retries", code="DEADLINE_EXCEEDED") == 1
+        assert telemetry.counter_value("retries") == 0
+        assert telemetry.snapshot()["gauges"] == [{"name": "in_flight", "labels": {}, "value": 2}]
+
+    def test_prometheus_format(self):
+        # Test the text exposition format, with cumulative buckets and escaped label values
+        telemetry = Telemetry(latency_buckets=(1.0, 2.0))
+        telemetry.inc("requests_total", model='a"b')
+        telemetry.add_gauge("in_flight", 1)
+        telemetry.observe("latency", 0.5, model="m")
+        telemetry.observe("latency", 1.5, model="m")
+        assert telemetry.to_prometheus().splitlines() == [
+            "# TYPE requests_total counter",
+            'requests_total{model="a\\"b"} 1',
+            "# TYPE in_flight gauge",
+            "in_flight 1",
+            "# TYPE latency histogram",
+            'latency_bucket{model="m",le="1.0"} 1',
+            'latency_bucket{model="m",le="2.0"} 2',
+            'latency_bucket{model="m",le="+Inf"} 2',
+            'latency_sum{model="m"} 2.0',
+            'latency_count{model="m"} 2',
+        ]
+
+    def test_write_json(self, tmp_path):
+        # Test that a .json path gets the snapshot as JSON
+        telemetry = Telemetry()
+        telemetry.inc("requests_total")
+        path = str(tmp_path / "metrics.json")
+        telemetry.write(path)
+        with open(path, encoding='utf8') as fh:
+            assert json.load(fh) == telemetry.snapshot()
+
+    def test_write_is_atomic(self, tmp_path, monkeypatch):
+        # Test that the file is written in full to a temporary file, which then replaces the old file
+        telemetry = Telemetry()
+        telemetry.inc("requests_total")
+        path = str(tmp_path / "metrics.json")
+        with open(path, 'w', encoding='utf8') as fh:
+            fh.write("old")
+        replaced = []
+
+        def replace(src, dst):
+            with open(dst, encoding='utf8') as fh:
+                assert fh.read() == "old"
+            with open(src, encoding='utf8') as fh:
+                assert json.load(fh) == telemetry.snapshot()
+            replaced.append((src, dst))
+            os.rename(src, dst)
+
+        monkeypatch.setattr(telemetry_module.os, "replace", replace)
+        telemetry.write(path)
+        assert replaced == [(f"{path}.tmp", path)]
+        assert os.listdir(tmp_path) == ["metrics.json"]
+
+
+class TestTelemetryExporter:
+    """
+    Tests for writing metrics from a background thread
+    """
+
+    def test_start_stop(self, tmp_path):
+        # Test that the file is written periodically and once more when the exporter stops
+        telemetry = Telemetry()
+        path = tmp_path / "metrics.prom"
+        exporter = TelemetryExporter(telemetry, str(path), interval=0.05)
+        exporter.start()
+        deadline = time.monotonic() + 5
+        while not path.exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert path.exists()
+
+        telemetry.inc("requests_total")
+        exporter.stop()
+        assert exporter._thread is None
+        assert "requests_total 1" in path.read_text(encoding='utf8')
+
+    def test_context_manager(self, tmp_path):
+        # Test that leaving the context writes the final metrics, even before the first interval
+        telemetry = Telemetry()
+        path = tmp_path / "metrics.json"
+        with TelemetryExporter(telemetry, str(path), interval=60):
+            telemetry.inc("requests_total")
+        assert json.loads(path.read_text(encoding='utf8'))["counters"][0]["value"] == 1
+
+    def test_no_path(self):
+        # Test that nothing is started without a path
+        exporter = TelemetryExporter(Telemetry(), None)
+        exporter.start()
+        assert exporter._thread is None
+        exporter.stop()